@@ -106,32 +106,6 @@ function setupWebSocketLogic(wss: WebSocketServer) {
 				case 'PROCESS_AUDIO':
 					handleAudioProcessing(wss, payload.audio, payload.fileName);
 					break;
-				case 'REQUEST_TTS_FOR_SENTENCE':
-					if (state.currentCharacterKey && payload.sentence) {
-						const voice =
-							state.characters[state.currentCharacterKey]?.voice || 'af_heart';
-						try {
-							const ttsResponse = await axios.post(
-								`${AI_API_URL}/tts`,
-								{ text: payload.sentence, voice },
-								{ responseType: 'arraybuffer' }
-							);
-							const audioData = Buffer.from(
-								ttsResponse.data,
-								'binary'
-							).toString('base64');
-							broadcast(wss, {
-								type: 'PLAY_AUDIO',
-								payload: { audio: audioData },
-							});
-						} catch (ttsError: any) {
-							console.error(
-								`Error during TTS for sentence "${payload.sentence}":`,
-								ttsError.message
-							);
-						}
-					}
-					break;
 				case 'SWITCH_CHARACTER':
 					state.currentCharacterKey = payload.key;
 					state.chatHistory = [];
@@ -175,6 +149,25 @@ function broadcast(wss: WebSocketServer, message: object) {
 }
 
 // --- Core Interaction Logic ---
+// Wraps 16-bit mono PCM from /converse in a WAV header so browsers can play it
+function pcm16ToWav(pcm: Buffer, sampleRate: number): Buffer {
+	const header = Buffer.alloc(44);
+	header.write('RIFF', 0);
+	header.writeUInt32LE(36 + pcm.length, 4);
+	header.write('WAVE', 8);
+	header.write('fmt ', 12);
+	header.writeUInt32LE(16, 16);
+	header.writeUInt16LE(1, 20); // PCM
+	header.writeUInt16LE(1, 22); // Mono
+	header.writeUInt32LE(sampleRate, 24);
+	header.writeUInt32LE(sampleRate * 2, 28);
+	header.writeUInt16LE(2, 32);
+	header.writeUInt16LE(16, 34);
+	header.write('data', 36);
+	header.writeUInt32LE(pcm.length, 40);
+	return Buffer.concat([header, pcm]);
+}
+
 async function handleAudioProcessing(
 	wss: WebSocketServer,
 	audioBase64: string,
@@ -185,87 +178,125 @@ async function handleAudioProcessing(
 		payload: { status: 'Transcribing...' },
 	});
 	const audioBuffer = Buffer.from(audioBase64, 'base64');
+	const character = state.currentCharacterKey
+		? state.characters[state.currentCharacterKey]
+		: null;
 
 	try {
-		// 1. Speech-to-Text
+		// STT, LLM and per-sentence TTS all run in main_api in one request,
+		// which streams back newline-delimited JSON events
 		const formData = new FormData();
 		formData.append('audio_file', audioBuffer, fileName || 'audio.webm');
-		const sttResponse = await axios.post(`${AI_API_URL}/stt`, formData, {
+		formData.append('system_prompt', getSystemPrompt());
+		formData.append('voice', character?.voice || 'af_heart');
+		formData.append('history', JSON.stringify(state.chatHistory));
+		const response = await axios.post(`${AI_API_URL}/converse`, formData, {
 			headers: { ...formData.getHeaders() },
+			responseType: 'stream',
 		});
-		const userText = sttResponse.data.text;
-		if (!userText || userText.trim().length < 2) {
-			broadcast(wss, { type: 'STATUS_UPDATE', payload: { status: 'Idle' } });
-			return;
-		}
-
-		state.chatHistory.push({ role: 'user', content: userText });
-		broadcast(wss, {
-			type: 'CHAT_MESSAGE',
-			payload: { role: 'user', content: userText },
-		});
-		broadcast(wss, {
-			type: 'STATUS_UPDATE',
-			payload: { status: 'Thinking...' },
-		});
-
-		// 2. Language Model (Streaming)
-		const llmStreamResponse = await axios.post(
-			`${AI_API_URL}/llm`,
-			{
-				prompt: userText,
-				system_prompt: getSystemPrompt(),
-			},
-			{ responseType: 'stream' }
-		);
-
-		let fullResponse = '';
-		broadcast(wss, { type: 'AI_RESPONSE_START' });
-
-		const stream = llmStreamResponse.data as NodeJS.ReadableStream;
+		const stream = response.data as NodeJS.ReadableStream;
+
+		let buffered = '';
+		const handleEvent = (event: any) => {
+			switch (event.type) {
+				case 'transcript':
+					if (!event.text || event.text.trim().length < 2) {
+						broadcast(wss, {
+							type: 'STATUS_UPDATE',
+							payload: { status: 'Idle' },
+						});
+						return;
+					}
+					state.chatHistory.push({ role: 'user', content: event.text });
+					broadcast(wss, {
+						type: 'CHAT_MESSAGE',
+						payload: { role: 'user', content: event.text },
+					});
+					broadcast(wss, {
+						type: 'STATUS_UPDATE',
+						payload: { status: 'Thinking...' },
+					});
+					broadcast(wss, { type: 'AI_RESPONSE_START' });
+					break;
+				case 'text':
+					broadcast(wss, {
+						type: 'AI_RESPONSE_TEXT',
+						payload: { delta: event.delta },
+					});
+					break;
+				case 'emotion':
+					broadcast(wss, {
+						type: 'AI_RESPONSE_EMOTION',
+						payload: { emotion: event.emotion },
+					});
+					break;
+				case 'audio':
+					broadcast(wss, {
+						type: 'PLAY_AUDIO',
+						payload: {
+							audio: pcm16ToWav(
+								Buffer.from(event.data, 'base64'),
+								event.sample_rate
+							).toString('base64'),
+						},
+					});
+					break;
+				case 'done':
+					if (event.text) {
+						state.chatHistory.push({ role: 'assistant', content: event.text });
+					}
+					// Sent even for an empty reply, so clients don't stay in Thinking/Talking
+					broadcast(wss, {
+						type: 'AI_RESPONSE_END',
+						payload: { text: event.text || '', emotion: event.emotion },
+					});
+					broadcast(wss, { type: 'AUDIO_STREAM_END' });
+					if (!event.text) {
+						setTimeout(
+							() =>
+								broadcast(wss, {
+									type: 'STATUS_UPDATE',
+									payload: { status: 'Idle' },
+								}),
+							2000
+						);
+					}
+					break;
+				case 'error':
+					console.error('Error in processing chain:', event.detail);
+					broadcast(wss, {
+						type: 'STATUS_UPDATE',
+						payload: { status: 'Error' },
+					});
+					broadcast(wss, { type: 'AI_RESPONSE_END', payload: {} });
+					broadcast(wss, { type: 'AUDIO_STREAM_END' });
+					setTimeout(
+						() =>
+							broadcast(wss, {
+								type: 'STATUS_UPDATE',
+								payload: { status: 'Idle' },
+							}),
+						2000
+					);
+					break;
+			}
+		};
 
 		stream.on('data', (chunk: Buffer) => {
-			const chunkStr = chunk.toString();
-			fullResponse += chunkStr;
-			broadcast(wss, {
-				type: 'AI_RESPONSE_CHUNK',
-				payload: { chunk: chunkStr },
-			});
-		});
-
-		stream.on('end', async () => {
-			console.log('LLM stream ended.');
-			// Signal to the client that the text stream is done, so it can process any remaining text
-			// and that the audio stream will also be ending soon.
-			broadcast(wss, { type: 'AI_RESPONSE_END' });
-			broadcast(wss, { type: 'AUDIO_STREAM_END' });
-
-			let finalDataObject: { text: string; emotion: string };
-			try {
-				finalDataObject = JSON.parse(fullResponse);
-			} catch (e) {
-				console.error(
-					'Failed to parse final LLM JSON:',
-					e,
-					'Response was:',
-					fullResponse
-				);
-				finalDataObject = {
-					text: fullResponse || "I'm sorry, my thoughts got tangled.",
-					emotion: 'surprised',
-				};
+			buffered += chunk.toString();
+			const lines = buffered.split('\n');
+			buffered = lines.pop() || '';
+			for (const line of lines) {
+				if (line.trim()) handleEvent(JSON.parse(line));
 			}
-
-			state.chatHistory.push({
-				role: 'assistant',
-				content: finalDataObject.text,
-			});
 		});
 
+		stream.on('end', () => console.log('Conversation stream ended.'));
+
 		stream.on('error', (err) => {
-			console.error('LLM Stream Error:', err);
+			console.error('Conversation Stream Error:', err);
 			broadcast(wss, { type: 'STATUS_UPDATE', payload: { status: 'Error' } });
-			broadcast(wss, { type: 'AI_RESPONSE_END' }); // End the stream on the client
+			broadcast(wss, { type: 'AI_RESPONSE_END', payload: {} }); // End the stream on the client
 			setTimeout(
 				() =>
 					broadcast(wss, {
@@ -277,7 +308,7 @@ async function handleAudioProcessing(
 		});
 	} catch (error: any) {
 		if (error.response) {
-			console.error('Error in processing chain:', error.response.data);
+			console.error('Error in processing chain:', error.response.status);
 		} else {
 			console.error('Error in processing chain:', error.message);
 		}
@@ -1,5 +1,3 @@
-import { parse } from 'partial-json';
-
 // --- DOM Elements ---
 const containerEl = document.querySelector('.container') as HTMLDivElement;
 const statusEl = document.getElementById('status')!;
@@ -34,7 +32,6 @@ const TOGGLE_RECORD_KEY = 'aiImprov-toggleRecord';
 let currentAssistantMessageEl: HTMLDivElement | null = null;
 let currentResponseText = '';
 let lastResponseEmotion: string | null = null;
-let processedTextForTTS = '';
 
 // State for sentence-by-sentence audio playback
 let audioQueue: string[] = [];
@@ -81,39 +78,27 @@ function handleMessage(type: string, payload: any) {
 			currentAssistantMessageEl = msgDiv;
 			currentResponseText = '';
 			lastResponseEmotion = null;
-			processedTextForTTS = ''; // Reset TTS tracker
 			audioQueue = [];
 			isPlayingAudio = false;
 			audioStreamHasEnded = false;
 			updateCharacterImage('talking');
 			break;
-		case 'AI_RESPONSE_CHUNK':
+		case 'AI_RESPONSE_TEXT':
+			// Audio for each sentence is synthesized server-side and arrives as PLAY_AUDIO
 			if (!currentAssistantMessageEl) return;
-			currentResponseText += payload.chunk;
-			try {
-				const partialData = parse(currentResponseText);
-				if (partialData.text) {
-					currentAssistantMessageEl.textContent = partialData.text;
-					// Process the newly received text for sentences
-					processNewTextForTTS(partialData.text);
-				}
-			} catch (e) {
-				currentAssistantMessageEl.textContent = currentResponseText;
-			}
+			currentResponseText += payload.delta;
+			currentAssistantMessageEl.textContent = currentResponseText;
 			chatHistoryEl.scrollTop = chatHistoryEl.scrollHeight;
 			break;
+		case 'AI_RESPONSE_EMOTION':
+			lastResponseEmotion = payload.emotion;
+			break;
 		case 'AI_RESPONSE_END':
-			if (currentAssistantMessageEl) {
-				try {
-					const finalData = JSON.parse(currentResponseText);
-					if (finalData.emotion) {
-						lastResponseEmotion = finalData.emotion;
-					}
-					// Process any remaining text after the stream ends
-					processNewTextForTTS(finalData.text, true);
-				} catch (e) {
-					console.error("Couldn't parse final JSON for emotion", e);
-				}
+			if (currentAssistantMessageEl && payload.text) {
+				currentAssistantMessageEl.textContent = payload.text;
+			}
+			if (payload.emotion) {
+				lastResponseEmotion = payload.emotion;
 			}
 			currentAssistantMessageEl = null;
 			break;
@@ -141,35 +126,6 @@ function sendMessage(type: string, payload: object) {
 	}
 }
 
-function processNewTextForTTS(fullText: string, isFinal = false) {
-	// Find the portion of the text that we haven't processed yet
-	let newText = fullText.substring(processedTextForTTS.length);
-
-	const sentenceEndRegex = /([^.!?]+[.!?])\s*/g;
-	let match;
-
-	while ((match = sentenceEndRegex.exec(newText)) !== null) {
-		const sentence = match[1].trim();
-		if (sentence) {
-			console.log(`Client detected sentence: "${sentence}"`);
-			sendMessage('REQUEST_TTS_FOR_SENTENCE', { sentence });
-			// Update the tracker to include the sentence we just processed
-			processedTextForTTS += match[0];
-		}
-	}
-
-	// If this is the final chunk, send any remaining text as a sentence
-	if (isFinal) {
-		newText = fullText.substring(processedTextForTTS.length);
-		const remainingSentence = newText.trim();
-		if (remainingSentence) {
-			console.log(`Client detected final sentence: "${remainingSentence}"`);
-			sendMessage('REQUEST_TTS_FOR_SENTENCE', { sentence: remainingSentence });
-			processedTextForTTS = fullText;
-		}
-	}
-}
-
 // --- UI Updates ---
 function updateStatus(status: string) {
 	statusEl.textContent = status;
@@ -1,16 +1,29 @@
+import argparse
+import hashlib
 import json
 import os
-from stable_diffusion_cpp import StableDiffusion
+import queue
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
 import config as cfg
+from lib.models import file_size, manager
 
 # --- Character Configuration ---
-# Change these values to generate a new character
+# Used when no manifest is given. A manifest is a JSON list of characters, e.g.
+# [{"name": "Luna", "voice": "af_heart"},
+#  {"name": "Rex", "voice": "am_onyx", "description": "a grumpy robot dog"}]
 CHARACTER_NAME = "Luna"
 CHARACTER_VOICE = "af_heart"  # A voice from the list in lib/tts.py
 # --- End Configuration ---
 
-BASE_PROMPT = f"a digital illustration of a friendly AI character named {CHARACTER_NAME}"
-OUTPUT_DIR = os.path.join("./data/characters/", CHARACTER_NAME.lower())
+CHARACTERS_DIR = "./data/characters/"
+# In derive mode this is rendered with txt2img and every other image is
+# derived from it with img2img, keeping the face consistent
+BASE_EMOTION = "neutral"
+DEFAULT_DESCRIPTION = "a friendly AI character"
 EMOTIONS = {
     "neutral": "with a calm expression",
     "happy": "smiling warmly",
@@ -21,41 +34,388 @@ EMOTIONS = {
 }
 
 
-def generate_images():
-	os.makedirs(OUTPUT_DIR, exist_ok=True)
-	sd = StableDiffusion(model_path=cfg.IMAGE_MODEL, verbose=False)
-
-	image_mapping = {}
-	charname_lower = CHARACTER_NAME.lower()
-	for key, detail in EMOTIONS.items():
-		full_prompt = f"{BASE_PROMPT}, {key} expression, {detail}"
-		print(f"Generating: {key} => {full_prompt}")
-
-		images = sd.txt_to_img(prompt=full_prompt,
-		                       width=512,
-		                       height=512,
-		                       sample_steps=25,
-		                       seed=-1)
-
-		filename = f"{charname_lower}_{key}.png"
+def load_model():
+	"""Loads the Stable Diffusion model. Slow, so only do this once per run."""
+	from stable_diffusion_cpp import StableDiffusion
+	print(f"Loading image model: {cfg.IMAGE_MODEL}")
+	return StableDiffusion(model_path=cfg.IMAGE_MODEL, verbose=False)
+
+
+def base_prompt(character: Dict[str, Any]) -> str:
+	description = character.get("description", DEFAULT_DESCRIPTION)
+	return f"a digital illustration of {description} named {character['name']}"
+
+
+def emotion_prompt(character: Dict[str, Any], key: str, detail: str) -> str:
+	return f"{base_prompt(character)}, {key} expression, {detail}"
+
+
+def derive_seed(name: str, key: str, base_seed: int = 0) -> int:
+	"""A stable per-image seed, so a re-run reproduces (and can skip) the same image."""
+	digest = hashlib.sha256(f"{name.lower()}:{key}:{base_seed}".encode()).digest()
+	return int.from_bytes(digest[:4], 'little') & 0x7fffffff
+
+
+def image_hash(params: Dict[str, Any]) -> str:
+	"""Hash of everything that determines an image's content."""
+	params = dict(params, model=os.path.basename(cfg.IMAGE_MODEL))
+	return hashlib.sha256(json.dumps(params,
+	                                 sort_keys=True).encode()).hexdigest()[:16]
+
+
+def character_dir(name: str) -> str:
+	return os.path.join(CHARACTERS_DIR, name.lower())
+
+
+def load_config(output_dir: str) -> Dict[str, Any]:
+	config_path = os.path.join(output_dir, "config.json")
+	try:
+		with open(config_path, "r") as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+
+def save_config(output_dir: str, character_config: Dict[str, Any]):
+	"""Writes config.json atomically, so an interrupted run never leaves it half-written."""
+	config_path = os.path.join(output_dir, "config.json")
+	tmp_path = config_path + ".tmp"
+	with open(tmp_path, "w") as f:
+		json.dump(character_config, f, indent=2)
+	os.replace(tmp_path, config_path)
+
+
+class CharacterImageGenerator:
+	"""
+    Generates character images and configs. The model is loaded on first use
+    and kept for every character after that.
+
+    With derive=True only the base portrait is generated from scratch; the other
+    images are img2img variations of it at derive_strength and derive_steps.
+    """
+
+	def __init__(self,
+	             sample_steps: int = 25,
+	             size: int = 512,
+	             base_seed: int = 0,
+	             derive: bool = False,
+	             derive_strength: float = 0.45,
+	             derive_steps: int | None = None):
+		self.sample_steps = sample_steps
+		self.size = size
+		self.base_seed = base_seed
+		self.derive = derive
+		self.derive_strength = derive_strength
+		# img2img only runs strength * steps denoising steps, so fewer are needed
+		self.derive_steps = derive_steps or max(8, sample_steps // 2)
+		self._sd = None
+
+	@property
+	def sd(self):
+		if self._sd is None:
+			self._sd = load_model()
+		return self._sd
+
+	def unload(self):
+		self._sd = None
+
+	def generate_character(self, character: Dict[str, Any]) -> int:
+		"""
+        Generates any of a character's images that are missing or out of date.
+        Returns the number of images generated.
+        """
+		name = character["name"]
+		output_dir = character.get("dir") or character_dir(name)
+		os.makedirs(output_dir, exist_ok=True)
+
+		# Keep fields edited elsewhere (e.g. instructions from the web UI)
+		character_config = load_config(output_dir)
+		character_config["name"] = name
+		character_config["voice"] = character.get(
+		    "voice", character_config.get("voice", CHARACTER_VOICE))
+		if "description" in character:
+			# Kept so images generated later on demand match the rest
+			character_config["description"] = character["description"]
+		character_config.setdefault("images", {})
+		character_config.setdefault("generation", {})
+
+		emotions = dict(EMOTIONS, **character.get("emotions", {}))
+		generated = 0
+		if self.derive and BASE_EMOTION in emotions:
+			# The base has to exist before anything can be derived from it
+			if self.generate_image(character, character_config, BASE_EMOTION,
+			                       emotions.pop(BASE_EMOTION)):
+				generated += 1
+		for key, detail in emotions.items():
+			if self.generate_image(character, character_config, key, detail):
+				generated += 1
+
+		save_config(output_dir, character_config)
+		return generated
+
+	def generate_image(self, character: Dict[str, Any],
+	                   character_config: Dict[str, Any], key: str,
+	                   detail: str) -> bool:
+		"""
+        Renders one image unless an up-to-date one exists, then saves the config
+        so an interrupted run picks up where it left off. Returns True if rendered.
+        """
+		name = character["name"]
+		output_dir = character.get("dir") or character_dir(name)
+		prompt = emotion_prompt(character, key, detail)
+		seed = derive_seed(name, key, self.base_seed)
+		generation = character_config["generation"]
+
+		base_path = character_config["images"].get(BASE_EMOTION)
+		derived = (self.derive and key != BASE_EMOTION and base_path is not None
+		           and os.path.exists(base_path))
+		if derived:
+			params = {
+			    "prompt": prompt,
+			    "seed": seed,
+			    "steps": self.derive_steps,
+			    "size": self.size,
+			    "strength": self.derive_strength,
+			    # A new base portrait invalidates everything derived from it
+			    "base": generation.get(BASE_EMOTION, {}).get("hash")
+			}
+		else:
+			params = {
+			    "prompt": prompt,
+			    "seed": seed,
+			    "steps": self.sample_steps,
+			    "size": self.size
+			}
+		params_hash = image_hash(params)
+
+		filename = f"{name.lower()}_{key}.png"
 		# Save image inside the character's specific directory
-		filepath = os.path.join(OUTPUT_DIR, filename)
+		filepath = os.path.join(output_dir, filename)
+		if os.path.exists(filepath) and generation.get(key,
+		                                               {}).get("hash") == params_hash:
+			print(f"Skipping: {name}/{key} (up to date)")
+			return False
+
+		start = time.time()
+		if derived:
+			print(f"Deriving: {name}/{key} from {BASE_EMOTION} => {prompt}")
+			images = self.sd.img_to_img(image=base_path,
+			                            prompt=prompt,
+			                            width=self.size,
+			                            height=self.size,
+			                            sample_steps=self.derive_steps,
+			                            strength=self.derive_strength,
+			                            seed=seed)
+		else:
+			print(f"Generating: {name}/{key} => {prompt}")
+			images = self.sd.txt_to_img(prompt=prompt,
+			                            width=self.size,
+			                            height=self.size,
+			                            sample_steps=self.sample_steps,
+			                            seed=seed)
 		images[0].save(filepath)
+		print(f"  ...done in {time.time() - start:.1f}s")
+
 		# Store the relative path for the config
-		image_mapping[key] = filepath
+		character_config["images"][key] = filepath
+		generation[key] = dict(params, hash=params_hash)
+		save_config(output_dir, character_config)
+		return True
 
-	character_config = {
-	    "name": CHARACTER_NAME,
-	    "voice": CHARACTER_VOICE,
-	    "images": image_mapping
-	}
 
-	config_path = os.path.join(OUTPUT_DIR, "config.json")
-	with open(config_path, "w") as f:
-		json.dump(character_config, f, indent=2)
+# Anything else the LLM comes up with is not worth rendering
+VALID_EMOTION_RE = re.compile(r"^[a-z][a-z -]{1,23}$")
+
+
+def _lower_thread_priority():
+	"""Niceness is per-thread on Linux; threads started from here inherit it."""
+	try:
+		os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+	except (AttributeError, OSError):
+		pass
+
+
+class BackgroundImageQueue:
+	"""
+    Renders images for emotions a character doesn't have yet, on a low-priority
+    background thread. A job only starts once is_idle() has been true for
+    idle_delay seconds, so it doesn't compete with a live turn. Results are
+    written to the character's config.json, which the character registry picks up.
+    """
+
+	def __init__(self,
+	             is_idle: Callable[[], bool],
+	             characters_dir: str = CHARACTERS_DIR,
+	             idle_delay: float = 5.0,
+	             sample_steps: int = 20):
+		self.is_idle = is_idle
+		self.characters_dir = characters_dir
+		self.idle_delay = idle_delay
+		# Derived from the neutral portrait when there is one, which is much faster
+		self.generator = CharacterImageGenerator(sample_steps=sample_steps,
+		                                         derive=True)
+		manager.register('image',
+		                 load=lambda: self.generator.sd,
+		                 unload=self.generator.unload,
+		                 is_loaded=lambda: self.generator._sd is not None,
+		                 size_hint=file_size(cfg.IMAGE_MODEL))
+		self.jobs: queue.Queue = queue.Queue()
+		self.pending = set()
+		self.lock = threading.Lock()
+		self._thread: threading.Thread | None = None
+		self._stop_event = threading.Event()
+
+	def request(self, character_key: str, emotion: str) -> bool:
+		"""Queues an image for `emotion`. Returns False if invalid or already queued."""
+		emotion = emotion.strip().lower()
+		if not VALID_EMOTION_RE.match(emotion):
+			return False
+		job = (character_key, emotion)
+		with self.lock:
+			if job in self.pending:
+				return False
+			self.pending.add(job)
+		print(f"Queued background image: {character_key}/{emotion}")
+		self.jobs.put(job)
+		return True
+
+	def start(self):
+		if self._thread and self._thread.is_alive():
+			return
+		self._stop_event.clear()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		self._stop_event.set()
+		self.jobs.put(None)
+
+	def _wait_for_idle(self) -> bool:
+		idle_since = None
+		while not self._stop_event.is_set():
+			if self.is_idle():
+				idle_since = idle_since or time.time()
+				if time.time() - idle_since >= self.idle_delay:
+					return True
+			else:
+				idle_since = None
+			self._stop_event.wait(0.5)
+		return False
+
+	def _run(self):
+		_lower_thread_priority()
+		while True:
+			job = self.jobs.get()
+			if job is None or not self._wait_for_idle():
+				break
+			try:
+				self._generate(*job)
+			except Exception as e:
+				print(f"Error generating background image {job}: {e}")
+			finally:
+				with self.lock:
+					self.pending.discard(job)
+			if self.jobs.empty():
+				# Don't hold the image model's memory while there's nothing to do
+				manager.unload('image', "queue empty")
+
+	def _generate(self, character_key: str, emotion: str):
+		output_dir = os.path.join(self.characters_dir, character_key)
+		character_config = load_config(output_dir)
+		if not character_config or emotion in character_config.get("images", {}):
+			return
+		character = {
+		    "name": character_config.get("name", character_key),
+		    "description": character_config.get("description",
+		                                        DEFAULT_DESCRIPTION),
+		    "dir": output_dir
+		}
+		character_config.setdefault("images", {})
+		character_config.setdefault("generation", {})
+		detail = EMOTIONS.get(emotion, f"looking {emotion}")
+		with manager.use('image'):
+			self.generator.generate_image(character, character_config, emotion,
+			                              detail)
+
+
+def load_manifest(path: str) -> List[Dict[str, Any]]:
+	with open(path, "r") as f:
+		manifest = json.load(f)
+	if isinstance(manifest, dict):
+		manifest = manifest.get("characters", [])
+	for character in manifest:
+		if "name" not in character:
+			raise ValueError(f"Manifest entry is missing a name: {character}")
+	return manifest
+
+
+def generate_images():
+	parser = argparse.ArgumentParser(
+	    description=
+	    "Generate character images and configs. Existing up-to-date images are skipped, so an interrupted run can simply be restarted."
+	)
+	parser.add_argument("manifest",
+	                    nargs="?",
+	                    help="JSON file listing the characters to generate.")
+	parser.add_argument("--name",
+	                    default=CHARACTER_NAME,
+	                    help="Character name when no manifest is given.")
+	parser.add_argument("--voice",
+	                    default=CHARACTER_VOICE,
+	                    help="Character voice when no manifest is given.")
+	parser.add_argument("--steps",
+	                    type=int,
+	                    default=25,
+	                    help="Sampling steps per image (default: 25).")
+	parser.add_argument("--size",
+	                    type=int,
+	                    default=512,
+	                    help="Image width/height, a multiple of 64.")
+	parser.add_argument(
+	    "--seed",
+	    type=int,
+	    default=0,
+	    help="Base seed; change it to get a different set of images.")
+	parser.add_argument(
+	    "--derive",
+	    action="store_true",
+	    help=
+	    f"Generate only the '{BASE_EMOTION}' portrait from scratch and derive the rest from it with img2img (faster, more consistent faces)."
+	)
+	parser.add_argument(
+	    "--derive-strength",
+	    type=float,
+	    default=0.45,
+	    help="img2img strength for derived images, 0-1 (default: 0.45).")
+	parser.add_argument(
+	    "--derive-steps",
+	    type=int,
+	    default=None,
+	    help="Sampling steps for derived images (default: half of --steps).")
+	args = parser.parse_args()
+
+	if args.manifest:
+		characters = load_manifest(args.manifest)
+	else:
+		characters = [{"name": args.name, "voice": args.voice}]
+
+	generator = CharacterImageGenerator(sample_steps=args.steps,
+	                                    size=args.size,
+	                                    base_seed=args.seed,
+	                                    derive=args.derive,
+	                                    derive_strength=args.derive_strength,
+	                                    derive_steps=args.derive_steps)
+	start = time.time()
+	total = 0
+	for i, character in enumerate(characters, 1):
+		print(f"\n[{i}/{len(characters)}] {character['name']}")
+		total += generator.generate_character(character)
+		print(
+		    f"Character '{character['name']}' saved to {character_dir(character['name'])}"
+		)
 
 	print(
-	    f"\nCharacter '{CHARACTER_NAME}' generated and config saved to {config_path}"
+	    f"\nGenerated {total} images for {len(characters)} characters in {time.time() - start:.1f}s"
 	)
 
 
@@ -0,0 +1,103 @@
+import io
+import struct
+
+import numpy as np
+import ffmpeg
+
+SAMPLE_RATE = 16000  # Whisper models are trained on 16kHz audio
+
+
+def pcm16_to_float32(data: bytes) -> np.ndarray:
+	"""Converts little-endian 16-bit PCM bytes to a (n, 1) float32 array."""
+	samples = np.frombuffer(data, dtype='<i2').astype(np.float32) / 32768.0
+	return samples.reshape(-1, 1)
+
+
+def resample(audio: np.ndarray, orig_rate: int,
+             target_rate: int = SAMPLE_RATE) -> np.ndarray:
+	"""
+    Linearly resamples a (n, 1) float32 array.
+    Good enough for speech going into Whisper; avoids pulling in a DSP library.
+    """
+	if orig_rate == target_rate or len(audio) == 0:
+		return audio
+	flat = audio.reshape(-1)
+	n_out = int(round(len(flat) * target_rate / orig_rate))
+	x_old = np.arange(len(flat), dtype=np.float64)
+	x_new = np.linspace(0, len(flat) - 1, n_out)
+	return np.interp(x_new, x_old, flat).astype(np.float32).reshape(-1, 1)
+
+
+def decode_audio(data: bytes, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+	"""
+    Decodes an encoded audio blob (e.g. WebM/Opus or OGG/Opus from a browser's
+    MediaRecorder) to a mono (n, 1) float32 array using ffmpeg over pipes.
+    """
+	out, _ = (ffmpeg.input('pipe:0').output('pipe:1',
+	                                        format='f32le',
+	                                        ac=1,
+	                                        ar=str(sample_rate)).run(
+	                                            input=data,
+	                                            capture_stdout=True,
+	                                            quiet=True))
+	return np.frombuffer(out, dtype=np.float32).reshape(-1, 1)
+
+
+def float32_to_pcm16(audio: np.ndarray) -> bytes:
+	"""Converts float32 samples in [-1, 1] to little-endian 16-bit PCM bytes."""
+	return (np.clip(audio, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+
+def wav_stream_header(sample_rate: int, channels: int = 1) -> bytes:
+	"""
+    A 16-bit PCM WAV header for a stream of unknown length. The size fields are
+    set to the maximum, which browsers and ffmpeg read as "until the end".
+    """
+	byte_rate = sample_rate * channels * 2
+	return (b'RIFF' + struct.pack('<I', 0xFFFFFFFF) + b'WAVEfmt ' +
+	        struct.pack('<IHHIIHH', 16, 1, channels, sample_rate, byte_rate,
+	                    channels * 2, 16) + b'data' +
+	        struct.pack('<I', 0xFFFFFFFF))
+
+
+class OpusEncoder:
+	"""
+    Incrementally encodes float32 mono audio to Ogg/Opus with PyAV. Each call to
+    encode() returns the Ogg bytes produced so far, so they can be streamed.
+    """
+
+	def __init__(self, sample_rate: int, bitrate: int = 32000):
+		import av  # Optional; only needed for Opus output
+
+		self.buffer = io.BytesIO()
+		self.position = 0
+		self.container = av.open(self.buffer, mode='w', format='ogg')
+		self.stream = self.container.add_stream('libopus', rate=sample_rate)
+		self.stream.bit_rate = bitrate
+		self.stream.layout = 'mono'
+		self.sample_rate = sample_rate
+		self.pts = 0
+
+	def _read(self) -> bytes:
+		data = self.buffer.getvalue()[self.position:]
+		self.position += len(data)
+		return data
+
+	def encode(self, audio: np.ndarray) -> bytes:
+		import av
+
+		samples = (np.clip(audio.reshape(1, -1), -1.0, 1.0) * 32767).astype(np.int16)
+		frame = av.AudioFrame.from_ndarray(samples, format='s16', layout='mono')
+		frame.sample_rate = self.sample_rate
+		frame.pts = self.pts
+		self.pts += samples.shape[1]
+		for packet in self.stream.encode(frame):
+			self.container.mux(packet)
+		return self._read()
+
+	def close(self) -> bytes:
+		"""Flushes the encoder and returns the last bytes of the stream."""
+		for packet in self.stream.encode(None):
+			self.container.mux(packet)
+		self.container.close()
+		return self._read()
@@ -0,0 +1,276 @@
+"""
+Finds the fastest llama.cpp settings for a language model on this machine.
+
+Run from the project root, e.g.:
+    python -m lib.autotune
+    python -m lib.autotune --model ./other-model.gguf --max-memory-gb 12
+
+Settings are tuned one at a time (threads, batch size, KV cache type, then
+context size), keeping the best value of each, by timing the prefill of a
+character's prompt and a short greedy reply. A setting's score is the time a
+turn of that shape would take. The best settings are saved in
+lib.llm.PROFILE_FILE under this host and model, and llm.init() uses them from
+then on, so each machine (e.g. at a new venue) only needs tuning once.
+"""
+import argparse
+import time
+from typing import Any, Dict, List
+
+from llama_cpp import Llama
+
+import config as cfg
+import lib.llm as llm
+from lib.characters import build_system_prompt
+from lib.models import GB, resident_memory
+from lib.threads import governor
+
+SYSTEM_PROMPT = build_system_prompt({'name': 'Luna'},
+                                    ['neutral', 'happy', 'sad', 'surprised'])
+# A few turns of history, so the prompt is as long as a real one mid-scene
+HISTORY = [
+    ("Hi! What's your name?", "I'm Luna! It's lovely to meet you."),
+    ("What are you up to today?",
+     "Oh, just practicing my juggling. I keep dropping the third ball though!"),
+    ("Can you tell me a story about a dragon?",
+     "Once upon a time, a very small dragon was afraid of the dark..."),
+]
+PROMPT = "That's a great start! What happens next?"
+# Settings within this fraction of the best are considered a tie, and the
+# earlier (cheaper or safer) candidate wins
+TIE = 0.03
+
+
+def prompt_tokens(model: Llama) -> List[int]:
+	history = [{
+	    'role': role,
+	    'content': text
+	} for turn in HISTORY for role, text in zip(('user', 'assistant'), turn)]
+	messages = llm.build_messages(PROMPT, SYSTEM_PROMPT, history)
+	text = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+	return model.tokenize((text + "\nassistant:").encode('utf-8'))
+
+
+def measure(model: Llama, tokens: List[int], reply_tokens: int,
+            runs: int) -> Dict[str, float]:
+	"""Best prefill and decode tokens/sec over `runs` from an empty KV cache."""
+	prefill, decode = 0.0, 0.0
+	for _ in range(runs):
+		model.reset()
+		start = time.time()
+		first_at = 0.0
+		n = 0
+		# Greedy and past any end-of-text, so every run decodes reply_tokens
+		for _ in model.generate(tokens, temp=0.0):
+			n += 1
+			if n == 1:
+				first_at = time.time()
+			if n > reply_tokens:
+				break
+		end = time.time()
+		prefill = max(prefill, len(tokens) / max(first_at - start, 1e-6))
+		decode = max(decode, (n - 1) / max(end - first_at, 1e-6))
+	return {'prefill_tps': prefill, 'decode_tps': decode}
+
+
+def turn_seconds(result: Dict[str, float], n_prompt: int,
+                 reply_tokens: int) -> float:
+	return n_prompt / result['prefill_tps'] + reply_tokens / result['decode_tps']
+
+
+class Tuner:
+
+	def __init__(self,
+	             model_path: str,
+	             reply_tokens: int = 64,
+	             runs: int = 2,
+	             max_memory_gb: float | None = None):
+		self.model_path = model_path
+		self.reply_tokens = reply_tokens
+		self.runs = runs
+		self.max_memory = max_memory_gb * GB if max_memory_gb else None
+		self.n_prompt = 0
+
+	def run(self, profile: Dict[str, Any]) -> Dict[str, Any] | None:
+		"""Loads the model with `profile` and measures it; None if it fails or is too big."""
+		before = resident_memory()
+		try:
+			model = llm.load_model(self.model_path,
+			                       profile['n_ctx'],
+			                       draft=None,
+			                       profile=profile)
+		except Exception as e:
+			print(f"  {profile}: failed to load ({e})")
+			return None
+		try:
+			return self._measure(model, profile, before)
+		finally:
+			llm.close_model(model)
+
+	def _measure(self, model: Llama, profile: Dict[str, Any],
+	             before: int) -> Dict[str, Any] | None:
+		tokens = prompt_tokens(model)
+		self.n_prompt = len(tokens)
+		try:
+			result = measure(model, tokens, self.reply_tokens, self.runs)
+		except Exception as e:
+			print(f"  {profile}: failed ({e})")
+			return None
+		memory = max(0, resident_memory() - before)
+		result.update(profile,
+		              memory_gb=round(memory / GB, 2),
+		              turn_s=turn_seconds(result, len(tokens), self.reply_tokens))
+		over = self.max_memory is not None and memory > self.max_memory
+		print(f"  {self._describe(profile)}  prefill {result['prefill_tps']:7.1f} tok/s  "
+		      f"decode {result['decode_tps']:6.1f} tok/s  {result['memory_gb']:5.2f} GB  "
+		      f"turn {result['turn_s']:.2f}s{'  (over memory limit)' if over else ''}")
+		return None if over else result
+
+	@staticmethod
+	def _describe(profile: Dict[str, Any]) -> str:
+		return (f"threads={profile['n_threads']:<3} batch={profile['n_batch']:<5} "
+		        f"kv={profile['kv_cache']}{'+fa' if profile['flash_attn'] else '':3} "
+		        f"ctx={profile['n_ctx']:<6}")
+
+	@staticmethod
+	def pick(results: List[Dict[str, Any] | None]) -> Dict[str, Any] | None:
+		"""The fastest result, or the first one within TIE of it."""
+		valid = [r for r in results if r]
+		if not valid:
+			return None
+		fastest = min(r['turn_s'] for r in valid)
+		return next(r for r in valid if r['turn_s'] <= fastest * (1 + TIE))
+
+	def tune_threads(self, profile: Dict[str, Any],
+	                 candidates: List[int]) -> Dict[str, Any] | None:
+		# Threads can change without a reload, so one model serves every candidate
+		before = resident_memory()
+		model = llm.load_model(self.model_path,
+		                       profile['n_ctx'],
+		                       draft=None,
+		                       profile=profile)
+		try:
+			results = []
+			for n_threads in candidates:
+				llm.set_threads(model, n_threads)
+				results.append(
+				    self._measure(model, dict(profile, n_threads=n_threads), before))
+		finally:
+			llm.close_model(model)
+		return self.pick(results)
+
+	def tune(self, profile: Dict[str, Any], key: str,
+	         candidates: List[Any]) -> Dict[str, Any] | None:
+		results = []
+		for value in candidates:
+			if isinstance(value, dict):
+				results.append(self.run(dict(profile, **value)))
+			else:
+				results.append(self.run(dict(profile, **{key: value})))
+		return self.pick(results)
+
+
+PROFILE_KEYS = ['n_threads', 'n_batch', 'kv_cache', 'flash_attn', 'n_ctx']
+
+
+def autotune(model_path: str,
+             contexts: List[int],
+             reply_tokens: int = 64,
+             runs: int = 2,
+             max_memory_gb: float | None = None) -> Dict[str, Any] | None:
+	tuner = Tuner(model_path, reply_tokens, runs, max_memory_gb)
+	cores = len(governor.cores)
+	thread_counts = sorted(
+	    {max(1, n) for n in [cores // 4, cores // 2, cores * 3 // 4, cores - 1, cores]})
+	profile: Dict[str, Any] = {
+	    'n_threads': cores,
+	    'n_batch': 512,
+	    'kv_cache': 'f16',
+	    'flash_attn': False,
+	    'n_ctx': contexts[0]
+	}
+	# Ties go to the earliest candidate: fewer threads (leaving cores for STT
+	# and TTS), smaller batches and contexts (less memory), full-precision KV
+	steps = [
+	    ('n_threads', thread_counts),
+	    ('n_batch', [128, 256, 512, 1024, 2048]),
+	    ('kv_cache', [{
+	        'kv_cache': 'f16',
+	        'flash_attn': False
+	    }, {
+	        'kv_cache': 'f16',
+	        'flash_attn': True
+	    }, {
+	        'kv_cache': 'q8_0',
+	        'flash_attn': True
+	    }, {
+	        'kv_cache': 'q4_0',
+	        'flash_attn': True
+	    }]),
+	    ('n_ctx', contexts),
+	]
+	best = None
+	for key, candidates in steps:
+		print(f"\n--- {key} ---")
+		if key == 'n_threads':
+			result = tuner.tune_threads(profile, candidates)
+		else:
+			result = tuner.tune(profile, key, candidates)
+		if result is None:
+			print(f"No {key} setting worked; keeping {profile[key]}")
+			continue
+		best = result
+		profile = {k: result[k] for k in PROFILE_KEYS}
+	if best is None:
+		return None
+	return {
+	    **profile, 'prefill_tps': round(best['prefill_tps'], 1),
+	    'decode_tps': round(best['decode_tps'], 1),
+	    'memory_gb': best['memory_gb'],
+	    'prompt_tokens': tuner.n_prompt,
+	    'tuned_at': time.strftime('%Y-%m-%d %H:%M')
+	}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+	    description=
+	    "Find the fastest llama.cpp settings for a model on this machine and save them for llm.init()."
+	)
+	parser.add_argument("--model",
+	                    default=cfg.LANGUAGE_MODEL,
+	                    help="GGUF to tune (default: LANGUAGE_MODEL).")
+	parser.add_argument(
+	    "--n-ctx",
+	    default=f"{llm.DEFAULT_N_CTX},{llm.DEFAULT_N_CTX * 2}",
+	    help=
+	    "Comma-separated context sizes to try, smallest first; each must hold a scene's prompt and history."
+	)
+	parser.add_argument("--reply-tokens",
+	                    type=int,
+	                    default=64,
+	                    help="Tokens to decode per run (default: 64).")
+	parser.add_argument("--runs", type=int, default=2)
+	parser.add_argument(
+	    "--max-memory-gb",
+	    type=float,
+	    default=getattr(cfg, 'MODEL_MEMORY_BUDGET_GB', None),
+	    help=
+	    "Skip settings whose resident memory exceeds this (default: MODEL_MEMORY_BUDGET_GB)."
+	)
+	parser.add_argument("--dry-run",
+	                    action="store_true",
+	                    help=f"Don't save the result to {llm.PROFILE_FILE}.")
+	args = parser.parse_args()
+
+	contexts = sorted(int(n) for n in args.n_ctx.split(","))
+	best = autotune(args.model, contexts, args.reply_tokens, args.runs,
+	                args.max_memory_gb)
+	if best is None:
+		print("\nNo setting could be measured.")
+	else:
+		print(f"\nBest for {llm.profile_key(args.model)}:")
+		for key, value in best.items():
+			print(f"  {key}: {value}")
+		if not args.dry_run:
+			llm.save_profile(args.model, best)
+			print(f"Saved to {llm.PROFILE_FILE}; llm.init() uses it on this machine.")
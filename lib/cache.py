@@ -0,0 +1,105 @@
+import hashlib
+import os
+import re
+from typing import Tuple
+
+import diskcache
+import numpy as np
+
+CACHE_DIR = "./data/cache"
+DEFAULT_TTL = 7 * 24 * 3600  # A week covers a run of rehearsals and shows
+
+
+def normalize_transcript(text: str) -> str:
+	"""Lowercases and strips punctuation, so "What's your name?" == "whats your name"."""
+	text = re.sub(r"[^\w\s]", "", text.lower())
+	return " ".join(text.split())
+
+
+def _key(*parts: str) -> str:
+	return hashlib.sha256("\x00".join(parts).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+	"""
+    Two-level, disk-backed LRU cache for repeated lines:
+
+    1. replies: normalized transcript + character + system prompt hash + the
+       reply it answers -> LLM reply
+    2. audio: text + voice + speed -> synthesized audio
+
+    Each level has its own size limit; entries also expire after `ttl` seconds.
+    """
+
+	def __init__(self,
+	             directory: str = CACHE_DIR,
+	             reply_size_limit: int = 16 * 1024**2,
+	             audio_size_limit: int = 512 * 1024**2,
+	             ttl: float = DEFAULT_TTL):
+		self.ttl = ttl
+		self.replies = diskcache.Cache(os.path.join(directory, "replies"),
+		                               size_limit=reply_size_limit,
+		                               eviction_policy='least-recently-used')
+		self.audio = diskcache.Cache(os.path.join(directory, "audio"),
+		                             size_limit=audio_size_limit,
+		                             eviction_policy='least-recently-used')
+
+	@staticmethod
+	def reply_key(transcript: str,
+	              character_name: str,
+	              system_prompt: str,
+	              context: str = '') -> str:
+		"""`context` is the previous reply, so "yes" or "why?" only hit in the same spot."""
+		prompt_hash = hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()
+		return _key("reply", normalize_transcript(transcript), character_name,
+		            prompt_hash, context.strip())
+
+	@staticmethod
+	def audio_key(text: str, voice: str, speed: float, engine: str,
+	              sample_rate: int) -> str:
+		"""The engine and rate are part of it, so switching engines doesn't replay old audio."""
+		return _key("audio", text.strip(), voice, f"{speed:.3f}", engine,
+		            str(sample_rate))
+
+	def get_reply(self,
+	              transcript: str,
+	              character_name: str,
+	              system_prompt: str,
+	              context: str = '') -> str | None:
+		return self.replies.get(
+		    self.reply_key(transcript, character_name, system_prompt, context))
+
+	def set_reply(self,
+	              transcript: str,
+	              character_name: str,
+	              system_prompt: str,
+	              reply: str,
+	              context: str = ''):
+		self.replies.set(self.reply_key(transcript, character_name, system_prompt,
+		                                context),
+		                 reply,
+		                 expire=self.ttl)
+
+	def get_audio(self, text: str, voice: str, speed: float, engine: str,
+	              sample_rate: int) -> Tuple[np.ndarray, int] | None:
+		entry = self.audio.get(
+		    self.audio_key(text, voice, speed, engine, sample_rate))
+		if entry is None:
+			return None
+		sample_rate, data = entry
+		return np.frombuffer(data, dtype=np.float32), sample_rate
+
+	def set_audio(self, text: str, voice: str, speed: float, engine: str,
+	              audio: np.ndarray, sample_rate: int):
+		entry = (sample_rate, np.asarray(audio, dtype=np.float32).tobytes())
+		self.audio.set(self.audio_key(text, voice, speed, engine, sample_rate),
+		               entry,
+		               expire=self.ttl)
+
+	def clear(self):
+		self.replies.clear()
+		self.audio.clear()
+
+	def close(self):
+		self.replies.close()
+		self.audio.close()
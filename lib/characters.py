@@ -0,0 +1,328 @@
+import io
+import json
+import os
+import struct
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from PIL import Image
+
+# Matches IMAGE_MAX_SIZE in lib/display.py so the display doesn't need to rescale
+DISPLAY_IMAGE_SIZE = (300, 450)
+# Image keys that are app states rather than emotions the LLM can pick
+STATE_IMAGE_KEYS = ['talking', 'listening', 'thinking']
+
+PACK_FILENAME = "character.pack"
+PACK_MAGIC = b"AICHAR01"
+
+
+def build_system_prompt(config: Dict[str, Any], valid_emotions: List[str]) -> str:
+	"""Builds the system prompt for a character config."""
+	char_name = config.get('name', 'AI')
+	prompt = (
+	    f"You are a helpful, expressive AI character named {char_name}. "
+	    f"Respond in JSON object format with keys: 'text' (spoken output), and optional 'emotion'. "
+	    f"Valid emotions are: {valid_emotions}.\n"
+	    "Example response:\n"
+	    '{"text": "Hello! How can I help you today?", "emotion": "happy"}')
+	# Set from the app_server's web UI
+	if config.get('instructions'):
+		prompt += f"\n\nIMPORTANT INSTRUCTIONS:\n{config['instructions']}"
+	return prompt
+
+
+def resolve_image_path(char_dir: str, image_path: str) -> str:
+	"""
+    Image paths in config.json are relative to the project root.
+    Falls back to looking next to the config so a character folder can be moved.
+    """
+	if os.path.exists(image_path):
+		return image_path
+	return os.path.join(char_dir, os.path.basename(image_path))
+
+
+def scale_image(path: str, max_size=DISPLAY_IMAGE_SIZE) -> bytes:
+	"""Loads an image, scales it to fit within max_size and returns PNG bytes."""
+	with Image.open(path) as img:
+		img = img.convert("RGBA")
+		scale = min(max_size[0] / img.width, max_size[1] / img.height)
+		new_size = (int(img.width * scale), int(img.height * scale))
+		img = img.resize(new_size, Image.Resampling.LANCZOS)
+		buf = io.BytesIO()
+		img.save(buf, format="PNG")
+		return buf.getvalue()
+
+
+class Character:
+	"""A loaded character with its precomputed prompt, emotions and images."""
+
+	def __init__(self, key: str, config: Dict[str, Any], images: Dict[str, bytes],
+	             source_mtime: float):
+		self.key = key
+		self.config = config
+		# Pre-scaled PNG bytes, keyed like config['images']
+		self.images = images
+		self.source_mtime = source_mtime
+		self.emotions = [
+		    e for e in config.get('images', {}).keys()
+		    if e not in STATE_IMAGE_KEYS
+		]
+		self.system_prompt = build_system_prompt(config, self.emotions)
+
+	@property
+	def name(self) -> str:
+		return self.config.get('name', self.key)
+
+
+def referenced_images(char_dir: str) -> List[str] | None:
+	"""Paths of the images a character's config.json references; None if it can't be read."""
+	try:
+		with open(os.path.join(char_dir, "config.json"), 'r') as f:
+			config = json.load(f)
+	except (OSError, ValueError):
+		return None
+	return [
+	    resolve_image_path(char_dir, image_path)
+	    for image_path in config.get('images', {}).values()
+	]
+
+
+def source_mtime(char_dir: str, images: List[str] | None = None) -> float:
+	"""
+    Newest mtime of a character's config.json and the images it references.
+    Returns 0 if there is no config. Pass `images` (from referenced_images)
+    when the config is known not to have changed, to skip parsing it.
+    """
+	try:
+		newest = os.path.getmtime(os.path.join(char_dir, "config.json"))
+	except OSError:
+		return 0
+	if images is None:
+		images = referenced_images(char_dir)
+		if images is None:
+			return 0
+	for path in images:
+		try:
+			newest = max(newest, os.path.getmtime(path))
+		except OSError:
+			pass
+	return newest
+
+
+def load_character(key: str, char_dir: str, mtime: float) -> Character:
+	"""Parses config.json and pre-scales every image it references."""
+	with open(os.path.join(char_dir, "config.json"), 'r') as f:
+		config = json.load(f)
+	images = {}
+	for image_key, image_path in config.get('images', {}).items():
+		path = resolve_image_path(char_dir, image_path)
+		try:
+			images[image_key] = scale_image(path)
+		except Exception as e:
+			print(f"  - Could not load image '{image_key}' for '{key}': {e}")
+	return Character(key, config, images, mtime)
+
+
+# --- Packed format ---
+# PACK_MAGIC, a little-endian uint32 header length, a JSON header, then the
+# PNG bytes of every image back to back (offsets are listed in the header).
+
+
+def write_pack(character: Character, path: str):
+	"""Compiles a loaded character into a single packed file."""
+	offsets = {}
+	blobs = []
+	offset = 0
+	for image_key, data in character.images.items():
+		offsets[image_key] = [offset, len(data)]
+		blobs.append(data)
+		offset += len(data)
+	config = {k: v for k, v in character.config.items() if k != 'emotion'}
+	header = json.dumps({
+	    "config": config,
+	    "source_mtime": character.source_mtime,
+	    "images": offsets
+	}).encode('utf-8')
+	tmp_path = path + ".tmp"
+	with open(tmp_path, 'wb') as f:
+		f.write(PACK_MAGIC)
+		f.write(struct.pack('<I', len(header)))
+		f.write(header)
+		for data in blobs:
+			f.write(data)
+	os.replace(tmp_path, path)
+
+
+def read_pack(key: str, path: str, mtime: float) -> Character | None:
+	"""Loads a packed character, or returns None if it is missing or stale."""
+	try:
+		with open(path, 'rb') as f:
+			if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+				return None
+			(header_len,) = struct.unpack('<I', f.read(4))
+			header = json.loads(f.read(header_len))
+			if header.get("source_mtime") != mtime:
+				return None
+			body = f.read()
+	except (OSError, ValueError, struct.error):
+		return None
+	images = {
+	    image_key: body[start:start + length]
+	    for image_key, (start, length) in header["images"].items()
+	}
+	return Character(key, header["config"], images, mtime)
+
+
+class CharacterRegistry:
+	"""
+    Keeps the characters in a directory loaded, reloading only the ones whose
+    config or images changed (tracked by mtime). Thread-safe.
+    """
+
+	def __init__(self, characters_dir: str, use_packs: bool = True):
+		self.characters_dir = characters_dir
+		self.use_packs = use_packs
+		self.lock = threading.Lock()
+		self.characters: Dict[str, Character] = {}
+		# config.json mtime and image paths per character, so a poll only
+		# stats files and parses just the configs that changed
+		self._sources: Dict[str, Tuple[float, List[str]]] = {}
+		self._watcher: threading.Thread | None = None
+		self._stop_event = threading.Event()
+
+	def get(self, key: str) -> Character | None:
+		with self.lock:
+			return self.characters.get(key)
+
+	def keys(self) -> List[str]:
+		with self.lock:
+			return sorted(self.characters.keys())
+
+	def items(self):
+		with self.lock:
+			return sorted(self.characters.items())
+
+	def __contains__(self, key: str) -> bool:
+		with self.lock:
+			return key in self.characters
+
+	def __len__(self) -> int:
+		with self.lock:
+			return len(self.characters)
+
+	def _load(self, key: str, char_dir: str, mtime: float) -> Character:
+		pack_path = os.path.join(char_dir, PACK_FILENAME)
+		if self.use_packs:
+			character = read_pack(key, pack_path, mtime)
+			if character:
+				return character
+		character = load_character(key, char_dir, mtime)
+		if self.use_packs:
+			try:
+				write_pack(character, pack_path)
+			except OSError as e:
+				print(f"  - Could not write pack for '{key}': {e}")
+		return character
+
+	def _source_mtime(self, key: str, char_dir: str) -> float:
+		try:
+			config_mtime = os.path.getmtime(os.path.join(char_dir, "config.json"))
+		except OSError:
+			self._sources.pop(key, None)
+			return 0
+		cached = self._sources.get(key)
+		if cached and cached[0] == config_mtime:
+			return source_mtime(char_dir, cached[1])
+		images = referenced_images(char_dir)
+		if images is None:
+			return 0
+		self._sources[key] = (config_mtime, images)
+		return source_mtime(char_dir, images)
+
+	def refresh(self) -> List[str]:
+		"""Rescans the directory. Returns the keys that were added, changed or removed."""
+		if not os.path.isdir(self.characters_dir):
+			return []
+
+		found: Dict[str, float] = {}
+		for char_name in os.listdir(self.characters_dir):
+			char_dir = os.path.join(self.characters_dir, char_name)
+			if os.path.isdir(char_dir):
+				mtime = self._source_mtime(char_name, char_dir)
+				if mtime:
+					found[char_name] = mtime
+
+		with self.lock:
+			current = dict(self.characters)
+
+		changed = []
+		for char_name, mtime in found.items():
+			old = current.get(char_name)
+			if old and old.source_mtime == mtime:
+				continue
+			char_dir = os.path.join(self.characters_dir, char_name)
+			try:
+				character = self._load(char_name, char_dir, mtime)
+			except Exception as e:
+				print(f"Error loading character '{char_name}': {e}")
+				continue
+			# Add a runtime state for the character's current emotion
+			character.config['emotion'] = old.config.get(
+			    'emotion', 'neutral') if old else 'neutral'
+			with self.lock:
+				self.characters[char_name] = character
+			changed.append(char_name)
+			verb = "Reloaded" if old else "Loaded"
+			print(f"  - {verb} character: {character.name}")
+
+		for char_name in current:
+			if char_name not in found:
+				with self.lock:
+					self.characters.pop(char_name, None)
+				self._sources.pop(char_name, None)
+				changed.append(char_name)
+				print(f"  - Removed character: {char_name}")
+
+		return changed
+
+	def watch(self,
+	          interval: float = 2.0,
+	          on_change: Callable[[List[str]], None] | None = None):
+		"""Starts a background thread that polls for changes every `interval` seconds."""
+		if self._watcher and self._watcher.is_alive():
+			return
+
+		def run():
+			while not self._stop_event.wait(interval):
+				try:
+					changed = self.refresh()
+				except Exception as e:
+					print(f"Error refreshing characters: {e}")
+					continue
+				if changed and on_change:
+					on_change(changed)
+
+		self._stop_event.clear()
+		self._watcher = threading.Thread(target=run, daemon=True)
+		self._watcher.start()
+
+	def stop(self):
+		self._stop_event.set()
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(
+	    description="Compile every character into a packed file for fast loading.")
+	parser.add_argument("characters_dir",
+	                    nargs="?",
+	                    default="./data/characters",
+	                    help="Directory of character folders.")
+	args = parser.parse_args()
+
+	start = time.time()
+	registry = CharacterRegistry(args.characters_dir, use_packs=True)
+	registry.refresh()
+	print(f"Packed {len(registry)} characters in {time.time() - start:.2f}s")
@@ -0,0 +1,257 @@
+import json
+import queue
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import lib.llm as llm
+
+# Seconds from the end of recording to the start of reply audio
+DEFAULT_SLO = 6.0
+DEFAULT_STAGE_BUDGETS = {
+    'stt': 1.5,
+    'llm_first_token': 1.5,
+    'llm': 3.5,
+    'tts': 1.5,
+}
+# Kokoro speaks roughly this many characters per second at speed 1.0
+CHARS_PER_SECOND = 15.0
+
+
+class TurnBudget:
+	"""
+    Latency budgets for one turn. Stages check how much time they have left and
+    record any degradation they apply to stay within it, with a reason.
+    """
+
+	def __init__(self,
+	             slo: float = DEFAULT_SLO,
+	             stage_budgets: Dict[str, float] | None = None):
+		self.slo = slo
+		self.budgets = dict(DEFAULT_STAGE_BUDGETS, **(stage_budgets or {}))
+		self.start = time.time()
+		self.stage_times: Dict[str, float] = {}
+		self.degradations: List[Tuple[str, str, str]] = []
+
+	def elapsed(self) -> float:
+		return time.time() - self.start
+
+	def remaining(self) -> float:
+		return self.slo - self.elapsed()
+
+	def stage_budget(self, stage: str, reserve: float = 0.0) -> float:
+		"""The stage's own budget, or less if the turn as a whole is running late."""
+		return max(0.0, min(self.budgets[stage], self.remaining() - reserve))
+
+	def record(self, stage: str, seconds: float):
+		self.stage_times[stage] = seconds
+
+	def degrade(self, stage: str, action: str, reason: str):
+		self.degradations.append((stage, action, reason))
+		print(f"[Deadline] {stage}: {action} ({reason})")
+
+	def summary(self) -> str:
+		stages = ", ".join(f"{k} {v:.2f}s" for k, v in self.stage_times.items())
+		status = "OK" if self.elapsed() <= self.slo else "MISSED"
+		text = f"[Deadline] Turn {self.elapsed():.2f}s / SLO {self.slo:.1f}s {status} ({stages})"
+		if self.degradations:
+			text += f", {len(self.degradations)} degradation(s)"
+		return text
+
+
+class LatencyStats:
+	"""Moving averages of recent stage performance, used to plan the next turn."""
+
+	def __init__(self, alpha: float = 0.3):
+		self.alpha = alpha
+		self.first_token_latency: float | None = None
+		self.decode_tps: float | None = None
+		# TTS seconds of compute per second of audio
+		self.tts_rtf: float | None = None
+
+	def _ema(self, old: float | None, new: float) -> float:
+		return new if old is None else old + self.alpha * (new - old)
+
+	def record_llm(self, first_token_latency: float, n_tokens: int,
+	               decode_seconds: float):
+		self.first_token_latency = self._ema(self.first_token_latency,
+		                                     first_token_latency)
+		if n_tokens > 1 and decode_seconds > 0:
+			self.decode_tps = self._ema(self.decode_tps, n_tokens / decode_seconds)
+
+	def record_tts(self, synth_seconds: float, audio_seconds: float):
+		if audio_seconds > 0:
+			self.tts_rtf = self._ema(self.tts_rtf, synth_seconds / audio_seconds)
+
+	def token_cap(self, budget: float, default: int) -> int:
+		"""How many tokens fit in `budget` seconds, going by recent turns."""
+		if self.decode_tps is None or self.first_token_latency is None:
+			return default
+		decode_time = budget - self.first_token_latency
+		return max(16, min(default, int(decode_time * self.decode_tps)))
+
+	def expected_tts_seconds(self, text: str, speed: float) -> float:
+		if self.tts_rtf is None:
+			return 0.0
+		return self.tts_rtf * len(text) / (CHARS_PER_SECOND * speed)
+
+
+def first_sentences(text: str, max_chars: int) -> str:
+	"""Trims text to whole sentences within max_chars (at least one sentence)."""
+	sentences = re.findall(r"[^.!?]+[.!?]+", text)
+	if not sentences:
+		return text[:max_chars]
+	result = sentences[0]
+	for sentence in sentences[1:]:
+		if len(result) + len(sentence) > max_chars:
+			break
+		result += sentence
+	return result.strip()
+
+
+def salvage_reply(partial: str) -> Dict[str, Any] | None:
+	"""
+    Recovers the complete sentences of 'text' (and the emotion, if present)
+    from a JSON reply that was cut off mid-generation.
+    """
+	match = re.search(r'"text"\s*:\s*"((?:[^"\\]|\\.)*)', partial)
+	if not match:
+		return None
+	raw_text = match.group(1)
+	try:
+		text = json.loads(f'"{raw_text}"')
+	except ValueError:
+		text = raw_text.replace('\\"', '"')
+	last_end = max(text.rfind('.'), text.rfind('!'), text.rfind('?'))
+	if last_end < 0:
+		return None
+	emotion = re.search(r'"emotion"\s*:\s*"([^"]*)"', partial)
+	return {
+	    'text': text[:last_end + 1].strip(),
+	    'emotion': emotion.group(1) if emotion else None
+	}
+
+
+_DONE = object()
+
+
+def _pump(start_stream: Callable[[], Iterator[str]], chunks: queue.Queue,
+          stop: threading.Event):
+	"""Runs on a worker thread: forwards chunks until the stream ends or `stop` is set."""
+	try:
+		# Starting the stream can block too (e.g. a router waiting for a first chunk)
+		stream = start_stream()
+		try:
+			for chunk in stream:
+				if stop.is_set():
+					break
+				chunks.put(chunk)
+		finally:
+			# Stops llama.cpp from generating any further
+			stream.close()
+	except Exception as e:
+		chunks.put(e)
+	finally:
+		chunks.put(_DONE)
+
+
+def generate_reply(budget: TurnBudget,
+                   stats: LatencyStats,
+                   user_text: str,
+                   sys_input: str,
+                   history=None,
+                   max_tokens: int = 128,
+                   tts_reserve: float = 0.0,
+                   generate_stream=llm.generate_stream) -> Dict[str, Any] | None:
+	"""
+    Streams a JSON reply from the LLM within the turn's budget:
+
+    - max_tokens is capped up front if recent decode speed says it won't fit
+    - if the first token is late, the cap is lowered further
+    - if the LLM budget runs out, generation is stopped
+
+    The deadline also covers the time to the first token: the stream is read
+    on a worker thread, so a slow prefill or a model that never answers can't
+    hold up the turn. A reply cut short is salvaged to its complete sentences. Returns the parsed
+    reply, or None if nothing usable was produced in time. `generate_stream`
+    can be swapped for another source with the same signature (e.g. a router).
+    """
+	llm_budget = budget.stage_budget('llm', reserve=tts_reserve)
+	cap = stats.token_cap(llm_budget, max_tokens)
+	if cap < max_tokens:
+		budget.degrade('llm', f"max_tokens capped to {cap}",
+		               f"{stats.decode_tps:.1f} tok/s won't fit {llm_budget:.1f}s")
+
+	start = time.time()
+	first_token_at = None
+	parts = []
+	stopped = False
+	chunks: queue.Queue = queue.Queue()
+	stop = threading.Event()
+
+	def start_stream():
+		return generate_stream(user_text,
+		                       sys_input=sys_input,
+		                       json=True,
+		                       history=history,
+		                       max_tokens=cap)
+
+	threading.Thread(target=_pump, args=(start_stream, chunks, stop),
+	                 daemon=True).start()
+	try:
+		while True:
+			try:
+				chunk = chunks.get(timeout=max(0.0, llm_budget -
+				                               (time.time() - start)))
+			except queue.Empty:
+				stopped = True
+				budget.degrade('llm', "generation aborted",
+				               f"over the {llm_budget:.1f}s budget" +
+				               ("" if parts else " before the first token"))
+				break
+			if chunk is _DONE:
+				break
+			if isinstance(chunk, Exception):
+				raise chunk
+			now = time.time()
+			if first_token_at is None:
+				first_token_at = now
+				first_token_latency = now - start
+				if first_token_latency > budget.budgets['llm_first_token'] and stats.decode_tps:
+					# Slow prefill leaves less time for decoding
+					new_cap = max(
+					    16, int((llm_budget - first_token_latency) * stats.decode_tps))
+					if new_cap < cap:
+						cap = new_cap
+						budget.degrade(
+						    'llm', f"max_tokens lowered to {cap}",
+						    f"first token took {first_token_latency:.2f}s")
+			parts.append(chunk)
+			if len(parts) >= cap and salvage_reply("".join(parts)):
+				stopped = True
+				budget.degrade('llm', "stopped at token cap",
+				               f"{len(parts)} tokens")
+				break
+			if now - start > llm_budget:
+				stopped = True
+				budget.degrade('llm', "generation aborted",
+				               f"over the {llm_budget:.1f}s budget")
+				break
+	finally:
+		# The worker closes the stream (stopping llama.cpp) at its next chunk
+		stop.set()
+
+	elapsed = time.time() - start
+	budget.record('llm', elapsed)
+	if first_token_at is not None:
+		stats.record_llm(first_token_at - start, len(parts),
+		                 time.time() - first_token_at)
+
+	raw = "".join(parts)
+	if not stopped:
+		try:
+			return json.loads(raw)
+		except ValueError:
+			pass
+	return salvage_reply(raw)
@@ -0,0 +1,124 @@
+import random
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+import sounddevice as sd
+
+import lib.tts as tts
+
+# Short enough to finish before most replies are ready
+FILLER_LINES = [
+    "Hmm...",
+    "Let me think.",
+    "Ooh, good question.",
+    "Well...",
+    "Hmm, okay.",
+]
+
+
+class FillerBank:
+	"""
+    Short filler utterances ("hmm", "let me think...") synthesized ahead of
+    time per voice and kept in memory, to be played while a reply is pending.
+    """
+
+	def __init__(self, synthesize=tts.synthesize):
+		# Returns (audio, sample_rate), like router.synthesize
+		self.synthesize = synthesize
+		self.lock = threading.Lock()
+		self.banks: Dict[Tuple[str, float, Tuple[str, ...]],
+		                 List[Tuple[np.ndarray, int]]] = {}
+		self._last: Dict[Tuple[str, float, Tuple[str, ...]], int] = {}
+
+	@staticmethod
+	def _key(voice: str, speed: float, lines: List[str] | None):
+		return (voice, round(speed, 3), tuple(lines or FILLER_LINES))
+
+	def prepare(self, voice: str, speed: float, lines: List[str] | None = None):
+		"""Synthesizes the fillers for a voice, unless that was already done."""
+		key = self._key(voice, speed, lines)
+		with self.lock:
+			if key in self.banks:
+				return
+		start = time.time()
+		clips = [self.synthesize(line, voice=voice, speed=speed) for line in key[2]]
+		with self.lock:
+			self.banks[key] = [c for c in clips if len(c[0])]
+		print(
+		    f"[Fillers] Prepared {len(clips)} fillers for {voice} in {time.time() - start:.1f}s"
+		)
+
+	def prepare_in_background(self, characters: List[Dict], default_speed: float):
+		"""Prepares fillers for several character configs on a daemon thread."""
+
+		def run():
+			for config in characters:
+				try:
+					self.prepare(config.get('voice', 'af_heart'),
+					             config.get('speed', default_speed),
+					             config.get('fillers'))
+				except Exception as e:
+					print(f"[Fillers] Error preparing fillers: {e}")
+
+		threading.Thread(target=run, daemon=True).start()
+
+	def pick(self, voice: str, speed: float,
+	         lines: List[str] | None = None) -> Tuple[np.ndarray, int] | None:
+		"""A random filler (audio, sample_rate) for the voice, not the same as last time."""
+		key = self._key(voice, speed, lines)
+		with self.lock:
+			clips = self.banks.get(key)
+			if not clips:
+				return None
+			choices = [i for i in range(len(clips)) if i != self._last.get(key)]
+			index = random.choice(choices or [0])
+			self._last[key] = index
+			return clips[index]
+
+
+class FillerTimer:
+	"""
+    Plays one filler if the real reply audio isn't ready within `deadline`
+    seconds of start(). Call finish() right before playing the real audio; it
+    cancels the filler or waits for one that's already playing to end.
+    """
+
+	def __init__(self, bank: FillerBank, voice: str, speed: float,
+	             lines: List[str] | None, deadline: float):
+		self.bank = bank
+		self.voice = voice
+		self.speed = speed
+		self.lines = lines
+		self.deadline = deadline
+		self.lock = threading.Lock()
+		self.finished = False
+		self.ends_at = 0.0
+		self._timer: threading.Timer | None = None
+
+	def start(self):
+		self._timer = threading.Timer(self.deadline, self._play)
+		self._timer.daemon = True
+		self._timer.start()
+
+	def _play(self):
+		with self.lock:
+			if self.finished:
+				return
+			clip = self.bank.pick(self.voice, self.speed, self.lines)
+			if clip is None:
+				return
+			audio, sample_rate = clip
+			print("[Fillers] Reply is slow, playing a filler")
+			sd.play(audio, sample_rate)
+			self.ends_at = time.time() + len(audio) / sample_rate
+
+	def finish(self):
+		with self.lock:
+			self.finished = True
+			if self._timer:
+				self._timer.cancel()
+			remaining = self.ends_at - time.time()
+		if remaining > 0:
+			time.sleep(remaining)
@@ -0,0 +1,136 @@
+import threading
+import time
+from typing import Callable, Dict, List
+
+import lib.llm as llm
+
+SUMMARY_PROMPT = (
+    "Summarize this conversation between a user and an AI character in a few "
+    "sentences. Keep names, facts, running jokes and anything the character "
+    "promised. Reply with only the summary, on one line.")
+
+
+class ConversationHistory:
+	"""
+    Token-budgeted chat history.
+
+    The most recent turns are kept verbatim. Once they grow past max_tokens, the
+    oldest ones are folded into a running summary by a background thread, but
+    only while is_idle() is true so it never delays a live turn. Until then,
+    messages() simply leaves out whatever doesn't fit the budget.
+    """
+
+	def __init__(self,
+	             max_tokens: int = 1024,
+	             keep_recent: int = 6,
+	             summary_max_tokens: int = 160,
+	             generate: Callable[..., str] = llm.generate):
+		self.max_tokens = max_tokens
+		# Messages (not turns) that are never folded into the summary
+		self.keep_recent = keep_recent
+		self.summary_max_tokens = summary_max_tokens
+		# Called like llm.generate; e.g. through a StageRouter when the LLM is remote
+		self.generate = generate
+		self.lock = threading.Lock()
+		self.turns: List[Dict[str, str]] = []
+		self.summary = ""
+
+	def add(self, role: str, content: str):
+		with self.lock:
+			self.turns.append({'role': role, 'content': content})
+
+	def add_turn(self, user_text: str, assistant_text: str):
+		with self.lock:
+			self.turns.append({'role': 'user', 'content': user_text})
+			self.turns.append({'role': 'assistant', 'content': assistant_text})
+
+	def last_reply(self) -> str:
+		"""The most recent assistant message, or '' at the start of a conversation."""
+		with self.lock:
+			for turn in reversed(self.turns):
+				if turn['role'] == 'assistant':
+					return turn['content']
+		return ''
+
+	def clear(self):
+		with self.lock:
+			self.turns = []
+			self.summary = ""
+
+	def _turn_tokens(self, turns: List[Dict[str, str]]) -> int:
+		return sum(llm.count_tokens(t['content']) for t in turns)
+
+	def messages(self) -> List[Dict[str, str]]:
+		"""The most recent turns that fit in max_tokens, oldest first."""
+		with self.lock:
+			turns = list(self.turns)
+			summary = self.summary
+		budget = self.max_tokens - (llm.count_tokens(summary) if summary else 0)
+		selected = []
+		for turn in reversed(turns):
+			budget -= llm.count_tokens(turn['content'])
+			if budget < 0:
+				break
+			selected.append(turn)
+		selected.reverse()
+		# Chat templates expect the first non-system message to be from the user
+		while selected and selected[0]['role'] != 'user':
+			selected.pop(0)
+		return selected
+
+	def system_context(self) -> str:
+		"""Text to append to the system prompt, carrying the folded-away turns."""
+		with self.lock:
+			summary = self.summary
+		if not summary:
+			return ""
+		return f"\n\nSummary of the conversation so far:\n{summary}"
+
+	def needs_summary(self) -> bool:
+		with self.lock:
+			turns = list(self.turns)
+		return len(turns) > self.keep_recent and self._turn_tokens(
+		    turns) > self.max_tokens
+
+	def summarize(self):
+		"""Folds all but the most recent turns into the summary."""
+		with self.lock:
+			old_turns = self.turns[:-self.keep_recent]
+			summary = self.summary
+		if not old_turns:
+			return
+
+		transcript = "\n".join(f"{t['role']}: {t['content']}" for t in old_turns)
+		if summary:
+			transcript = f"Earlier summary: {summary}\n{transcript}"
+		start = time.time()
+		new_summary = self.generate(transcript,
+		                            sys_input=SUMMARY_PROMPT,
+		                            max_tokens=self.summary_max_tokens).strip()
+		print(
+		    f"[History] Folded {len(old_turns)} messages into summary in {time.time() - start:.1f}s"
+		)
+
+		with self.lock:
+			# Turns added meanwhile are after old_turns, so dropping the prefix is safe
+			# unless the history was cleared while we were summarizing
+			if self.turns[:len(old_turns)] == old_turns:
+				self.turns = self.turns[len(old_turns):]
+				self.summary = new_summary
+
+	def start_background_summarizer(self,
+	                                is_idle: Callable[[], bool],
+	                                interval: float = 1.0):
+		"""Starts a daemon thread that summarizes whenever idle and over budget."""
+
+		def run():
+			while True:
+				time.sleep(interval)
+				try:
+					if is_idle() and self.needs_summary():
+						self.summarize()
+				except Exception as e:
+					print(f"[History] Error summarizing: {e}")
+					time.sleep(30)  # Don't spin on a persistent error
+
+		threading.Thread(target=run, daemon=True).start()
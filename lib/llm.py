@@ -1,48 +1,422 @@
+import json
+import os
+import socket
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Callable, Dict
+import numpy as np
+import llama_cpp
 from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
 from openai.types.chat import ChatCompletion, ChatCompletionChunk
 import config as cfg
+from lib.models import manager
+from lib.threads import governor
 
-model: Llama
+model: Llama | None = None
+# Path and context size of the loaded model, for swap_model()
+model_path_loaded: str | None = None
+DEFAULT_N_CTX = 4096
+model_n_ctx = DEFAULT_N_CTX
+# Embedding-mode instance for long-term memory, created on first use: by
+# default the same GGUF (its mmapped weights share the page cache), or a small
+# dedicated embedding model. It runs on the CPU unless EMBED_GPU_LAYERS says
+# otherwise, so it doesn't take a second copy of the chat model's VRAM.
+EMBED_MODEL = getattr(cfg, 'EMBED_MODEL', None) or cfg.LANGUAGE_MODEL
+EMBED_GPU_LAYERS = getattr(cfg, 'EMBED_GPU_LAYERS', 0)
+# Longer input is truncated; a turn or summary fits comfortably
+EMBED_N_CTX = 2048
+embed_model: Llama | None = None
+embed_lock = threading.Lock()
+# Tokenizer-only instance (vocab_only skips the weights) for count_tokens()
+# while the model isn't loaded here, e.g. when the LLM runs on another node
+tokenizer: Llama | None = None
+# A Llama instance isn't thread-safe; background jobs (e.g. history
+# summarization) share it with the live turn. A plain Lock rather than an
+# RLock, as a streaming generator may be resumed from another thread.
+model_lock = threading.Lock()
 
+# Speculative decoding: None (off), 'prompt_lookup' (or 'prompt_lookup:N' to
+# draft N tokens), or the path to a small draft GGUF that shares the main
+# model's tokenizer (e.g. cfg.STORY_MODEL_2)
+DRAFT = getattr(cfg, 'LANGUAGE_MODEL_DRAFT', None)
+# Prompt lookup: 2 does better on CPU-only machines, where every rejected
+# draft token costs; with the model on a GPU, 'prompt_lookup:10' can be faster
+PROMPT_LOOKUP_TOKENS = 2
+DRAFT_MODEL_TOKENS = 6
 
-def init(model_path=cfg.LANGUAGE_MODEL):
-	global model
-	model = Llama(
+# Best llama.cpp settings per host and model, written by `python -m lib.autotune`
+PROFILE_FILE = "./data/llm_profiles.json"
+KV_CACHE_TYPES = {
+    'f16': llama_cpp.GGML_TYPE_F16,
+    'q8_0': llama_cpp.GGML_TYPE_Q8_0,
+    'q4_0': llama_cpp.GGML_TYPE_Q4_0
+}
+
+
+class LlamaSmallDraftModel(LlamaDraftModel):
+	"""
+    Drafts tokens by greedily decoding with a small model; the main model then
+    verifies the whole draft in one batch. Its KV cache is reused across calls
+    the same way the main model's is, by the longest common token prefix.
+    """
+
+	def __init__(self, model_path: str, num_pred_tokens=DRAFT_MODEL_TOKENS,
+	             n_ctx=4096):
+		n_threads = governor.threads('llm')
+		self.model = Llama(model_path,
+		                   n_gpu_layers=-1,
+		                   n_ctx=n_ctx,
+		                   n_threads=n_threads,
+		                   n_threads_batch=n_threads,
+		                   verbose=False)
+		self.num_pred_tokens = num_pred_tokens
+
+	def __call__(self, input_ids, /, **kwargs):
+		draft = []
+		for token in self.model.generate(input_ids.tolist(), temp=0.0):
+			draft.append(token)
+			if len(draft) >= self.num_pred_tokens or token == self.model.token_eos():
+				break
+		return np.array(draft, dtype=np.intc)
+
+	def close(self):
+		self.model.close()
+
+
+def load_draft_model(draft, n_ctx=4096) -> LlamaDraftModel | None:
+	if not draft:
+		return None
+	if draft == 'prompt_lookup' or draft.startswith('prompt_lookup:'):
+		_, _, n_tokens = draft.partition(':')
+		return LlamaPromptLookupDecoding(
+		    num_pred_tokens=int(n_tokens) if n_tokens else PROMPT_LOOKUP_TOKENS)
+	return LlamaSmallDraftModel(draft, n_ctx=n_ctx)
+
+
+# --- Tuning profiles ---
+def profile_key(model_path: str) -> str:
+	"""Profiles are per machine and per model file (a re-download counts as the same model)."""
+	return f"{socket.gethostname()}:{os.path.basename(model_path)}:{os.path.getsize(model_path)}"
+
+
+def load_profiles() -> Dict[str, Dict[str, Any]]:
+	try:
+		with open(PROFILE_FILE, 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+
+def load_profile(model_path: str) -> Dict[str, Any]:
+	"""The autotuned settings for this host and model, or {} if it hasn't been tuned here."""
+	try:
+		return load_profiles().get(profile_key(model_path), {})
+	except OSError:
+		return {}
+
+
+def save_profile(model_path: str, profile: Dict[str, Any]):
+	profiles = load_profiles()
+	profiles[profile_key(model_path)] = profile
+	os.makedirs(os.path.dirname(PROFILE_FILE), exist_ok=True)
+	tmp_path = PROFILE_FILE + ".tmp"
+	with open(tmp_path, 'w') as f:
+		json.dump(profiles, f, indent=2)
+	os.replace(tmp_path, PROFILE_FILE)
+
+
+def llama_params(profile: Dict[str, Any]) -> Dict[str, Any]:
+	"""Llama() arguments for a profile's n_batch, kv_cache and flash_attn."""
+	params = {}
+	if 'n_batch' in profile:
+		params['n_batch'] = params['n_ubatch'] = profile['n_batch']
+	if 'kv_cache' in profile:
+		params['type_k'] = params['type_v'] = KV_CACHE_TYPES[profile['kv_cache']]
+	if 'flash_attn' in profile:
+		params['flash_attn'] = profile['flash_attn']
+	return params
+
+
+def load_model(model_path: str,
+               n_ctx: int | None = None,
+               draft=DRAFT,
+               profile: Dict[str, Any] | None = None) -> Llama:
+	"""
+    Settings not given come from this host's autotune profile for the model
+    (see lib/autotune.py), else llama.cpp's defaults.
+    """
+	if profile is None:
+		profile = load_profile(model_path)
+		if profile:
+			print(f"[LLM] Using the autotuned settings for this machine: {profile}")
+	n_ctx = n_ctx or profile.get('n_ctx') or DEFAULT_N_CTX
+	draft_model = load_draft_model(draft, n_ctx)
+	# Every core while nothing else runs; the thread governor re-tunes it per turn
+	n_threads = profile.get('n_threads') or governor.threads('llm')
+	new_model = Llama(
 	    model_path,
 	    n_gpu_layers=-1,  # Uncomment to use GPU acceleration
 	    # seed=1337, # Uncomment to set a specific seed
-	    # n_ctx=2048, # Uncomment to increase the context window
-	    verbose=False)
+	    n_ctx=n_ctx,  # Room for the system prompt plus chat history
+	    n_threads=n_threads,
+	    n_threads_batch=n_threads,
+	    draft_model=draft_model,
+	    verbose=False,
+	    **llama_params(profile))
+	if isinstance(draft_model, LlamaSmallDraftModel
+	              ) and draft_model.model.n_vocab() != new_model.n_vocab():
+		print(f"[LLM] Draft model {draft} has a different vocabulary; not using it.")
+		draft_model.close()
+		new_model.draft_model = None
+	elif draft_model:
+		print(f"[LLM] Speculative decoding with {draft}")
+	return new_model
 
 
-def unload():
-	global model
-	if not model:
+def set_threads(target: Llama, n_threads: int):
+	"""Takes effect from the next decode call. The caller must own `target`."""
+	if not target.ctx:
 		return
-	model.close()
-	del model
+	llama_cpp.llama_set_n_threads(target.ctx, n_threads, n_threads)
+	target.n_threads = target.n_threads_batch = n_threads
+
+
+# Thread count from the governor that the model hasn't picked up yet
+pending_threads: int | None = None
+
+
+def _apply_pending_threads():
+	"""Called with model_lock held, so the model can't be closed or mid-decode."""
+	global pending_threads
+	n_threads, pending_threads = pending_threads, None
+	if n_threads is None or model is None:
+		return
+	set_threads(model, n_threads)
+	if isinstance(model.draft_model, LlamaSmallDraftModel):
+		set_threads(model.draft_model.model, n_threads)
+
+
+def _apply_threads(n_threads: int):
+	"""
+    Called by the governor from whichever thread changed the running stages.
+    An idle model is updated now; during a generation, the generating thread
+    picks the new count up between tokens.
+    """
+	global pending_threads
+	pending_threads = n_threads
+	if model_lock.acquire(blocking=False):
+		try:
+			_apply_pending_threads()
+		finally:
+			model_lock.release()
+
+
+def close_model(old_model: Llama):
+	if isinstance(old_model.draft_model, LlamaSmallDraftModel):
+		old_model.draft_model.close()
+	old_model.close()
+
+
+def _limit_threads(model_path: str):
+	# Decoding is memory-bound, so more threads than the tuned count only contend
+	governor.set_limit('llm', load_profile(model_path).get('n_threads'))
+
+
+def init(model_path=cfg.LANGUAGE_MODEL, n_ctx: int | None = None, draft=DRAFT):
+	global model, model_path_loaded, model_n_ctx
+	model = load_model(model_path, n_ctx, draft)
+	model_path_loaded = model_path
+	model_n_ctx = model.n_ctx()
+	_limit_threads(model_path)
+	with model_lock:
+		_reset_tokenizer()
+
+
+def _reload():
+	"""Loads the model again after the model manager unloaded it, keeping any swap."""
+	init(model_path_loaded or cfg.LANGUAGE_MODEL, model_n_ctx)
 
 
-def generate(input: str, sys_input='', json=False):
+def _unload_model():
 	global model
-	if not model:
-		init()
+	with model_lock:
+		# Unset before closing, so nothing picks up a model that's being freed
+		old_model, model = model, None
+		if old_model:
+			close_model(old_model)
 
+
+def _unload_embed():
+	global embed_model
+	with embed_lock:
+		if embed_model:
+			embed_model.close()
+			embed_model = None
+
+
+def unload():
+	_unload_embed()
+	_unload_model()
+	with model_lock:
+		_reset_tokenizer()
+
+
+# --- Hot-swap ---
+swap_lock = threading.Lock()
+swap_status = {'state': 'idle', 'loading_path': None, 'error': None}
+
+
+def swap_model(model_path: str,
+               n_ctx: int | None = None,
+               draft=DRAFT,
+               on_done: Callable[[bool, str | None], None] | None = None) -> bool:
+	"""
+    Loads `model_path` on a background thread while the current model keeps
+    serving, then swaps it in and closes the old one. Every generation holds
+    model_lock until it's done, so the swap waits for in-flight generations
+    and the next one starts on the new model. Both models are in memory while
+    the new one loads, so the model manager makes room for both first.
+
+    Returns False if a swap is already in progress. on_done(ok, error) is
+    called from the loading thread when the swap has finished or failed.
+    """
+	if not swap_lock.acquire(blocking=False):
+		return False
+	swap_status.update(state='loading', loading_path=model_path, error=None)
+
+	def run():
+		global model, model_path_loaded, model_n_ctx
+		error = None
+		try:
+			with manager.swapping('llm', os.path.getsize(model_path)) as loaded:
+				start = time.time()
+				# The new model's own profile decides n_ctx, unless one is given
+				new_model = load_model(model_path, n_ctx, draft)
+				loaded()
+				print(
+				    f"[LLM] Loaded {model_path} in {time.time() - start:.1f}s, swapping")
+				with model_lock:
+					old_model = model
+					model = new_model
+					model_path_loaded = model_path
+					model_n_ctx = new_model.n_ctx()
+					_limit_threads(model_path)
+					_reset_tokenizer()
+				if old_model:
+					close_model(old_model)
+			swap_status.update(state='idle', loading_path=None)
+		except Exception as e:
+			error = str(e)
+			print(f"[LLM] Failed to load {model_path}, keeping the current model: {e}")
+			swap_status.update(state='failed', error=error)
+		finally:
+			swap_lock.release()
+		if on_done:
+			on_done(error is None, error)
+
+	threading.Thread(target=run, daemon=True).start()
+	return True
+
+
+def model_info() -> Dict[str, Any]:
+	return {'model_path': model_path_loaded, 'n_ctx': model_n_ctx, **swap_status}
+
+
+def _load_embed(model_path=EMBED_MODEL):
+	global embed_model
+	with embed_lock:
+		if embed_model is None:
+			# The whole input goes through in one batch, so the batch sizes match n_ctx
+			embed_model = Llama(model_path,
+			                    n_gpu_layers=EMBED_GPU_LAYERS,
+			                    n_ctx=EMBED_N_CTX,
+			                    n_batch=EMBED_N_CTX,
+			                    n_ubatch=EMBED_N_CTX,
+			                    n_threads=governor.threads('llm'),
+			                    embedding=True,
+			                    verbose=False)
+
+
+def embed(text: str) -> np.ndarray:
+	"""
+    Returns a single embedding vector for `text` (mean-pooled if needed),
+    truncated to EMBED_N_CTX tokens.
+    """
+	with manager.use('embed'), embed_lock:
+		assert embed_model is not None
+		tokens = embed_model.tokenize(text.encode('utf-8'))
+		if len(tokens) > EMBED_N_CTX:
+			text = embed_model.detokenize(tokens[:EMBED_N_CTX - 1]).decode(
+			    'utf-8', errors='ignore')
+		vector = np.asarray(embed_model.embed(text, truncate=True),
+		                    dtype=np.float32)
+	if vector.ndim == 2:
+		# Models without a pooling layer return one vector per token
+		vector = vector.mean(axis=0)
+	return vector
+
+
+def _tokenizer() -> Llama:
+	"""The loaded model, else the vocab-only instance. Called with model_lock held."""
+	global tokenizer
+	if model is not None:
+		return model
+	if tokenizer is None:
+		tokenizer = Llama(model_path_loaded or cfg.LANGUAGE_MODEL,
+		                  vocab_only=True,
+		                  verbose=False)
+	return tokenizer
+
+
+def _reset_tokenizer():
+	"""After a model change. Called with model_lock held."""
+	global tokenizer
+	if tokenizer is not None:
+		tokenizer.close()
+		tokenizer = None
+	_count_tokens.cache_clear()
+
+
+@lru_cache(maxsize=4096)
+def _count_tokens(text: str) -> int:
+	with model_lock:
+		return len(_tokenizer().tokenize(text.encode('utf-8'), add_bos=False))
+
+
+def count_tokens(text: str) -> int:
+	"""
+    Counts tokens with the model's tokenizer. Results are cached. Doesn't need
+    the model loaded, so it won't load it just to count.
+    """
+	return _count_tokens(text)
+
+
+def build_messages(input: str, sys_input='', history=None):
+	"""Builds the chat messages: system prompt, prior turns, then the new input."""
 	messages = [{'role': 'user', 'content': input}]
+	if history:
+		messages = list(history) + messages
 	if sys_input:
 		msg = {'role': 'system', 'content': sys_input}
 		messages.insert(0, msg)
+	return messages
 
+
+def generate(input: str, sys_input='', json=False, history=None, max_tokens=128):
 	kwargs = {
-	    'messages': messages,
-	    'max_tokens': 128,
+	    'messages': build_messages(input, sys_input, history),
+	    'max_tokens': max_tokens,
 	    'stop': ["Q:", "\n"],
 	    'stream': False
 	}
 	if json:
 		kwargs['response_format'] = {'type': 'json_object'}
 
-	output = model.create_chat_completion_openai_v1(**kwargs)
+	with manager.use('llm'), model_lock, governor.stage('llm'):
+		_apply_pending_threads()
+		output = model.create_chat_completion_openai_v1(**kwargs)
 	assert isinstance(output, ChatCompletion)
 
 	output_str = output.choices[0].message.content
@@ -50,31 +424,44 @@ def generate(input: str, sys_input='', json=False):
 	return output_str
 
 
-def generate_stream(input: str, sys_input='', json=False):
+def generate_stream(input: str,
+                    sys_input='',
+                    json=False,
+                    history=None,
+                    max_tokens=256):
 	"""
     Generates a response from the language model as a stream of text chunks.
     """
-	global model
-	if not model:
-		init()
-
-	messages = [{'role': 'user', 'content': input}]
-	if sys_input:
-		msg = {'role': 'system', 'content': sys_input}
-		messages.insert(0, msg)
-
 	kwargs = {
-	    'messages': messages,
-	    'max_tokens': 256,  # Increased token limit for longer streaming
+	    'messages': build_messages(input, sys_input, history),
+	    'max_tokens': max_tokens,  # Higher default for longer streaming
 	    'stream': True
 	}
 	if json:
 		kwargs['response_format'] = {'type': 'json_object'}
 
-	stream = model.create_chat_completion_openai_v1(**kwargs)
+	with manager.use('llm'), model_lock, governor.stage('llm'):
+		_apply_pending_threads()
+		stream = model.create_chat_completion_openai_v1(**kwargs)
+
+		for chunk in stream:
+			# Another stage started or finished since the last token
+			_apply_pending_threads()
+			assert isinstance(chunk, ChatCompletionChunk)
+			content = chunk.choices[0].delta.content
+			if content:
+				yield content
+
 
-	for chunk in stream:
-		assert isinstance(chunk, ChatCompletionChunk)
-		content = chunk.choices[0].delta.content
-		if content:
-			yield content
+manager.register('llm',
+                 load=_reload,
+                 unload=_unload_model,
+                 is_loaded=lambda: model is not None,
+                 size_hint=lambda: os.path.getsize(model_path_loaded or cfg.
+                                                   LANGUAGE_MODEL))
+manager.register('embed',
+                 load=_load_embed,
+                 unload=_unload_embed,
+                 is_loaded=lambda: embed_model is not None,
+                 size_hint=lambda: os.path.getsize(EMBED_MODEL))
+governor.register('llm', apply=_apply_threads)
@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+import lib.llm as llm
+
+VECTORS_FILE = "memory.f32"
+TEXTS_FILE = "memory.jsonl"
+META_FILE = "memory.json"
+INITIAL_CAPACITY = 256
+
+
+class MemoryStore:
+	"""
+    Long-term memory for one character: every turn is embedded and kept in a
+    contiguous, normalized float32 matrix, memory-mapped from the character's
+    folder, so a cosine top-k search is a single matrix-vector product.
+
+    The embedder is pluggable; by default it's the language model's embedding mode.
+    """
+
+	def __init__(self,
+	             directory: str,
+	             embedder: Callable[[str], np.ndarray] = llm.embed):
+		self.directory = directory
+		self.embedder = embedder
+		self.lock = threading.Lock()
+		self.texts: List[str] = []
+		self.vectors: np.memmap | None = None
+		self.dim = 0
+		self.capacity = 0
+		self._load()
+
+	@property
+	def count(self) -> int:
+		return len(self.texts)
+
+	def _path(self, name: str) -> str:
+		return os.path.join(self.directory, name)
+
+	def _load(self):
+		try:
+			with open(self._path(META_FILE), 'r') as f:
+				meta = json.load(f)
+			with open(self._path(TEXTS_FILE), 'r', encoding='utf-8') as f:
+				texts = [json.loads(line)['text'] for line in f if line.strip()]
+		except (OSError, ValueError, KeyError):
+			return
+		self.dim = meta['dim']
+		self.capacity = meta['capacity']
+		self.vectors = np.memmap(self._path(VECTORS_FILE),
+		                         dtype=np.float32,
+		                         mode='r+',
+		                         shape=(self.capacity, self.dim))
+		# Texts are appended after their vector, so a crash can't leave a
+		# text without a vector (only the reverse, which is harmless)
+		self.texts = texts[:self.capacity]
+
+	def _save_meta(self):
+		tmp_path = self._path(META_FILE) + ".tmp"
+		with open(tmp_path, 'w') as f:
+			json.dump({'dim': self.dim, 'capacity': self.capacity}, f)
+		os.replace(tmp_path, self._path(META_FILE))
+
+	def _ensure_capacity(self, dim: int):
+		"""Creates or grows (doubling) the memory-mapped matrix."""
+		if self.vectors is not None and dim != self.dim:
+			print(
+			    f"[Memory] Embedding size changed ({self.dim} -> {dim}); starting over."
+			)
+			self.vectors = None
+			self.texts = []
+			self.capacity = 0
+			open(self._path(TEXTS_FILE), 'w').close()
+		if self.vectors is not None and self.count < self.capacity:
+			return
+
+		os.makedirs(self.directory, exist_ok=True)
+		new_capacity = max(INITIAL_CAPACITY, self.capacity * 2)
+		fresh = self.vectors is None
+		if self.vectors is not None:
+			self.vectors.flush()
+			self.vectors = None
+		# Rows are appended, so extending the file keeps existing rows in place
+		self.vectors = np.memmap(self._path(VECTORS_FILE),
+		                         dtype=np.float32,
+		                         mode='w+' if fresh else 'r+',
+		                         shape=(new_capacity, dim))
+		self.dim = dim
+		self.capacity = new_capacity
+		self._save_meta()
+
+	def _embed(self, text: str) -> np.ndarray:
+		vector = np.asarray(self.embedder(text), dtype=np.float32).reshape(-1)
+		norm = np.linalg.norm(vector)
+		return vector / norm if norm > 0 else vector
+
+	def add(self, text: str):
+		"""Embeds and stores a piece of conversation."""
+		vector = self._embed(text)
+		with self.lock:
+			self._ensure_capacity(len(vector))
+			assert self.vectors is not None
+			self.vectors[self.count] = vector
+			self.vectors.flush()
+			with open(self._path(TEXTS_FILE), 'a', encoding='utf-8') as f:
+				f.write(json.dumps({'text': text}) + "\n")
+			self.texts.append(text)
+
+	def search(self,
+	           query: str,
+	           k: int = 3,
+	           min_score: float = 0.3,
+	           exclude_last: int = 0) -> List[Tuple[float, str]]:
+		"""
+        Returns up to k (score, text) pairs most similar to `query`, best first.
+        exclude_last skips the newest entries (e.g. ones still in the chat history).
+        """
+		with self.lock:
+			n = self.count - exclude_last
+			if n <= 0 or self.vectors is None:
+				return []
+			matrix = self.vectors[:n]
+			texts = self.texts[:n]
+		query_vector = self._embed(query)
+		if len(query_vector) != matrix.shape[1]:
+			return []
+		scores = matrix @ query_vector
+		k = min(k, n)
+		top = np.argpartition(-scores, k - 1)[:k]
+		top = top[np.argsort(-scores[top])]
+		return [(float(scores[i]), texts[i]) for i in top
+		        if scores[i] >= min_score]
+
+	def clear(self):
+		with self.lock:
+			self.texts = []
+			self.vectors = None
+			self.dim = 0
+			self.capacity = 0
+			for name in (VECTORS_FILE, TEXTS_FILE, META_FILE):
+				if os.path.exists(self._path(name)):
+					os.remove(self._path(name))
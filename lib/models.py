@@ -0,0 +1,276 @@
+import contextlib
+import os
+import threading
+import time
+from typing import Any, Callable, Dict
+
+import config as cfg
+
+GB = 1024**3
+
+
+def resident_memory() -> int:
+	"""This process's resident memory in bytes (0 if it can't be read)."""
+	try:
+		import psutil
+		return psutil.Process().memory_info().rss
+	except ImportError:
+		pass
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError):
+		return 0
+
+
+def available_memory() -> int | None:
+	"""Memory the OS can still hand out, counting other processes (e.g. story_app)."""
+	try:
+		import psutil
+		return psutil.virtual_memory().available
+	except ImportError:
+		pass
+	try:
+		with open('/proc/meminfo') as f:
+			for line in f:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1]) * 1024
+	except (OSError, ValueError):
+		pass
+	return None
+
+
+class ManagedModel:
+
+	def __init__(self, name: str, load: Callable[[], None],
+	             unload: Callable[[], None], is_loaded: Callable[[], bool],
+	             size_hint: Callable[[], int] | None):
+		self.name = name
+		self.load = load
+		self.unload = unload
+		self.is_loaded = is_loaded
+		self.size_hint = size_hint
+		self.lock = threading.Lock()
+		self.users = 0
+		self.last_used = 0.0
+		# Measured as the change in resident memory when it was last loaded
+		self.resident_bytes = 0
+		self.loads = 0
+		self.unloads = 0
+		self.load_seconds = 0.0
+		self.unload_seconds = 0.0
+
+	def expected_bytes(self) -> int:
+		"""
+        The larger of the measured size and the hint; mmapped weights (GGUFs)
+        only show up in resident memory as they're paged in.
+        """
+		try:
+			hint = self.size_hint() if self.size_hint else 0
+		except OSError:
+			hint = 0
+		return max(self.resident_bytes, hint)
+
+
+class ModelManager:
+	"""
+    Keeps track of which models (LLM, STT, TTS, image...) are loaded in this
+    process and how much memory each takes. Code uses a model inside
+    `with manager.use(name):`, which loads it if needed; to make room within
+    `budget_bytes` (or what the OS has left), the least recently used models
+    that aren't in use are unloaded first. Models idle for `idle_timeout`
+    seconds are unloaded by a background thread, and reload on next use.
+    """
+
+	def __init__(self,
+	             budget_bytes: int | None = None,
+	             idle_timeout: float | None = None,
+	             check_interval: float = 10.0):
+		self.budget_bytes = budget_bytes
+		self.idle_timeout = idle_timeout
+		self.check_interval = check_interval
+		self.lock = threading.Lock()
+		self.models: Dict[str, ManagedModel] = {}
+		self.thread: threading.Thread | None = None
+
+	def register(self,
+	             name: str,
+	             load: Callable[[], None],
+	             unload: Callable[[], None],
+	             is_loaded: Callable[[], bool],
+	             size_hint: Callable[[], int] | None = None):
+		"""size_hint estimates the memory a model needs before it has been measured (e.g. its file size)."""
+		with self.lock:
+			self.models[name] = ManagedModel(name, load, unload, is_loaded,
+			                                 size_hint)
+		if self.idle_timeout and self.thread is None:
+			self.thread = threading.Thread(target=self._watch_idle, daemon=True)
+			self.thread.start()
+
+	def _resident_total(self, exclude: str = '') -> int:
+		return sum(m.expected_bytes() for m in self.models.values()
+		           if m.name != exclude and m.is_loaded())
+
+	def _make_room(self, entry: ManagedModel, needed: int | None = None):
+		"""Frees memory for `needed` bytes (default: the entry's expected size) next to the other models."""
+		if needed is None:
+			needed = entry.expected_bytes()
+		while True:
+			with self.lock:
+				over_budget = self.budget_bytes is not None and self._resident_total(
+				    entry.name) + needed > self.budget_bytes
+				available = available_memory()
+				low_memory = available is not None and needed > available
+				if not over_budget and not low_memory:
+					return
+				candidates = [
+				    m for m in self.models.values()
+				    if m is not entry and m.users == 0 and m.is_loaded()
+				]
+				if not candidates:
+					if over_budget:
+						print(
+						    f"[Models] Loading {entry.name} goes over the memory budget; nothing idle to unload"
+						)
+					return
+				victim = min(candidates, key=lambda m: m.last_used)
+			reason = "memory budget" if over_budget else "low system memory"
+			self._unload(victim, reason)
+
+	def _load(self, entry: ManagedModel):
+		self._make_room(entry)
+		before = resident_memory()
+		start = time.time()
+		entry.load()
+		entry.load_seconds = time.time() - start
+		entry.resident_bytes = max(0, resident_memory() - before)
+		entry.loads += 1
+		print(f"[Models] Loaded {entry.name} in {entry.load_seconds:.1f}s "
+		      f"({entry.resident_bytes / GB:.2f} GB)")
+
+	def _unload(self, entry: ManagedModel, reason: str):
+		with entry.lock:
+			# Might have been picked up again since it was chosen
+			if entry.users or not entry.is_loaded():
+				return
+			start = time.time()
+			entry.unload()
+			entry.unload_seconds = time.time() - start
+			entry.unloads += 1
+		print(f"[Models] Unloaded {entry.name} ({reason})")
+
+	@contextlib.contextmanager
+	def use(self, name: str):
+		"""Makes sure the model is loaded, and keeps it loaded until the block exits."""
+		entry = self.models[name]
+		with entry.lock:
+			entry.users += 1
+			try:
+				if not entry.is_loaded():
+					self._load(entry)
+			except BaseException:
+				entry.users -= 1
+				raise
+		try:
+			yield
+		finally:
+			with entry.lock:
+				entry.users -= 1
+				entry.last_used = time.time()
+
+	@contextlib.contextmanager
+	def swapping(self, name: str, new_bytes: int):
+		"""
+        Wraps replacing a model in place (e.g. swapping to another LLM), where
+        the old one keeps serving while the new one loads: makes room for
+        `new_bytes` next to the old one, keeps it from being unloaded
+        meanwhile, and yields a `loaded()` callback that the block calls once
+        the new model is in memory, to measure it.
+        """
+		entry = self.models[name]
+		with entry.lock:
+			entry.users += 1
+		try:
+			current = entry.expected_bytes() if entry.is_loaded() else 0
+			self._make_room(entry, current + new_bytes)
+			before = resident_memory()
+			start = time.time()
+			measured: Dict[str, float] = {}
+
+			def loaded():
+				measured['seconds'] = time.time() - start
+				measured['bytes'] = max(0, resident_memory() - before)
+
+			yield loaded
+			if measured:
+				entry.load_seconds = measured['seconds']
+				entry.resident_bytes = int(measured['bytes'])
+				entry.loads += 1
+				print(f"[Models] Swapped {entry.name} in {entry.load_seconds:.1f}s "
+				      f"({entry.resident_bytes / GB:.2f} GB)")
+		finally:
+			with entry.lock:
+				entry.users -= 1
+				entry.last_used = time.time()
+
+	def load(self, name: str):
+		"""Loads a model ahead of its first use (e.g. at startup)."""
+		with self.use(name):
+			pass
+
+	def unload(self, name: str, reason: str = "done"):
+		"""Unloads a model now, unless it's in use."""
+		self._unload(self.models[name], reason)
+
+	def unload_all(self):
+		for entry in list(self.models.values()):
+			self._unload(entry, "shutdown")
+
+	def _watch_idle(self):
+		assert self.idle_timeout is not None
+		while True:
+			time.sleep(self.check_interval)
+			now = time.time()
+			for entry in list(self.models.values()):
+				if entry.users == 0 and entry.is_loaded(
+				) and now - entry.last_used > self.idle_timeout:
+					try:
+						self._unload(entry, f"idle for {now - entry.last_used:.0f}s")
+					except Exception as e:
+						print(f"[Models] Error unloading {entry.name}: {e}")
+
+	def metrics(self) -> Dict[str, Any]:
+		now = time.time()
+		models = {
+		    m.name: {
+		        'loaded': m.is_loaded(),
+		        'in_use': m.users,
+		        'resident_gb': round(m.resident_bytes / GB, 3),
+		        'idle_s': round(now - m.last_used, 1) if m.last_used else None,
+		        'loads': m.loads,
+		        'unloads': m.unloads,
+		        'last_load_s': round(m.load_seconds, 2),
+		        'last_unload_s': round(m.unload_seconds, 2),
+		    }
+		    for m in self.models.values()
+		}
+		available = available_memory()
+		return {
+		    'budget_gb': self.budget_bytes / GB if self.budget_bytes else None,
+		    'resident_gb': round(self._resident_total() / GB, 3),
+		    'available_gb': round(available / GB, 2) if available else None,
+		    'idle_timeout_s': self.idle_timeout,
+		    'models': models
+		}
+
+
+def file_size(path: str) -> Callable[[], int]:
+	"""A size_hint for models loaded from a single file, like GGUFs."""
+	return lambda: os.path.getsize(path)
+
+
+_budget_gb = getattr(cfg, 'MODEL_MEMORY_BUDGET_GB', None)
+# Shared by lib.llm, lib.stt, lib.tts and the background image generator
+manager = ModelManager(
+    budget_bytes=int(_budget_gb * GB) if _budget_gb else None,
+    idle_timeout=getattr(cfg, 'MODEL_IDLE_UNLOAD_S', None))
@@ -0,0 +1,273 @@
+import io
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+import soundfile as sf
+
+import config as cfg
+
+STAGES = ['stt', 'llm', 'tts']
+HEALTH_INTERVAL = 5.0
+# An unhealthy node is retried after this long even without a health check
+RETRY_AFTER = 30.0
+
+
+class StageUnavailable(Exception):
+	pass
+
+
+class LocalBackend:
+	"""Runs a stage in this process with lib.stt / lib.llm / lib.tts, which load on use."""
+
+	def __init__(self, stage: str):
+		self.stage = stage
+		self.name = f"local:{stage}"
+
+	def healthy(self) -> bool:
+		return True
+
+	def _module(self):
+		if self.stage == 'stt':
+			import lib.stt as module
+		elif self.stage == 'llm':
+			import lib.llm as module
+		else:
+			import lib.tts as module
+		return module
+
+	def transcribe(self, audio_path: str) -> str:
+		return self._module().transcribe(audio_path)
+
+	def generate_stream(self, input: str, **kwargs) -> Iterator[str]:
+		return self._module().generate_stream(input, **kwargs)
+
+	def synthesize(self, text: str, voice: str,
+	               speed: float) -> Tuple[np.ndarray, int]:
+		return self._module().synthesize(text, voice=voice, speed=speed)
+
+	def tts_engine(self) -> Tuple[str, int] | None:
+		import lib.tts as tts
+		# Unknown until the engine has loaded
+		return (tts.model.name, tts.SAMPLE_RATE) if tts.model else None
+
+
+class RemoteBackend:
+	"""
+    Runs a stage on another machine's main_api.py, over a pooled keep-alive
+    session. A failed request marks the node unhealthy until a health check
+    (or RETRY_AFTER) says otherwise.
+    """
+
+	def __init__(self, stage: str, url: str, timeout: float = 30.0):
+		self.stage = stage
+		self.url = url.rstrip('/')
+		self.name = f"{self.url}:{stage}"
+		self.timeout = timeout
+		self.session = requests.Session()
+		self.session.mount('http://', HTTPAdapter(pool_maxsize=4))
+		self.session.mount('https://', HTTPAdapter(pool_maxsize=4))
+		self.is_healthy = True
+		self.failed_at = 0.0
+		# The node's TTS engine and sample rate, from its last health check
+		self.engine: Tuple[str, int] | None = None
+
+	def healthy(self) -> bool:
+		if not self.is_healthy and time.time() - self.failed_at > RETRY_AFTER:
+			self.is_healthy = True
+		return self.is_healthy
+
+	def mark_failed(self, error: Exception):
+		if self.is_healthy:
+			print(f"[Router] {self.name} failed: {error}")
+		self.is_healthy = False
+		self.failed_at = time.time()
+
+	def check_health(self):
+		try:
+			response = self.session.get(f"{self.url}/health", timeout=2.0)
+			response.raise_for_status()
+			health = response.json()
+			ok = self.stage in health.get('stages', [])
+			tts_info = health.get('tts')
+			self.engine = (tts_info['engine'],
+			               tts_info['sample_rate']) if tts_info else None
+		except (requests.RequestException, ValueError, KeyError):
+			ok = False
+		if ok != self.is_healthy:
+			print(f"[Router] {self.name} is {'up' if ok else 'down'}")
+		self.is_healthy = ok
+		if not ok:
+			self.failed_at = time.time()
+
+	def transcribe(self, audio_path: str) -> str:
+		with open(audio_path, 'rb') as f:
+			response = self.session.post(f"{self.url}/stt",
+			                             files={'audio_file': f},
+			                             timeout=self.timeout)
+		response.raise_for_status()
+		return response.json()['text']
+
+	def generate_stream(self,
+	                    input: str,
+	                    sys_input='',
+	                    json=False,
+	                    history=None,
+	                    max_tokens=256) -> Iterator[str]:
+		response = self.session.post(f"{self.url}/llm",
+		                             json={
+		                                 'prompt': input,
+		                                 'system_prompt': sys_input,
+		                                 'json_mode': json,
+		                                 'history': history,
+		                                 'max_tokens': max_tokens
+		                             },
+		                             stream=True,
+		                             timeout=self.timeout)
+		response.raise_for_status()
+		try:
+			for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+				if chunk:
+					yield chunk
+		finally:
+			# Closing early tells the node the client is gone, so it stops generating
+			response.close()
+
+	def synthesize(self, text: str, voice: str,
+	               speed: float) -> Tuple[np.ndarray, int]:
+		response = self.session.post(f"{self.url}/tts",
+		                             json={
+		                                 'text': text,
+		                                 'voice': voice,
+		                                 'speed': speed,
+		                                 'format': 'wav'
+		                             },
+		                             timeout=self.timeout)
+		response.raise_for_status()
+		# The node's engine decides the rate, so take it from the WAV header
+		audio, sample_rate = sf.read(io.BytesIO(response.content), dtype='float32')
+		return audio, sample_rate
+
+	def tts_engine(self) -> Tuple[str, int] | None:
+		return self.engine
+
+
+class StageRouter:
+	"""
+    Sends each stage (stt, llm, tts) to the first healthy backend configured for
+    it: remote nodes in order, then this process as the fallback. A request that
+    fails on a node is retried on the next backend, unless output was already
+    streamed.
+
+    `nodes` maps a stage to a list of main_api.py base URLs, e.g.
+    {'stt': ['http://laptop2:8001'], 'tts': ['http://laptop2:8001']}.
+    """
+
+	def __init__(self,
+	             nodes: Dict[str, List[str]] | None = None,
+	             local_fallback: bool = True):
+		nodes = nodes or {}
+		self.backends: Dict[str, List[Any]] = {}
+		for stage in STAGES:
+			backends: List[Any] = [RemoteBackend(stage, url) for url in nodes.get(stage, [])]
+			if local_fallback or not backends:
+				backends.append(LocalBackend(stage))
+			self.backends[stage] = backends
+		self.stopped = threading.Event()
+		self.thread: threading.Thread | None = None
+
+	def is_remote(self, stage: str) -> bool:
+		return isinstance(self.backends[stage][0], RemoteBackend)
+
+	def start_health_checks(self, interval: float = HEALTH_INTERVAL):
+		remotes = [b for bs in self.backends.values() for b in bs
+		           if isinstance(b, RemoteBackend)]
+		if not remotes:
+			return
+
+		def run():
+			while not self.stopped.wait(interval):
+				for backend in remotes:
+					backend.check_health()
+
+		self.thread = threading.Thread(target=run, daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+
+	def status(self) -> Dict[str, List[Dict[str, Any]]]:
+		return {
+		    stage: [{
+		        'backend': b.name,
+		        'healthy': b.healthy()
+		    } for b in backends]
+		    for stage, backends in self.backends.items()
+		}
+
+	def tts_engine(self) -> Tuple[str, int] | None:
+		"""Engine name and sample rate of the backend synthesize() would use now, if known."""
+		for backend in self.backends['tts']:
+			if backend.healthy():
+				return backend.tts_engine()
+		return None
+
+	def _call(self, stage: str, method: str, *args, **kwargs):
+		errors = []
+		for backend in self.backends[stage]:
+			if not backend.healthy():
+				continue
+			try:
+				return getattr(backend, method)(*args, **kwargs)
+			except Exception as e:
+				errors.append(f"{backend.name}: {e}")
+				if isinstance(backend, RemoteBackend):
+					backend.mark_failed(e)
+					continue
+				raise
+		raise StageUnavailable(f"No backend for {stage}: {'; '.join(errors)}")
+
+	def transcribe(self, audio_path: str) -> str:
+		return self._call('stt', 'transcribe', audio_path)
+
+	def synthesize(self,
+	               text: str,
+	               voice='af_heart',
+	               speed=1.2) -> Tuple[np.ndarray, int]:
+		"""Returns (audio, sample_rate); the rate depends on the backend's engine."""
+		return self._call('tts', 'synthesize', text, voice, speed)
+
+	def generate_stream(self, input: str, **kwargs) -> Iterator[str]:
+		"""Like llm.generate_stream; fails over only until the first chunk is out."""
+		errors = []
+		for backend in self.backends['llm']:
+			if not backend.healthy():
+				continue
+			stream = backend.generate_stream(input, **kwargs)
+			try:
+				first = next(stream, None)
+			except Exception as e:
+				errors.append(f"{backend.name}: {e}")
+				if isinstance(backend, RemoteBackend):
+					backend.mark_failed(e)
+					continue
+				raise
+			return self._continue(stream, first)
+		raise StageUnavailable(f"No backend for llm: {'; '.join(errors)}")
+
+	@staticmethod
+	def _continue(stream: Iterator[str], first: str | None) -> Iterator[str]:
+		try:
+			if first is not None:
+				yield first
+			yield from stream
+		finally:
+			stream.close()
+
+
+def from_config() -> StageRouter:
+	"""A router for the nodes in config.STAGE_NODES (everything local if unset)."""
+	return StageRouter(getattr(cfg, 'STAGE_NODES', {}))
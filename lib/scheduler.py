@@ -0,0 +1,193 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Tuple
+
+import lib.llm as llm
+
+PRIORITY_HIGH = 0  # Live conversation turns
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2  # Background work, e.g. summaries
+
+_DONE = object()
+
+
+class DeadlineExceeded(Exception):
+	pass
+
+
+class LLMJob:
+	"""
+    One queued generation. Iterate it with `async for` to receive the text
+    chunks; cancel() stops it whether it's still queued or already running.
+    """
+
+	def __init__(self, kwargs: Dict[str, Any], priority: int,
+	             deadline: float | None, loop: asyncio.AbstractEventLoop):
+		self.kwargs = kwargs
+		self.priority = priority
+		self.deadline = deadline
+		self.loop = loop
+		self.chunks: asyncio.Queue = asyncio.Queue()
+		self.cancelled = threading.Event()
+		self.submitted_at = time.time()
+		self.started_at: float | None = None
+
+	def cancel(self):
+		self.cancelled.set()
+
+	def expired(self) -> bool:
+		return self.deadline is not None and time.time() > self.deadline
+
+	def _put(self, item):
+		"""Hands an item to the event loop; called from the scheduler thread."""
+		try:
+			self.loop.call_soon_threadsafe(self.chunks.put_nowait, item)
+		except RuntimeError:
+			# The event loop is gone, so nobody is listening anymore
+			self.cancel()
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self) -> str:
+		item = await self.chunks.get()
+		if item is _DONE:
+			raise StopAsyncIteration
+		if isinstance(item, Exception):
+			raise item
+		return item
+
+
+class LLMScheduler:
+	"""
+    Owns the language model on a dedicated thread and runs one generation at a
+    time, highest priority first (then earliest deadline, then arrival order).
+
+    A job whose deadline passes while it's queued fails with DeadlineExceeded;
+    one that's running is cut off at the deadline. Cancelled jobs (e.g. the
+    client disconnected) are skipped, or stopped at the next chunk.
+    """
+
+	def __init__(self, history_size: int = 100):
+		self.cond = threading.Condition()
+		self.heap: List[Tuple[int, float, int, LLMJob]] = []
+		self.counter = itertools.count()
+		self.running: LLMJob | None = None
+		self.thread: threading.Thread | None = None
+		self.stopped = False
+		self.waits: deque = deque(maxlen=history_size)
+		self.counts = {'completed': 0, 'cancelled': 0, 'expired': 0, 'failed': 0}
+
+	def start(self):
+		self.stopped = False
+		self.thread = threading.Thread(target=self._run, daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		with self.cond:
+			self.stopped = True
+			self.cond.notify_all()
+		if self.running:
+			self.running.cancel()
+		if self.thread:
+			self.thread.join(timeout=5)
+
+	def submit(self,
+	           prompt: str,
+	           sys_input='',
+	           json=False,
+	           history=None,
+	           max_tokens=256,
+	           priority=PRIORITY_NORMAL,
+	           timeout: float | None = None) -> LLMJob:
+		"""
+        Queues a generation; must be called from the event loop. `timeout` is
+        the deadline in seconds from now for the whole job, queueing included.
+        """
+		kwargs = {
+		    'input': prompt,
+		    'sys_input': sys_input,
+		    'json': json,
+		    'history': history,
+		    'max_tokens': max_tokens
+		}
+		deadline = time.time() + timeout if timeout is not None else None
+		job = LLMJob(kwargs, priority, deadline, asyncio.get_running_loop())
+		with self.cond:
+			heapq.heappush(self.heap, (priority, deadline or float('inf'),
+			                           next(self.counter), job))
+			self.cond.notify()
+		return job
+
+	def metrics(self) -> Dict[str, Any]:
+		with self.cond:
+			queued = [job for *_, job in self.heap if not job.cancelled.is_set()]
+			waits = list(self.waits)
+			running = self.running
+		now = time.time()
+		return {
+		    'queue_depth': len(queued),
+		    'running': running is not None,
+		    'oldest_wait_s': max((now - j.submitted_at for j in queued), default=0.0),
+		    'avg_wait_s': sum(waits) / len(waits) if waits else 0.0,
+		    'max_wait_s': max(waits, default=0.0),
+		    **self.counts
+		}
+
+	def _next_job(self) -> LLMJob | None:
+		with self.cond:
+			while not self.heap and not self.stopped:
+				self.cond.wait()
+			if self.stopped:
+				return None
+			*_, job = heapq.heappop(self.heap)
+			self.running = job
+			return job
+
+	def _run(self):
+		while True:
+			job = self._next_job()
+			if job is None:
+				return
+			try:
+				self._generate(job)
+			finally:
+				with self.cond:
+					self.running = None
+
+	def _generate(self, job: LLMJob):
+		if job.cancelled.is_set():
+			self.counts['cancelled'] += 1
+			return
+		if job.expired():
+			self.counts['expired'] += 1
+			job._put(DeadlineExceeded("Deadline passed while queued"))
+			return
+
+		job.started_at = time.time()
+		self.waits.append(job.started_at - job.submitted_at)
+		stream = llm.generate_stream(**job.kwargs)
+		try:
+			for chunk in stream:
+				if job.cancelled.is_set():
+					self.counts['cancelled'] += 1
+					print("[Scheduler] Client went away, stopped generating")
+					return
+				job._put(chunk)
+				if job.expired():
+					self.counts['expired'] += 1
+					print("[Scheduler] Deadline reached, stopped generating")
+					return
+			self.counts['completed'] += 1
+		except Exception as e:
+			self.counts['failed'] += 1
+			print(f"[Scheduler] Generation error: {e}")
+			job._put(e)
+		finally:
+			# Releases the model lock and stops llama.cpp right away
+			stream.close()
+			job._put(_DONE)
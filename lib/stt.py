@@ -1,96 +1,363 @@
-# adapted from https://github.com/Blaizzy/mlx-audio/blob/main/mlx_audio/stt/generate.py
+# MLX engine adapted from https://github.com/Blaizzy/mlx-audio/blob/main/mlx_audio/stt/generate.py
+"""
+Speech-to-text with interchangeable engines, all behind one transcribe():
+
+- mlx: mlx_audio's Whisper, for Apple Silicon
+- whispercpp: whisper.cpp via pywhispercpp, fast on plain CPUs
+- faster_whisper: CTranslate2 Whisper on CPU (int8)
+
+Each engine's package is only imported when that engine is used. Run
+`python -m lib.stt --benchmark clip.wav --reference "what was said"` to find the
+fastest engine/model that's accurate enough on this machine; with
+STT_ENGINE = 'auto' (the default) the result is used from then on.
+"""
+import json
+import os
+import platform
+import re
+import contextlib
+import time
+from typing import Any, Dict, List, Type
+
+import numpy as np
+import soundfile as sf
 
-from typing import Any
 import config as cfg
-import os, time
-import mlx.core as mx
-from mlx_audio.stt.utils import get_model_and_args
-from mlx_audio.stt.generate import save_as_json, save_as_srt, save_as_txt, save_as_vtt
-
-model: Any
-
-
-def load_model(model_path: str,
-               lazy: bool = False,
-               strict: bool = True,
-               **kwargs):
-	model_name = None
-	model_type = 'whisper'
-	if isinstance(model_path, str):
-		model_name = model_path.lower().split("/")[-1].split("-")
-	elif isinstance(model_path, Path):
-		index = model_path.parts.index("hub")
-		model_name = model_path.parts[index + 1].lower().split("--")[-1].split("-")
-	else:
-		raise ValueError(f"Invalid model path type: {type(model_path)}")
+from lib.audio import SAMPLE_RATE, resample
+from lib.models import manager
+from lib.threads import governor
+
+PROFILE_FILE = "./data/stt_profile.json"
+DEFAULT_THREADS = max(1, (os.cpu_count() or 2) // 2)
+
+
+class STTEngine:
+	"""Base class for engines; `model` is a model name or path the engine understands."""
+	name = ""
+	# Engines on the GPU don't take a share of the CPU cores from the other stages
+	uses_cpu = True
+
+	def __init__(self, model: str, threads: int = DEFAULT_THREADS):
+		self.model = model
+		self.threads = threads
+
+	@classmethod
+	def available(cls) -> bool:
+		raise NotImplementedError
+
+	def load(self):
+		raise NotImplementedError
+
+	def transcribe(self, audio: np.ndarray) -> str:
+		"""Transcribes mono float32 audio at SAMPLE_RATE."""
+		raise NotImplementedError
+
+	def unload(self):
+		pass
+
+
+class MLXEngine(STTEngine):
+	name = "mlx"
+	uses_cpu = False
+
+	@classmethod
+	def available(cls) -> bool:
+		try:
+			import mlx.core
+			import mlx_audio
+			return True
+		except ImportError:
+			return False
+
+	def load(self):
+		import mlx.core as mx
+		from mlx_audio.stt.utils import get_model_and_args
+
+		model_name = self.model.lower().split("/")[-1].split("-")
+		model_class, _ = get_model_and_args(model_type='whisper',
+		                                    model_name=model_name)
+		self.whisper = model_class.Model.from_pretrained(self.model)
+		self.whisper.eval()
+		mx.reset_peak_memory()
+
+	def transcribe(self, audio: np.ndarray) -> str:
+		return self.whisper.generate(audio).text
+
+	def unload(self):
+		self.whisper = None
+
+
+class WhisperCppEngine(STTEngine):
+	name = "whispercpp"
+
+	@classmethod
+	def available(cls) -> bool:
+		try:
+			import pywhispercpp
+			return True
+		except ImportError:
+			return False
+
+	def load(self):
+		from pywhispercpp.model import Model
+
+		# Model names like 'base.en' are downloaded on first use
+		self.whisper = Model(self.model,
+		                     n_threads=self.threads,
+		                     print_realtime=False,
+		                     print_progress=False)
+
+	def transcribe(self, audio: np.ndarray) -> str:
+		# Follows self.threads, which the thread governor adjusts between calls
+		segments = self.whisper.transcribe(audio, n_threads=self.threads)
+		return " ".join(segment.text.strip() for segment in segments)
+
+	def unload(self):
+		self.whisper = None
+
 
-	model_class, model_type = get_model_and_args(model_type=model_type,
-	                                             model_name=model_name)
-	model = model_class.Model.from_pretrained(model_path)
+class FasterWhisperEngine(STTEngine):
+	name = "faster_whisper"
 
-	if not lazy:
-		model.eval()
+	@classmethod
+	def available(cls) -> bool:
+		try:
+			import faster_whisper
+			return True
+		except ImportError:
+			return False
 
-	return model
+	def load(self):
+		from faster_whisper import WhisperModel
 
+		self.whisper = WhisperModel(self.model,
+		                            device="cpu",
+		                            compute_type="int8",
+		                            cpu_threads=self.threads)
 
-def init(model_path: str = cfg.WHISPER_MODEL):
+	def transcribe(self, audio: np.ndarray) -> str:
+		segments, _ = self.whisper.transcribe(audio, beam_size=1)
+		return " ".join(segment.text.strip() for segment in segments)
+
+	def unload(self):
+		self.whisper = None
+
+
+ENGINES: Dict[str, Type[STTEngine]] = {
+    engine.name: engine
+    for engine in [MLXEngine, WhisperCppEngine, FasterWhisperEngine]
+}
+
+model: STTEngine | None = None
+
+
+def load_audio(audio_path: str) -> np.ndarray:
+	"""Reads an audio file as mono float32 at SAMPLE_RATE."""
+	audio, rate = sf.read(audio_path, dtype='float32', always_2d=True)
+	audio = audio.mean(axis=1, keepdims=True)
+	return resample(audio, rate, SAMPLE_RATE).reshape(-1)
+
+
+def load_profile() -> Dict[str, Any] | None:
+	try:
+		with open(PROFILE_FILE, 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+
+def default_engine() -> str:
+	"""MLX on Apple Silicon, otherwise the first CPU engine that's installed."""
+	preference = ['whispercpp', 'faster_whisper']
+	if platform.system() == 'Darwin' and platform.machine() == 'arm64':
+		preference.insert(0, 'mlx')
+	for name in preference:
+		if ENGINES[name].available():
+			return name
+	raise RuntimeError(
+	    "No STT engine installed; pip install pywhispercpp or faster-whisper")
+
+
+def create_engine(engine_name: str | None = None,
+                  model_path: str | None = None,
+                  threads: int | None = None) -> STTEngine:
+	"""
+    Builds (without loading) an engine. Anything not given comes from config,
+    then from the benchmark profile when STT_ENGINE is 'auto'.
+    """
+	engine_name = engine_name or getattr(cfg, 'STT_ENGINE', 'auto')
+	threads = threads or getattr(cfg, 'STT_THREADS', None)
+	if engine_name == 'auto':
+		profile = load_profile()
+		if profile and profile.get('engine') in ENGINES and ENGINES[
+		    profile['engine']].available() and not model_path:
+			engine_name = profile['engine']
+			model_path = profile['model']
+			threads = threads or profile.get('threads')
+		else:
+			engine_name = default_engine()
+	if engine_name not in ENGINES:
+		raise ValueError(f"Unknown STT engine: {engine_name}")
+	return ENGINES[engine_name](model_path or cfg.WHISPER_MODEL, threads or
+	                            governor.threads('stt'))
+
+
+def init(model_path: str | None = None, engine_name: str | None = None):
 	global model
-	model = load_model(model_path)
-	print(f"\n\033[94mModel:\033[0m {model_path}")
-	mx.reset_peak_memory()
+	model = create_engine(engine_name, model_path)
+	model.load()
+	print(
+	    f"\n\033[94mSTT:\033[0m {model.name} {model.model} ({model.threads} threads)"
+	)
 
 
 def unload():
 	global model
 	if not model:
 		return
-	del model
+	model.unload()
+	model = None
 
 
-def generate(
-    audio_path: str,
-    output_path: str = '',
-    format: str = "txt",
-    verbose: bool = True,
-):
-	global model
-	if not model:
-		init()
+def _apply_threads(n_threads: int):
+	# Only whisper.cpp picks this up per call; the others keep their load-time count
+	if model is not None and not getattr(cfg, 'STT_THREADS', None):
+		model.threads = n_threads
 
-	print(f"\033[94mAudio path:\033[0m {audio_path}")
-	if output_path:
-		print(f"\033[94mOutput path:\033[0m {output_path}")
-	print(f"\033[94mFormat:\033[0m {format}")
-	mx.reset_peak_memory()
-	start_time = time.time()
-	segments = model.generate(audio_path)
-	end_time = time.time()
 
+manager.register('stt',
+                 load=init,
+                 unload=unload,
+                 is_loaded=lambda: model is not None)
+governor.register('stt', apply=_apply_threads)
+
+
+def transcribe(audio_path: str, verbose: bool = False) -> str:
+	"""Transcribes an audio file with the loaded engine."""
+	audio = load_audio(audio_path)
+	with manager.use('stt'):
+		assert model is not None
+		with governor.stage('stt') if model.uses_cpu else contextlib.nullcontext():
+			start_time = time.time()
+			text = model.transcribe(audio).strip()
 	if verbose:
-		print("\n\033[94mTranscription:\033[0m")
-		print(segments.text)
-		print("\n\033[94mSegments:\033[0m")
-		if hasattr(segments, "segments"):
-			print(segments.segments)
-		elif hasattr(segments, "tokens"):
-			print(segments.tokens)
-		else:
-			print(segments)
+		print(f"\033[94mTranscription:\033[0m {text}")
+		print(
+		    f"\033[94mProcessing time:\033[0m {time.time() - start_time:.2f} seconds")
+	return text
 
-	print(f"\033[94mProcessing time:\033[0m {end_time - start_time:.2f} seconds")
-	print(f"\033[94mPeak memory:\033[0m {mx.get_peak_memory() / 1e9:.2f} GB")
 
-	if output_path:
-		os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+# --- Benchmark ---
+def word_error_rate(reference: str, hypothesis: str) -> float:
+	"""Word-level edit distance over the reference length, ignoring case and punctuation."""
+	ref = re.sub(r"[^\w\s']", " ", reference.lower()).split()
+	hyp = re.sub(r"[^\w\s']", " ", hypothesis.lower()).split()
+	if not ref:
+		return 0.0 if not hyp else 1.0
+	previous = list(range(len(hyp) + 1))
+	for i, ref_word in enumerate(ref, 1):
+		current = [i] + [0] * len(hyp)
+		for j, hyp_word in enumerate(hyp, 1):
+			current[j] = min(previous[j] + 1, current[j - 1] + 1,
+			                 previous[j - 1] + (ref_word != hyp_word))
+		previous = current
+	return previous[-1] / len(ref)
 
-	if format == "txt" and output_path:
-		save_as_txt(segments, output_path)
-	elif format == "srt" and output_path:
-		save_as_srt(segments, output_path)
-	elif format == "vtt" and output_path:
-		save_as_vtt(segments, output_path)
-	elif format == "json" and output_path:
-		save_as_json(segments, output_path)
 
-	return segments
+def benchmark(audio_path: str,
+              reference: str,
+              engines: List[str],
+              models: List[str],
+              threads: int,
+              min_accuracy: float = 0.85,
+              runs: int = 2) -> Dict[str, Any] | None:
+	"""
+    Transcribes the clip with every engine/model combination and returns the
+    fastest one whose accuracy (1 - WER) meets min_accuracy, or None.
+    """
+	audio = load_audio(audio_path)
+	duration = len(audio) / SAMPLE_RATE
+	results = []
+	for engine_name in engines:
+		if not ENGINES[engine_name].available():
+			print(f"{engine_name}: not installed, skipping")
+			continue
+		for model_name in models:
+			engine = ENGINES[engine_name](model_name, threads)
+			try:
+				load_start = time.time()
+				engine.load()
+				load_time = time.time() - load_start
+				engine.transcribe(audio[:SAMPLE_RATE])  # Warm-up
+				times = []
+				for _ in range(runs):
+					start = time.time()
+					text = engine.transcribe(audio)
+					times.append(time.time() - start)
+			except Exception as e:
+				print(f"{engine_name} {model_name}: failed ({e})")
+				continue
+			finally:
+				engine.unload()
+			seconds = min(times)
+			accuracy = 1.0 - word_error_rate(reference, text)
+			results.append({
+			    'engine': engine_name,
+			    'model': model_name,
+			    'threads': threads,
+			    'seconds': seconds,
+			    'rtf': seconds / duration if duration else 0.0,
+			    'accuracy': accuracy,
+			    'load_seconds': load_time,
+			})
+			print(f"{engine_name:15} {model_name:12} {seconds:6.2f}s  "
+			      f"RTF {results[-1]['rtf']:.2f}  accuracy {accuracy:.0%}  {text[:50]!r}")
+
+	passing = [r for r in results if r['accuracy'] >= min_accuracy]
+	if not passing:
+		return None
+	return min(passing, key=lambda r: r['seconds'])
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(
+	    description=
+	    "Benchmark the installed STT engines on a clip and save the fastest one that's accurate enough."
+	)
+	parser.add_argument("--benchmark",
+	                    metavar="AUDIO",
+	                    required=True,
+	                    help="Audio clip of speech to transcribe.")
+	parser.add_argument("--reference",
+	                    required=True,
+	                    help="What's actually said in the clip.")
+	parser.add_argument("--engines",
+	                    default=",".join(ENGINES),
+	                    help="Comma-separated engines to try (default: all).")
+	parser.add_argument("--models",
+	                    default="tiny.en,base.en,small.en",
+	                    help="Comma-separated model sizes to try.")
+	parser.add_argument("--threads", type=int, default=DEFAULT_THREADS)
+	parser.add_argument("--min-accuracy",
+	                    type=float,
+	                    default=0.85,
+	                    help="Lowest acceptable 1 - WER (default: 0.85).")
+	parser.add_argument("--dry-run",
+	                    action="store_true",
+	                    help=f"Don't save the result to {PROFILE_FILE}.")
+	args = parser.parse_args()
+
+	best = benchmark(args.benchmark, args.reference, args.engines.split(","),
+	                 args.models.split(","), args.threads, args.min_accuracy)
+	if best is None:
+		print(f"\nNothing reached {args.min_accuracy:.0%} accuracy.")
+	else:
+		print(f"\nFastest accurate engine: {best['engine']} {best['model']} "
+		      f"({best['seconds']:.2f}s, {best['accuracy']:.0%})")
+		if not args.dry_run:
+			os.makedirs(os.path.dirname(PROFILE_FILE), exist_ok=True)
+			with open(PROFILE_FILE, 'w') as f:
+				json.dump(best, f, indent=2)
+			print(f"Saved to {PROFILE_FILE}; used when STT_ENGINE is 'auto'.")
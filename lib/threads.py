@@ -0,0 +1,213 @@
+"""
+Shares the CPU cores between the stages (stt, llm, tts) of this process.
+
+Left alone, llama.cpp, whisper.cpp and the TTS engine each pick a thread count
+for the whole machine, so when a pipelined turn overlaps them (TTS speaking
+the first sentence while the LLM is still decoding) they oversubscribe the
+cores and all of them slow down. Instead, a stage runs inside
+`with governor.stage(name):`, and the cores are split between the stages
+running at that moment in proportion to their weights. A stage running alone
+gets every core; when another one starts or finishes, the running stages are
+re-tuned on the spot (llama.cpp's thread count can change between decode calls).
+"""
+import contextlib
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+import config as cfg
+
+STAGES = ['stt', 'llm', 'tts']
+# The LLM decodes token by token for the whole reply, so it gets most of the
+# cores; STT is short and mostly runs alone, TTS keeps ahead of playback easily
+DEFAULT_WEIGHTS = {'llm': 4, 'stt': 2, 'tts': 1}
+
+
+def usable_cores() -> List[int]:
+	"""The cores this process may run on (respecting taskset/cgroups where the OS says)."""
+	try:
+		return sorted(os.sched_getaffinity(0))
+	except AttributeError:
+		return list(range(os.cpu_count() or 1))
+
+
+class StageStats:
+
+	def __init__(self):
+		self.runs = 0
+		self.busy_seconds = 0.0
+		# Time spent running while another stage was running too
+		self.overlap_seconds = 0.0
+		self.thread_seconds = 0.0
+		self.rebalances = 0
+
+
+class ThreadGovernor:
+	"""
+    Assigns thread counts (and, with pin=True, disjoint sets of cores) to the
+    stages that are running. Each stage can register an `apply(threads)`
+    callback that passes its new count on to the engine; it's called from
+    whichever thread changed the set of running stages.
+    """
+
+	def __init__(self,
+	             cores: List[int] | None = None,
+	             weights: Dict[str, float] | None = None,
+	             pin: bool = False):
+		self.cores = cores or usable_cores()
+		self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+		self.pin = pin and hasattr(os, 'sched_setaffinity')
+		self.lock = threading.Lock()
+		self.appliers: Dict[str, Callable[[int], None]] = {}
+		# Number of callers inside stage(name), and their native thread ids
+		self.active: Dict[str, int] = {}
+		self.tids: Dict[str, List[int]] = {}
+		self.assigned: Dict[str, int] = {}
+		# Most threads a stage can use well (e.g. from lib/autotune.py)
+		self.limits: Dict[str, int] = {}
+		self.stats = {stage: StageStats() for stage in STAGES}
+		self.last_change = time.time()
+		self.contended_seconds = 0.0
+		self.max_concurrent = 0
+
+	def register(self, stage: str, apply: Callable[[int], None] | None = None):
+		if apply:
+			self.appliers[stage] = apply
+		self.stats.setdefault(stage, StageStats())
+
+	def set_limit(self, stage: str, max_threads: int | None):
+		with self.lock:
+			if max_threads:
+				self.limits[stage] = max_threads
+			else:
+				self.limits.pop(stage, None)
+
+	def allocation(self, stages: List[str]) -> Dict[str, int]:
+		"""Splits the cores between `stages` by weight, at least one thread each."""
+		stages = [s for s in stages if self.weights.get(s, 1) > 0]
+		if not stages:
+			return {}
+		total_weight = sum(self.weights.get(s, 1) for s in stages)
+		n_cores = len(self.cores)
+		threads = {
+		    s: max(1, round(n_cores * self.weights.get(s, 1) / total_weight))
+		    for s in stages
+		}
+		# Rounding can hand out one more thread than there are cores
+		while sum(threads.values()) > max(n_cores, len(stages)):
+			largest = max(threads, key=lambda s: threads[s])
+			threads[largest] -= 1
+		return {s: min(n, self.limits.get(s, n)) for s, n in threads.items()}
+
+	def threads(self, stage: str) -> int:
+		"""The stage's current share, or what it would get running alone."""
+		with self.lock:
+			if stage in self.assigned:
+				return self.assigned[stage]
+		return self.allocation([stage]).get(stage, 1)
+
+	def _core_sets(self, threads: Dict[str, int]) -> Dict[str, List[int]]:
+		sets, start = {}, 0
+		order = lambda s: STAGES.index(s) if s in STAGES else len(STAGES)
+		for stage in sorted(threads, key=order):
+			sets[stage] = self.cores[start:start + threads[stage]] or self.cores
+			start += threads[stage]
+		return sets
+
+	def _account(self):
+		"""Adds the time since the last change to the running stages' stats."""
+		now = time.time()
+		elapsed = now - self.last_change
+		self.last_change = now
+		running = [s for s, n in self.active.items() if n]
+		for stage in running:
+			stats = self.stats[stage]
+			stats.busy_seconds += elapsed
+			stats.thread_seconds += elapsed * self.assigned.get(stage, 0)
+			if len(running) > 1:
+				stats.overlap_seconds += elapsed
+		if len(running) > 1:
+			self.contended_seconds += elapsed
+
+	def _rebalance(self, changed: str):
+		"""Called with the lock held after `changed` started or stopped."""
+		running = [s for s, n in self.active.items() if n]
+		self.max_concurrent = max(self.max_concurrent, len(running))
+		new = self.allocation(running)
+		updates = {
+		    s: n
+		    for s, n in new.items() if s == changed or self.assigned.get(s) != n
+		}
+		self.assigned = new
+		core_sets = self._core_sets(new) if self.pin else {}
+		for stage, n in updates.items():
+			if stage != changed:
+				self.stats[stage].rebalances += 1
+			apply = self.appliers.get(stage)
+			if apply:
+				try:
+					apply(n)
+				except Exception as e:
+					print(f"[Threads] Couldn't set {stage} to {n} threads: {e}")
+			for tid in self.tids.get(stage, []) if self.pin else []:
+				try:
+					os.sched_setaffinity(tid, core_sets[stage])
+				except OSError:
+					pass
+
+	@contextlib.contextmanager
+	def stage(self, name: str):
+		"""Runs a block as `name`, re-tuning it and the other running stages."""
+		tid = threading.get_native_id()
+		with self.lock:
+			self._account()
+			self.active[name] = self.active.get(name, 0) + 1
+			self.tids.setdefault(name, []).append(tid)
+			self.stats.setdefault(name, StageStats()).runs += 1
+			self._rebalance(name)
+		try:
+			yield self.assigned.get(name, 1)
+		finally:
+			with self.lock:
+				self._account()
+				self.active[name] -= 1
+				self.tids[name].remove(tid)
+				if self.pin:
+					# Threads are reused (e.g. by the web server), so unpin this one
+					try:
+						os.sched_setaffinity(tid, self.cores)
+					except OSError:
+						pass
+				self._rebalance(name)
+
+	def metrics(self) -> Dict[str, Any]:
+		with self.lock:
+			self._account()
+			stages = {
+			    stage: {
+			        'threads': self.assigned.get(stage, 0),
+			        'runs': stats.runs,
+			        'busy_s': round(stats.busy_seconds, 2),
+			        'overlap_s': round(stats.overlap_seconds, 2),
+			        'avg_threads': round(stats.thread_seconds / stats.busy_seconds, 1)
+			                       if stats.busy_seconds else None,
+			        'rebalances': stats.rebalances
+			    }
+			    for stage, stats in self.stats.items()
+			}
+			return {
+			    'cores': len(self.cores),
+			    'pinned': self.pin,
+			    'weights': self.weights,
+			    'limits': self.limits,
+			    'contended_s': round(self.contended_seconds, 2),
+			    'max_concurrent': self.max_concurrent,
+			    'stages': stages
+			}
+
+
+# Shared by lib.llm, lib.stt and lib.tts
+governor = ThreadGovernor(cores=getattr(cfg, 'CPU_CORES', None),
+                          weights=getattr(cfg, 'THREAD_WEIGHTS', None),
+                          pin=getattr(cfg, 'THREAD_AFFINITY', False))
@@ -1,14 +1,39 @@
-from mlx.nn import Module
-import config as cfg
-from mlx_audio.tts.models.kokoro import KokoroPipeline
-from mlx_audio.tts.utils import load_model
+"""
+Text-to-speech with interchangeable engines behind synthesize()/synthesize_stream():
+
+- kokoro: Kokoro via mlx_audio, for Apple Silicon
+- pyttsx3: the OS speech engine (eSpeak NG on Linux), fast on any CPU
+- null: silence of a plausible length, for running without audio
+
+Each engine's package is only imported when that engine is used, and each
+keeps running figures for its real-time factor and latency to first chunk.
+Run `python -m lib.tts --benchmark` to compare them per voice; with
+TTS_ENGINE = 'auto' (the default) the one with the lowest first-chunk latency
+is used from then on.
+"""
+import contextlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Tuple, Type
+
+import numpy as np
 import soundfile as sf
 
-model: Module
-pipeline: KokoroPipeline
+import config as cfg
+from lib.audio import resample
+from lib.models import manager
+from lib.threads import governor
+
+PROFILE_FILE = "./data/tts_profile.json"
+# Splits text into sentences, so the first one can play while the rest is synthesized
+SENTENCE_SPLIT = r'(?<=[.!?])\s+'
 
 # list is from https://huggingface.co/prince-canuma/Kokoro-82M/tree/main/voices
-Voices = [
+KOKORO_VOICES = [
     'af_alloy', 'af_aoede', 'af_bella', 'af_heart', 'af_jessica', 'af_kore',
     'af_nicole', 'af_nova', 'af_river', 'af_sarah', 'af_sky', 'am_adam',
     'am_echo', 'am_eric', 'am_fenrir', 'am_liam', 'am_michael', 'am_onyx',
@@ -16,28 +41,363 @@ Voices = [
 ]
 
 
-def init(model_path=cfg.TTS_MODEL):
-	global model, pipeline
-	model = load_model(model_path)
-	pipeline = KokoroPipeline(lang_code='a', model=model, repo_id=cfg.TTS_MODEL)
+class TTSEngine:
+	"""
+    Base class for engines. Subclasses implement _stream(); stream() wraps it to
+    keep moving averages of the real-time factor (synthesis seconds per second
+    of audio) and the latency to the first chunk.
+    """
+	name = ""
+	sample_rate = 24000
+	# Engines on the GPU (or doing nothing) don't take a share of the CPU cores
+	uses_cpu = True
+
+	def __init__(self, model: str | None = None):
+		self.model = model
+		self.rtf: float | None = None
+		self.first_chunk_latency: float | None = None
+		# Engines aren't thread-safe; background jobs (e.g. filler synthesis)
+		# share them with the live turn
+		self.lock = threading.Lock()
+
+	@classmethod
+	def available(cls) -> bool:
+		raise NotImplementedError
+
+	def load(self):
+		pass
+
+	def unload(self):
+		pass
+
+	def voices(self) -> List[str]:
+		raise NotImplementedError
+
+	def _stream(self, text: str, voice: str, speed: float,
+	            split_pattern: str) -> Iterator[np.ndarray]:
+		raise NotImplementedError
+
+	def _ema(self, old: float | None, new: float, alpha=0.3) -> float:
+		return new if old is None else old + alpha * (new - old)
+
+	def stream(self, text: str, voice: str, speed: float,
+	           split_pattern: str) -> Iterator[np.ndarray]:
+		start = time.time()
+		busy = 0.0  # Excludes time spent waiting on the consumer
+		samples = 0
+		cpu_stage = governor.stage('tts') if self.uses_cpu else contextlib.nullcontext()
+		with self.lock, cpu_stage:
+			chunk_start = time.time()
+			for chunk in self._stream(text, voice, speed, split_pattern):
+				busy += time.time() - chunk_start
+				if samples == 0:
+					self.first_chunk_latency = self._ema(self.first_chunk_latency,
+					                                     time.time() - start)
+				samples += len(chunk)
+				yield chunk
+				chunk_start = time.time()
+		if samples:
+			self.rtf = self._ema(self.rtf, busy / (samples / self.sample_rate))
+
+	def metrics(self) -> Dict[str, Any]:
+		return {
+		    'engine': self.name,
+		    'sample_rate': self.sample_rate,
+		    'rtf': self.rtf,
+		    'first_chunk_latency': self.first_chunk_latency
+		}
+
+
+class KokoroEngine(TTSEngine):
+	name = "kokoro"
+	sample_rate = 24000
+	uses_cpu = False  # MLX runs it on the GPU
+
+	@classmethod
+	def available(cls) -> bool:
+		try:
+			import mlx_audio
+			return True
+		except ImportError:
+			return False
+
+	def load(self):
+		from mlx_audio.tts.models.kokoro import KokoroPipeline
+		from mlx_audio.tts.utils import load_model
+
+		model_path = self.model or cfg.TTS_MODEL
+		self.kokoro = load_model(model_path)
+		self.pipeline = KokoroPipeline(lang_code='a',
+		                               model=self.kokoro,
+		                               repo_id=model_path)
+
+	def unload(self):
+		self.pipeline = None
+		self.kokoro = None
+
+	def voices(self) -> List[str]:
+		return KOKORO_VOICES
+
+	def _stream(self, text, voice, speed, split_pattern):
+		for _, _, audio in self.pipeline(text,
+		                                 voice=voice,
+		                                 speed=speed,
+		                                 split_pattern=split_pattern):
+			assert audio is not None
+			yield np.asarray(audio[0], dtype=np.float32)
+
+
+class Pyttsx3Engine(TTSEngine):
+	"""The OS speech engine. It can only write files, so each sentence goes through a temp WAV."""
+	name = "pyttsx3"
+	sample_rate = 22050
+	BASE_RATE = 200  # Words per minute at speed 1.0
+
+	@classmethod
+	def available(cls) -> bool:
+		try:
+			import pyttsx3
+			return True
+		except ImportError:
+			return False
+
+	def load(self):
+		import pyttsx3
+
+		self.engine = pyttsx3.init()
+		self.voice_ids = {v.name: v.id for v in self.engine.getProperty('voices')}
+
+	def unload(self):
+		self.engine.stop()
+		self.engine = None
+
+	def voices(self) -> List[str]:
+		return list(self.voice_ids)
+
+	def _stream(self, text, voice, speed, split_pattern):
+		# Character voices are usually Kokoro names; those get the default voice
+		if voice in self.voice_ids:
+			self.engine.setProperty('voice', self.voice_ids[voice])
+		self.engine.setProperty('rate', int(self.BASE_RATE * speed))
+		for sentence in re.split(split_pattern, text):
+			if not sentence.strip():
+				continue
+			fd, path = tempfile.mkstemp(suffix=".wav")
+			os.close(fd)
+			try:
+				self.engine.save_to_file(sentence, path)
+				self.engine.runAndWait()
+				audio, rate = sf.read(path, dtype='float32', always_2d=True)
+			finally:
+				os.remove(path)
+			audio = resample(audio.mean(axis=1, keepdims=True), rate,
+			                 self.sample_rate)
+			yield audio.reshape(-1)
+
+
+class NullEngine(TTSEngine):
+	"""Produces silence as long as the text would take to say."""
+	name = "null"
+	sample_rate = 24000
+	uses_cpu = False
+	CHARS_PER_SECOND = 15.0
+
+	@classmethod
+	def available(cls) -> bool:
+		return True
+
+	def voices(self) -> List[str]:
+		return ['silent']
+
+	def _stream(self, text, voice, speed, split_pattern):
+		for sentence in re.split(split_pattern, text):
+			if sentence.strip():
+				seconds = len(sentence) / (self.CHARS_PER_SECOND * speed)
+				yield np.zeros(int(seconds * self.sample_rate), dtype=np.float32)
+
+
+ENGINES: Dict[str, Type[TTSEngine]] = {
+    engine.name: engine
+    for engine in [KokoroEngine, Pyttsx3Engine, NullEngine]
+}
+
+model: TTSEngine | None = None
+# Sample rate of the loaded engine's audio
+SAMPLE_RATE = 24000
+
+
+def load_profile() -> Dict[str, Any] | None:
+	try:
+		with open(PROFILE_FILE, 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+
+def create_engine(engine_name: str | None = None,
+                  model_path: str | None = None) -> TTSEngine:
+	"""
+    Builds (without loading) an engine: the one named, else TTS_ENGINE from
+    config. 'auto' uses the benchmark's pick, else the first installed engine.
+    """
+	engine_name = engine_name or getattr(cfg, 'TTS_ENGINE', 'auto')
+	if engine_name == 'auto':
+		profile = load_profile()
+		if profile and profile.get('engine') in ENGINES and ENGINES[
+		    profile['engine']].available():
+			engine_name = profile['engine']
+		else:
+			engine_name = next(name for name, engine in ENGINES.items()
+			                   if engine.available())
+	if engine_name not in ENGINES:
+		raise ValueError(f"Unknown TTS engine: {engine_name}")
+	return ENGINES[engine_name](model_path)
+
+
+def init(model_path: str | None = None, engine_name: str | None = None):
+	global model, SAMPLE_RATE
+	model = create_engine(engine_name, model_path)
+	model.load()
+	SAMPLE_RATE = model.sample_rate
+	print(f"\n\033[94mTTS:\033[0m {model.name} ({SAMPLE_RATE} Hz)")
 
 
 def unload():
-	global model, pipeline
+	global model
 	if not model:
 		return
-	del pipeline
-	del model
+	model.unload()
+	model = None
+
+
+manager.register('tts',
+                 load=init,
+                 unload=unload,
+                 is_loaded=lambda: model is not None)
+
+
+def voices() -> List[str]:
+	with manager.use('tts'):
+		assert model is not None
+		return model.voices()
+
+
+def metrics() -> Dict[str, Any]:
+	"""Sample rate, real-time factor and first-chunk latency of the loaded engine."""
+	return model.metrics() if model else {}
+
+
+def synthesize_stream(text: str,
+                      voice='af_heart',
+                      speed=1.2,
+                      split_pattern=SENTENCE_SPLIT):
+	"""
+    Yields float32 audio chunks at SAMPLE_RATE as they're synthesized, one per
+    piece of text split by `split_pattern` (sentences by default).
+    """
+	with manager.use('tts'):
+		assert model is not None
+		yield from model.stream(text, voice, speed, split_pattern)
+
+
+def synthesize(text: str, voice='af_heart', speed=1.2) -> Tuple[np.ndarray, int]:
+	"""
+    Synthesizes `text` and returns the audio as a float32 array, with its
+    sample rate (which depends on the engine).
+    """
+	segments = list(
+	    synthesize_stream(text, voice=voice, speed=speed, split_pattern=r'\n+'))
+	if not segments:
+		return np.zeros(0, dtype=np.float32), SAMPLE_RATE
+	return np.concatenate(segments), SAMPLE_RATE
 
 
 def generate(text: str, output_path='audio.wav', voice='af_heart', speed=1.2):
-	global pipeline
-	if not pipeline:
-		init()
-
-	for _, _, audio in pipeline(text,
-	                            voice=voice,
-	                            speed=speed,
-	                            split_pattern=r'\n+'):
-		assert audio is not None
-		sf.write(output_path, audio[0], 24000)
+	audio, sample_rate = synthesize(text, voice=voice, speed=speed)
+	sf.write(output_path, audio, sample_rate)
+
+
+# --- Benchmark ---
+BENCHMARK_TEXT = ("Oh, hello there! I wasn't expecting visitors today. "
+                  "Come in, come in, and mind the cat.")
+
+
+def benchmark(engines: List[str],
+              voices: List[str] | None = None,
+              text: str = BENCHMARK_TEXT,
+              runs: int = 3) -> List[Dict[str, Any]]:
+	"""
+    Synthesizes `text` with each engine and voice (default: the engine's first
+    three voices), streaming by sentence, and measures latency to first chunk
+    and real-time factor.
+    """
+	results = []
+	for engine_name in engines:
+		if not ENGINES[engine_name].available():
+			print(f"{engine_name}: not installed, skipping")
+			continue
+		engine = ENGINES[engine_name]()
+		load_start = time.time()
+		try:
+			engine.load()
+		except Exception as e:
+			print(f"{engine_name}: failed to load ({e})")
+			continue
+		load_time = time.time() - load_start
+		engine_voices = voices or engine.voices()[:3]
+		for voice in engine_voices:
+			try:
+				list(engine.stream("Warm up.", voice, 1.0, SENTENCE_SPLIT))
+				engine.rtf = engine.first_chunk_latency = None
+				for _ in range(runs):
+					list(engine.stream(text, voice, 1.0, SENTENCE_SPLIT))
+			except Exception as e:
+				print(f"{engine_name} {voice}: failed ({e})")
+				continue
+			results.append({
+			    'engine': engine_name,
+			    'voice': voice,
+			    'load_seconds': load_time,
+			    **engine.metrics()
+			})
+			print(f"{engine_name:8} {voice[:20]:20} first chunk "
+			      f"{engine.first_chunk_latency:5.2f}s  RTF {engine.rtf:.2f}  "
+			      f"{engine.sample_rate} Hz")
+		engine.unload()
+	return results
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(
+	    description=
+	    "Compare the installed TTS engines per voice, and save the one with the lowest latency to first chunk."
+	)
+	parser.add_argument("--benchmark", action="store_true", required=True)
+	parser.add_argument("--engines",
+	                    default=",".join(e for e in ENGINES if e != 'null'),
+	                    help="Comma-separated engines to try (default: all but null).")
+	parser.add_argument(
+	    "--voices",
+	    default=None,
+	    help="Comma-separated voices to try (default: each engine's first three).")
+	parser.add_argument("--text", default=BENCHMARK_TEXT)
+	parser.add_argument("--dry-run",
+	                    action="store_true",
+	                    help=f"Don't save the result to {PROFILE_FILE}.")
+	args = parser.parse_args()
+
+	results = benchmark(args.engines.split(","),
+	                    args.voices.split(",") if args.voices else None, args.text)
+	if not results:
+		print("\nNo engine could be benchmarked.")
+	else:
+		best = min(results, key=lambda r: r['first_chunk_latency'])
+		print(f"\nLowest first-chunk latency: {best['engine']} ({best['voice']}, "
+		      f"{best['first_chunk_latency']:.2f}s)")
+		if not args.dry_run:
+			os.makedirs(os.path.dirname(PROFILE_FILE), exist_ok=True)
+			with open(PROFILE_FILE, 'w') as f:
+				json.dump({'engine': best['engine'], 'results': results}, f, indent=2)
+			print(f"Saved to {PROFILE_FILE}; used when TTS_ENGINE is 'auto'.")
@@ -0,0 +1,272 @@
+"""
+Hands-free capture: listens all the time for a wake word (e.g. the character's
+name) and starts a normal capture when it's heard.
+
+Continuous transcription would keep a CPU core busy, so detection is gated:
+every 30 ms frame goes through webrtcvad (or an energy threshold if it isn't
+installed), which costs next to nothing, and only a burst of speech about as
+long as a name is checked for the wake word, with a tiny Whisper model on one
+thread (its own "wake" stage in the thread governor, and a model in the model
+manager, so the idle unloader can free it). Recent
+frames are kept in a ring buffer, so the capture starts PRE_ROLL_S before the
+burst and the first syllable isn't lost. The capture ends after END_SILENCE_S
+of silence.
+"""
+import collections
+import contextlib
+import difflib
+import queue
+import re
+import threading
+import time
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+from lib.audio import SAMPLE_RATE, pcm16_to_float32
+from lib.models import manager
+from lib.threads import governor
+import lib.stt as stt
+
+FRAME_MS = 30  # webrtcvad takes 10, 20 or 30 ms frames
+FRAME_SAMPLES = SAMPLE_RATE * FRAME_MS // 1000
+PRE_ROLL_S = 0.4
+PRE_ROLL_FRAMES = int(PRE_ROLL_S * 1000 / FRAME_MS)
+# Bursts of speech shorter than this (clicks, bumps) or that run on past
+# MAX_BURST_S (talking, not calling a name) aren't checked
+MIN_BURST_S = 0.3
+MAX_BURST_S = 2.0
+# Silence that ends a burst, and a capture
+BURST_END_S = 0.3
+END_SILENCE_S = 1.0
+MAX_CAPTURE_S = 20.0
+# How close a heard word has to be to the wake word (names get misspelled)
+MATCH_RATIO = 0.75
+
+
+class EnergyVAD:
+	"""Fallback when webrtcvad isn't installed: loudness against a running noise floor."""
+
+	def __init__(self, margin: float = 3.0, min_rms: float = 0.01):
+		self.margin = margin
+		self.min_rms = min_rms
+		self.noise = min_rms
+
+	def is_speech(self, frame: bytes, sample_rate: int) -> bool:
+		samples = np.frombuffer(frame, dtype='<i2').astype(np.float32) / 32768.0
+		rms = float(np.sqrt(np.mean(samples**2)))
+		speech = rms > max(self.noise * self.margin, self.min_rms)
+		if not speech:
+			self.noise += 0.05 * (rms - self.noise)
+		return speech
+
+
+def create_vad(aggressiveness: int = 2):
+	try:
+		import webrtcvad
+		return webrtcvad.Vad(aggressiveness)
+	except ImportError:
+		print("[Wake] webrtcvad isn't installed, using an energy threshold "
+		      "(pip install webrtcvad for fewer false starts)")
+		return EnergyVAD()
+
+
+def normalize(text: str) -> List[str]:
+	return re.sub(r"[^\w\s']", " ", text.lower()).split()
+
+
+def contains_wake_word(text: str, wake_words: List[str],
+                       ratio: float = MATCH_RATIO) -> bool:
+	"""True if any run of words in `text` sounds close enough to a wake word."""
+	words = normalize(text)
+	for wake_word in wake_words:
+		target = " ".join(normalize(wake_word))
+		n = len(target.split())
+		if not n:
+			continue
+		for i in range(max(1, len(words) - n + 1)):
+			heard = " ".join(words[i:i + n])
+			if difflib.SequenceMatcher(None, heard, target).ratio() >= ratio:
+				return True
+	return False
+
+
+class WakeWordListener:
+	"""
+    Reads the microphone on its own low-rate input stream and calls:
+
+    - on_wake(pre_roll) when a wake word is heard; it starts a capture and
+      returns True, or returns False if the app can't take one right now
+    - on_audio(frame) with each (n, 1) float32 frame of the capture
+    - on_end() when the speaker has gone quiet
+
+    Nothing is detected while is_idle() is False, so the character's own
+    voice doesn't wake it.
+    """
+
+	def __init__(self,
+	             wake_words: Callable[[], List[str]],
+	             on_wake: Callable[[np.ndarray], bool],
+	             on_audio: Callable[[np.ndarray], None],
+	             on_end: Callable[[], None],
+	             is_idle: Callable[[], bool] = lambda: True,
+	             stt_model: str = 'tiny.en'):
+		self.wake_words = wake_words
+		self.on_wake = on_wake
+		self.on_audio = on_audio
+		self.on_end = on_end
+		self.is_idle = is_idle
+		self.stt_model = stt_model
+		self.vad = None
+		self.frames: queue.Queue = queue.Queue()
+		# Enough for the pre-roll plus the longest burst
+		self.ring: collections.deque = collections.deque(
+		    maxlen=int((PRE_ROLL_S + MAX_BURST_S) * 1000 / FRAME_MS))
+		self.keyword_engine: stt.STTEngine | None = None
+		self.stream = None
+		self._thread: threading.Thread | None = None
+		self._stop_event = threading.Event()
+		self.checks = 0
+		self.skipped = 0
+		self.detections = 0
+
+	def _load_engine(self):
+		# One thread is plenty for a second of audio
+		engine = stt.create_engine(model_path=self.stt_model, threads=1)
+		engine.load()
+		self.keyword_engine = engine
+
+	def _unload_engine(self):
+		engine, self.keyword_engine = self.keyword_engine, None
+		if engine:
+			engine.unload()
+
+	def start(self):
+		import sounddevice as sd
+
+		self.vad = create_vad()
+		manager.register('wake',
+		                 load=self._load_engine,
+		                 unload=self._unload_engine,
+		                 is_loaded=lambda: self.keyword_engine is not None)
+		governor.register('wake')
+		governor.set_limit('wake', 1)
+		# Loaded up front so the first check isn't slow
+		manager.load('wake')
+		self._stop_event.clear()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+		def callback(indata, frames, time, status):
+			# Runs on the audio thread, so it only hands the frame over
+			self.frames.put(bytes(indata))
+
+		self.stream = sd.RawInputStream(samplerate=SAMPLE_RATE,
+		                                blocksize=FRAME_SAMPLES,
+		                                channels=1,
+		                                dtype='int16',
+		                                callback=callback)
+		self.stream.start()
+		print(f"[Wake] Listening for {', '.join(self.wake_words())!r}")
+
+	def stop(self):
+		self._stop_event.set()
+		self.frames.put(None)
+		if self.stream:
+			self.stream.stop()
+			self.stream.close()
+			self.stream = None
+		if 'wake' in manager.models:
+			manager.unload('wake', "stopped")
+
+	def _next_frame(self) -> bytes | None:
+		frame = self.frames.get()
+		if frame is None or self._stop_event.is_set():
+			return None
+		return frame
+
+	def _run(self):
+		while True:
+			frame = self._next_frame()
+			if frame is None:
+				return
+			if not self.is_idle():
+				self.ring.clear()
+				continue
+			self.ring.append(frame)
+			if not self.vad.is_speech(frame, SAMPLE_RATE):
+				continue
+			read = self._read_burst()
+			if read is None:
+				return
+			burst, silent_ms = read
+			# The burst plus what came just before it
+			heard = list(self.ring)[-(len(burst) + PRE_ROLL_FRAMES):]
+			if self._worth_checking(burst, silent_ms) and self._heard_wake_word(
+			    burst) and self.on_wake(pcm16_to_float32(b"".join(heard))):
+				self.detections += 1
+				self.ring.clear()
+				if not self._capture():
+					return
+			else:
+				# Keep the pre-roll, in case the next burst starts right away
+				while len(self.ring) > PRE_ROLL_FRAMES:
+					self.ring.popleft()
+
+	def _silence_after(self, frame: bytes, silent_ms: int) -> int:
+		"""Milliseconds of silence so far, counting this frame."""
+		return 0 if self.vad.is_speech(frame, SAMPLE_RATE) else silent_ms + FRAME_MS
+
+	def _read_burst(self) -> Tuple[List[bytes], int] | None:
+		"""
+        Reads frames into the ring until the speech pauses or MAX_BURST_S is
+        reached; returns the burst and the milliseconds of silence at its end.
+        """
+		burst = [self.ring[-1]]
+		silent_ms = 0
+		while silent_ms < BURST_END_S * 1000 and len(
+		    burst) * FRAME_MS < MAX_BURST_S * 1000:
+			frame = self._next_frame()
+			if frame is None:
+				return None
+			self.ring.append(frame)
+			burst.append(frame)
+			silent_ms = self._silence_after(frame, silent_ms)
+		return burst, silent_ms
+
+	def _worth_checking(self, burst: List[bytes], silent_ms: int) -> bool:
+		speech_ms = len(burst) * FRAME_MS - silent_ms
+		ran_on = silent_ms < BURST_END_S * 1000
+		if speech_ms < MIN_BURST_S * 1000 or ran_on:
+			self.skipped += 1
+			return False
+		return True
+
+	def _heard_wake_word(self, burst: List[bytes]) -> bool:
+		self.checks += 1
+		start = time.time()
+		audio = pcm16_to_float32(b"".join(burst)).reshape(-1)
+		with manager.use('wake'):
+			engine = self.keyword_engine
+			assert engine is not None
+			with governor.stage(
+			    'wake') if engine.uses_cpu else contextlib.nullcontext():
+				text = engine.transcribe(audio)
+		heard = contains_wake_word(text, self.wake_words())
+		print(f"[Wake] Heard {text.strip()!r} ({time.time() - start:.2f}s)"
+		      f"{' - wake word' if heard else ''}")
+		return heard
+
+	def _capture(self) -> bool:
+		"""Streams frames to on_audio until END_SILENCE_S of silence; False if stopped."""
+		silent_ms = 0
+		captured_ms = 0
+		while silent_ms < END_SILENCE_S * 1000 and captured_ms < MAX_CAPTURE_S * 1000:
+			frame = self._next_frame()
+			if frame is None:
+				return False
+			self.on_audio(pcm16_to_float32(frame))
+			captured_ms += FRAME_MS
+			silent_ms = self._silence_after(frame, silent_ms)
+		self.on_end()
+		return True
@@ -1,6 +1,9 @@
-import io
+import re
 import json
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import uuid
+import asyncio
+import base64
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import soundfile as sf
@@ -15,17 +18,40 @@ import os
 import lib.llm as llm
 import lib.stt as stt
 import lib.tts as tts
+import lib.models as models
+from lib.threads import governor
+from lib.audio import (decode_audio, float32_to_pcm16, wav_stream_header,
+                       OpusEncoder, SAMPLE_RATE)
+from lib.scheduler import (LLMScheduler, LLMJob, DeadlineExceeded,
+                           PRIORITY_NORMAL, PRIORITY_HIGH)
+from lib.router import STAGES, from_config
 
 # --- App & Models ---
 app = FastAPI()
+# The only thing that touches the language model; see lib/scheduler.py
+scheduler = LLMScheduler()
+# Which models this instance loads and serves; set with --stages so that e.g.
+# a second machine serves only STT and TTS (see lib/router.py)
+serving_stages = set(STAGES)
+# Where /converse sends STT and TTS: config.STAGE_NODES, else this process
+router = from_config()
+
+
+def require_stage(stage: str):
+	if stage not in serving_stages:
+		raise HTTPException(status_code=503,
+		                    detail=f"This node doesn't serve {stage}")
 
 
 @app.on_event("startup")
 def startup_event():
-	print("Initializing AI models...")
-	llm.init()
-	stt.init()
-	tts.init()
+	print(f"Initializing AI models ({', '.join(sorted(serving_stages))})...")
+	# Loaded through the model manager, which measures each one's memory
+	for stage in sorted(serving_stages):
+		models.manager.load(stage)
+	if 'llm' in serving_stages:
+		scheduler.start()
+	router.start_health_checks()
 	print("Models initialized.")
 	print("Now start the Node server. In a new terminal, run:")
 	print("cd app_server")
@@ -36,43 +62,76 @@ def startup_event():
 @app.on_event("shutdown")
 def shutdown_event():
 	print("Unloading AI models...")
-	llm.unload()
-	stt.unload()
-	tts.unload()
+	router.stop()
+	if 'llm' in serving_stages:
+		scheduler.stop()
+		llm.unload()
+	if 'stt' in serving_stages:
+		stt.unload()
+	if 'tts' in serving_stages:
+		tts.unload()
 	print("Models unloaded.")
 
 
 # --- API Endpoints ---
 
 
-@app.post("/stt")
-async def speech_to_text(audio_file: UploadFile = File(...)):
+@app.get("/health")
+async def health():
 	"""
-    Accepts an audio file, converts it to a standard WAV format,
-    and returns the transcribed text.
+    Used by other nodes' stage routers to see what this node can take, and
+    which TTS engine it runs (callers key their audio caches on it).
     """
-	# Define temporary paths. Using the original filename helps keep track.
-	temp_input_path = f"data/temp_input_{audio_file.filename}"
-	temp_output_path = "data/temp_stt_input.wav"
+	tts_info = {
+	    "engine": tts.model.name,
+	    "sample_rate": tts.SAMPLE_RATE
+	} if 'tts' in serving_stages and tts.model else None
+	return {"status": "ok", "stages": sorted(serving_stages), "tts": tts_info}
+
 
+def convert_and_transcribe(data: bytes, filename: str) -> str:
+	"""
+    Converts an uploaded audio file to a 16kHz mono WAV and transcribes it.
+    Blocking, so it's run on a worker thread; each call has its own temp files.
+    """
+	request_id = uuid.uuid4().hex
+	# Keeping the original extension helps ffmpeg pick the format
+	temp_input_path = f"data/temp_input_{request_id}{os.path.splitext(filename)[1]}"
+	temp_output_path = f"data/temp_stt_input_{request_id}.wav"
 	try:
 		# 1. Save the uploaded file (e.g., .webm) to a temporary location.
 		with open(temp_input_path, "wb") as f:
-			f.write(await audio_file.read())
+			f.write(data)
 
 		# 2. Use ffmpeg to convert the input file to a 16kHz mono WAV file.
-		print(f"Converting '{temp_input_path}' to '{temp_output_path}'...")
 		(ffmpeg.input(temp_input_path).output(
 		    temp_output_path,
 		    ac=1,  # Mono channel
 		    ar='16000',  # 16kHz sample rate
 		    format='wav').run(overwrite_output=True, quiet=True))
-		print("Conversion complete.")
 
 		# 3. Pass the *converted* WAV file to the STT function.
-		result = stt.generate(temp_output_path, verbose=False)
-		return {"text": result.text.strip()}
+		return stt.transcribe(temp_output_path)
+	finally:
+		# 4. Clean up both temporary files.
+		for path in (temp_input_path, temp_output_path):
+			if os.path.exists(path):
+				os.remove(path)
+
 
+@app.post("/stt")
+async def speech_to_text(audio_file: UploadFile = File(...)):
+	"""
+    Accepts an audio file, converts it to a standard WAV format,
+    and returns the transcribed text.
+    """
+	require_stage('stt')
+	data = await audio_file.read()
+	try:
+		# Off the event loop, so /health keeps answering during a long transcription
+		text = await asyncio.to_thread(convert_and_transcribe, data,
+		                               audio_file.filename or "audio")
+		return {"text": text}
 	except ffmpeg.Error as e:
 		# Provide more specific feedback if ffmpeg fails
 		error_details = e.stderr.decode() if e.stderr else str(e)
@@ -82,39 +141,91 @@ async def speech_to_text(audio_file: UploadFile = File(...)):
 	except Exception as e:
 		print(f"STT Error: {e}")
 		raise HTTPException(status_code=500, detail=str(e))
-	finally:
-		# 4. Clean up both temporary files.
-		if os.path.exists(temp_input_path):
-			os.remove(temp_input_path)
-		if os.path.exists(temp_output_path):
-			os.remove(temp_output_path)
 
 
 class LLMRequest(BaseModel):
 	prompt: str
 	system_prompt: str
+	# Lower runs first; see lib/scheduler.py
+	priority: int = PRIORITY_NORMAL
+	# Seconds the request may take in total, queueing included
+	timeout: float | None = None
+	history: list | None = None
+	json_mode: bool = True
+	max_tokens: int = 256
+
+
+# How often a request waiting in the LLM queue checks that its client is still there
+DISCONNECT_POLL_S = 0.5
+
+
+async def wait_for_first_chunk(job: LLMJob, http_request: Request) -> str:
+	"""
+    Waits for the job's first chunk ("" if it produced none). The job is
+    cancelled if the client disconnects or the request is cancelled first, so
+    a caller that gave up doesn't keep its place in the queue.
+    """
+	next_chunk = asyncio.ensure_future(job.__anext__())
+	try:
+		while True:
+			done, _ = await asyncio.wait({next_chunk}, timeout=DISCONNECT_POLL_S)
+			if done:
+				try:
+					return next_chunk.result()
+				except StopAsyncIteration:
+					return ""
+			if await http_request.is_disconnected():
+				job.cancel()
+				raise HTTPException(status_code=499, detail="Client disconnected")
+	except asyncio.CancelledError:
+		job.cancel()
+		raise
+	finally:
+		if not next_chunk.done():
+			next_chunk.cancel()
 
 
 @app.post("/llm")
-async def language_model_generate(request: LLMRequest):
+async def language_model_generate(request: LLMRequest, http_request: Request):
 	"""
     Accepts a user prompt and system prompt, and streams the model's response.
+    Requests are queued by the scheduler; generation stops if the client disconnects.
     """
+	require_stage('llm')
 	try:
+		job = scheduler.submit(request.prompt,
+		                       sys_input=request.system_prompt,
+		                       json=request.json_mode,
+		                       history=request.history,
+		                       max_tokens=request.max_tokens,
+		                       priority=request.priority,
+		                       timeout=request.timeout)
+		# Waiting for the first chunk means a request that expires in the
+		# queue still gets a proper error status
+		try:
+			first_chunk = await wait_for_first_chunk(job, http_request)
+		except DeadlineExceeded as e:
+			raise HTTPException(status_code=503, detail=str(e))
+
 		# The generator for the streaming response
-		def stream_generator():
+		async def stream_generator():
 			try:
-				for chunk in llm.generate_stream(request.prompt,
-				                                 sys_input=request.system_prompt,
-				                                 json=True):
+				yield first_chunk
+				async for chunk in job:
+					if await http_request.is_disconnected():
+						break
 					yield chunk
 			except Exception as e:
 				print(f"LLM stream error: {e}")
 				# The stream will simply end here. The client needs to handle it.
-				pass
+			finally:
+				# Also runs when Starlette cancels the stream on disconnect
+				job.cancel()
 
 		return StreamingResponse(stream_generator(), media_type="text/plain")
 
+	except HTTPException:
+		raise
 	except Exception as e:
 		print(f"LLM Error before stream start: {e}")
 		# This will catch errors before the stream starts (e.g., model not loaded)
@@ -126,32 +237,311 @@ async def language_model_generate(request: LLMRequest):
 		    }))
 
 
+@app.get("/llm/metrics")
+async def language_model_metrics():
+	"""Queue depth, wait times and job outcomes of the LLM scheduler."""
+	return scheduler.metrics()
+
+
 class TTSRequest(BaseModel):
 	text: str
 	voice: str
+	speed: float = 1.2
+	# pcm16, wav or opus; if not given, picked from the Accept header
+	format: str | None = None
+
+
+TTS_MEDIA_TYPES = {
+    'pcm16': 'application/octet-stream',
+    'wav': 'audio/wav',
+    'opus': 'audio/ogg',
+}
+
+
+def opus_available() -> bool:
+	try:
+		import av
+		return True
+	except ImportError:
+		return False
+
+
+def negotiate_audio_format(requested: str | None, accept: str) -> str:
+	"""Picks the /tts output format. WAV is the default, for older clients."""
+	if requested:
+		if requested not in TTS_MEDIA_TYPES:
+			raise HTTPException(status_code=400,
+			                    detail=f"Unknown audio format: {requested}")
+		if requested == 'opus' and not opus_available():
+			raise HTTPException(status_code=400,
+			                    detail="Opus output needs PyAV (pip install av)")
+		return requested
+	if ('audio/ogg' in accept or 'audio/opus' in accept) and opus_available():
+		return 'opus'
+	if 'audio/wav' in accept or 'audio/x-wav' in accept:
+		return 'wav'
+	if 'audio/pcm' in accept or 'application/octet-stream' in accept:
+		return 'pcm16'
+	return 'wav'
+
+
+def encode_audio_stream(chunks, audio_format: str):
+	"""Encodes float32 chunks into a byte stream, one piece per chunk."""
+	if audio_format == 'opus':
+		encoder = OpusEncoder(tts.SAMPLE_RATE)
+		for chunk in chunks:
+			data = encoder.encode(chunk)
+			if data:
+				yield data
+		yield encoder.close()
+		return
+	if audio_format == 'wav':
+		yield wav_stream_header(tts.SAMPLE_RATE)
+	for chunk in chunks:
+		yield float32_to_pcm16(chunk)
 
 
 @app.post("/tts")
-async def text_to_speech(request: TTSRequest):
+async def text_to_speech(request: TTSRequest, http_request: Request):
 	"""
-    Accepts text and a voice, returns the generated audio as a WAV file stream.
+    Accepts text and a voice, and streams the audio back sentence by sentence
+    as it's synthesized: as raw 16-bit PCM, WAV with a streaming header, or
+    Ogg/Opus (a fraction of the size, for phones on Wi-Fi).
     """
+	require_stage('tts')
+	audio_format = negotiate_audio_format(request.format,
+	                                      http_request.headers.get('accept', ''))
+	chunks = tts.synthesize_stream(request.text,
+	                               voice=request.voice,
+	                               speed=request.speed)
 	try:
-		temp_audio_path = "data/temp_tts_output.wav"
-		tts.generate(request.text,
-		             output_path=temp_audio_path,
-		             voice=request.voice)
-
-		# Stream the file back
-		with open(temp_audio_path, "rb") as f:
-			audio_bytes = f.read()
-
-		return StreamingResponse(io.BytesIO(audio_bytes), media_type="audio/wav")
+		# Synthesizes the first sentence up front, so errors still get a 500
+		first_chunk = await asyncio.to_thread(next, chunks, None)
 	except Exception as e:
 		print(f"TTS Error: {e}")
 		raise HTTPException(status_code=500, detail=str(e))
 
+	def all_chunks():
+		try:
+			if first_chunk is not None:
+				yield first_chunk
+			yield from chunks
+		except Exception as e:
+			print(f"TTS stream error: {e}")
+		finally:
+			# Releases the TTS pipeline if the client went away mid-stream
+			chunks.close()
+
+	return StreamingResponse(encode_audio_stream(all_chunks(), audio_format),
+	                         media_type=TTS_MEDIA_TYPES[audio_format],
+	                         headers={
+	                             'X-Audio-Format': audio_format,
+	                             'X-Sample-Rate': str(tts.SAMPLE_RATE)
+	                         })
+
+
+@app.get("/tts/metrics")
+async def text_to_speech_metrics():
+	"""The TTS engine's sample rate, real-time factor and latency to first chunk."""
+	require_stage('tts')
+	return tts.metrics()
+
+
+@app.get("/models/metrics")
+async def model_metrics():
+	"""Memory use, idle time and load/unload counts of each model in this process."""
+	return models.manager.metrics()
+
+
+@app.get("/router/metrics")
+async def router_metrics():
+	"""The backends each stage is routed to, in order, and which are healthy."""
+	return router.status()
+
+
+@app.get("/threads/metrics")
+async def thread_metrics():
+	"""Threads each stage has now, and how much the stages overlapped."""
+	return governor.metrics()
+
+
+# --- Conversation ---
+# A sentence ends at . ! or ? (plus closing quotes/brackets) followed by whitespace
+SENTENCE_RE = re.compile(
+    r'(?:[^.!?]|[.!?]+(?!["\')\]]*\s))*[.!?]+["\')\]]*\s+')
+TEXT_FIELD_RE = re.compile(r'"text"\s*:\s*"((?:[^"\\]|\\.)*)')
+EMOTION_FIELD_RE = re.compile(r'"emotion"\s*:\s*"([^"]*)"')
+
+
+def partial_reply_text(raw: str) -> str:
+	"""The 'text' value of a JSON reply that may still be mid-stream."""
+	match = TEXT_FIELD_RE.search(raw)
+	if not match:
+		return ""
+	# Drops a \\uXXXX escape that hasn't fully arrived yet
+	value = re.sub(r'\\u[0-9a-fA-F]{0,3}$', '', match.group(1))
+	try:
+		return json.loads(f'"{value}"')
+	except ValueError:
+		return value.replace('\\"', '"')
+
+
+def transcribe_upload(data: bytes) -> str:
+	"""Decodes any ffmpeg-readable audio blob and transcribes it (maybe on another node)."""
+	wav_path = f"data/temp_converse_{uuid.uuid4().hex}.wav"
+	try:
+		sf.write(wav_path, decode_audio(data), SAMPLE_RATE)
+		return router.transcribe(wav_path)
+	finally:
+		if os.path.exists(wav_path):
+			os.remove(wav_path)
+
+
+def event_line(type: str, **payload) -> bytes:
+	return (json.dumps({'type': type, **payload}) + "\n").encode('utf-8')
+
+
+@app.post("/converse")
+async def converse(http_request: Request,
+                   audio_file: UploadFile = File(...),
+                   system_prompt: str = Form(...),
+                   voice: str = Form('af_heart'),
+                   speed: float = Form(1.2),
+                   history: str = Form('[]')):
+	"""
+    Runs a whole turn in one request: STT, then the LLM with sentence-level TTS
+    running alongside it. Streams newline-delimited JSON events:
+
+    - {"type": "transcript", "text": ...}
+    - {"type": "text", "delta": ...}: the spoken text as it's generated
+    - {"type": "emotion", "emotion": ...}: as soon as the LLM has picked one
+    - {"type": "audio", "index": n, "text": ..., "sample_rate": ..., "data": ...}:
+      one per sentence, base64 16-bit mono PCM
+    - {"type": "done", "text": ..., "emotion": ...} or {"type": "error", "detail": ...}
+    """
+	require_stage('llm')
+	audio_data = await audio_file.read()
+	try:
+		history_messages = json.loads(history)
+	except ValueError:
+		raise HTTPException(status_code=400, detail="history must be a JSON list")
+
+	events: asyncio.Queue = asyncio.Queue()
+	sentences: asyncio.Queue = asyncio.Queue()
+
+	async def run_llm(user_text: str):
+		job = scheduler.submit(user_text,
+		                       sys_input=system_prompt,
+		                       json=True,
+		                       history=history_messages,
+		                       priority=PRIORITY_HIGH)
+		raw = ""
+		sent_text = ""
+		spoken_upto = 0
+		emotion = None
+		try:
+			async for chunk in job:
+				raw += chunk
+				text = partial_reply_text(raw)
+				if len(text) > len(sent_text) and text.startswith(sent_text):
+					await events.put(event_line('text', delta=text[len(sent_text):]))
+					sent_text = text
+				while match := SENTENCE_RE.match(text, spoken_upto):
+					await sentences.put(match.group(0).strip())
+					spoken_upto = match.end()
+				if emotion is None:
+					found = EMOTION_FIELD_RE.search(raw)
+					if found:
+						emotion = found.group(1)
+						await events.put(event_line('emotion', emotion=emotion))
+		finally:
+			job.cancel()
+
+		try:
+			reply = json.loads(raw)
+			text = reply.get('text', '')
+			if emotion is None and reply.get('emotion'):
+				emotion = reply['emotion']
+				await events.put(event_line('emotion', emotion=emotion))
+		except ValueError:
+			text = partial_reply_text(raw) or raw
+		if text[spoken_upto:].strip():
+			await sentences.put(text[spoken_upto:].strip())
+		return text, emotion
+
+	async def run_tts():
+		index = 0
+		while True:
+			sentence = await sentences.get()
+			if sentence is None:
+				return
+			audio, sample_rate = await asyncio.to_thread(router.synthesize,
+			                                             sentence,
+			                                             voice=voice,
+			                                             speed=speed)
+			pcm = float32_to_pcm16(audio)
+			await events.put(
+			    event_line('audio',
+			               index=index,
+			               text=sentence,
+			               sample_rate=sample_rate,
+			               data=base64.b64encode(pcm).decode('ascii')))
+			index += 1
+
+	async def run_turn():
+		try:
+			user_text = await asyncio.to_thread(transcribe_upload, audio_data)
+			await events.put(event_line('transcript', text=user_text))
+			if not user_text:
+				await events.put(event_line('done', text="", emotion=None))
+				return
+			tts_task = asyncio.create_task(run_tts())
+			try:
+				text, emotion = await run_llm(user_text)
+			finally:
+				await sentences.put(None)
+			await tts_task
+			await events.put(event_line('done', text=text, emotion=emotion))
+		except Exception as e:
+			print(f"Converse error: {e}")
+			await events.put(event_line('error', detail=str(e)))
+		finally:
+			await events.put(None)
+
+	async def stream_events():
+		turn = asyncio.create_task(run_turn())
+		try:
+			while True:
+				line = await events.get()
+				if line is None:
+					break
+				if await http_request.is_disconnected():
+					break
+				yield line
+		finally:
+			# Cancelling the turn also cancels its scheduler job
+			turn.cancel()
+
+	return StreamingResponse(stream_events(), media_type="application/x-ndjson")
+
 
 if __name__ == "__main__":
+	import argparse
 	import uvicorn
-	uvicorn.run(app, host="0.0.0.0", port=8001)
+
+	parser = argparse.ArgumentParser(description="Serve the AI models over HTTP.")
+	parser.add_argument(
+	    "--stages",
+	    default=",".join(STAGES),
+	    help=
+	    "Comma-separated stages to load and serve (default: stt,llm,tts). E.g. run --stages stt,tts on a second machine and list it in STAGE_NODES."
+	)
+	parser.add_argument("--host", default="0.0.0.0")
+	parser.add_argument("--port", type=int, default=8001)
+	args = parser.parse_args()
+
+	serving_stages = {s.strip() for s in args.stages.split(",") if s.strip()}
+	unknown = serving_stages - set(STAGES)
+	if unknown:
+		parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+	uvicorn.run(app, host=args.host, port=args.port)
@@ -3,7 +3,6 @@ import os
 import time
 import threading
 import queue
-import shutil
 from typing import Dict, Any
 
 # --- Dependencies for manual recording ---
@@ -19,6 +18,8 @@ import numpy as np
 import lib.llm as llm
 import lib.stt as stt
 import lib.tts as tts
+from lib.characters import CharacterRegistry
+from generate_character_images import BackgroundImageQueue
 
 # --- Configuration ---
 # File paths for Vuo to read from
@@ -49,11 +50,15 @@ class AppState:
 		# A queue to process interactions sequentially
 		self.processing_queue = queue.Queue()
 		# Character-related state
-		self.available_characters: Dict[str, Dict[str, Any]] = {}
+		# Watched for edits, so characters can be added without a restart
+		self.characters = CharacterRegistry(CHARACTERS_DIR)
 		self.current_character_name: str | None = None
 
 
 state = AppState()
+# Renders images for emotions the current character doesn't have yet
+image_queue = BackgroundImageQueue(
+    is_idle=lambda: state.current_state == "Idle")
 
 
 # --- Character Management ---
@@ -64,56 +69,43 @@ def load_characters():
 		print(f"Warning: Characters directory not found at {CHARACTERS_DIR}")
 		return
 
-	for char_name in os.listdir(CHARACTERS_DIR):
-		char_dir = os.path.join(CHARACTERS_DIR, char_name)
-		config_path = os.path.join(char_dir, "config.json")
-		if os.path.isdir(char_dir) and os.path.isfile(config_path):
-			try:
-				with open(config_path, 'r') as f:
-					config_data = json.load(f)
-					# Add a runtime state for the character's current emotion
-					config_data['emotion'] = 'neutral'
-					state.available_characters[char_name] = config_data
-					print(f"  - Loaded character: {config_data['name']}")
-			except Exception as e:
-				print(f"Error loading character '{char_name}': {e}")
-
-	if state.available_characters:
+	state.characters.refresh()
+
+	if len(state.characters):
 		# Set the first character found as the default
-		state.current_character_name = sorted(state.available_characters.keys())[0]
-		print(
-		    f"Default character set to: {state.available_characters[state.current_character_name]['name']}"
-		)
+		state.current_character_name = state.characters.keys()[0]
+		character = state.characters.get(state.current_character_name)
+		assert character is not None
+		print(f"Default character set to: {character.name}")
 	else:
 		print("No characters found. The application may not function correctly.")
 
 
+def on_characters_changed(changed):
+	"""Called from the registry's watcher thread when characters are edited."""
+	if state.current_character_name not in state.characters:
+		keys = state.characters.keys()
+		state.current_character_name = keys[0] if keys else None
+	if state.current_character_name in changed:
+		update_image_for_state()
+
+
 def get_current_character() -> Dict[str, Any] | None:
 	"""Safely gets the config dictionary for the current character."""
 	if not state.current_character_name:
 		return None
-	return state.available_characters.get(state.current_character_name)
+	character = state.characters.get(state.current_character_name)
+	return character.config if character else None
 
 
 def get_system_prompt() -> str:
-	"""Generates the system prompt for the current character."""
-	character = get_current_character()
+	"""Returns the precomputed system prompt for the current character."""
+	if not state.current_character_name:
+		return "You are a helpful AI."  # Fallback
+	character = state.characters.get(state.current_character_name)
 	if not character:
 		return "You are a helpful AI."  # Fallback
-
-	char_name = character.get('name', 'AI')
-	# Dynamically get valid emotions from the character's image map
-	valid_emotions = [
-	    e for e in character.get('images', {}).keys()
-	    if e not in ['talking', 'listening', 'thinking']
-	]
-
-	return (
-	    f"You are a helpful, expressive AI character named {char_name}. "
-	    f"Respond in JSON object format with keys: 'text' (spoken output), and optional 'emotion'. "
-	    f"Valid emotions are: {valid_emotions}.\n"
-	    "Example response:\n"
-	    '{"text": "Hello! How can I help you today?", "emotion": "happy"}')
+	return character.system_prompt
 
 
 # --- File I/O & State Updates ---
@@ -127,24 +119,37 @@ def write_file(filepath, content):
 		print(f"Error writing to file {filepath}: {e}")
 
 
+def write_image(filepath, data: bytes):
+	"""Writes via a temp file so the display never reads a half-written PNG."""
+	try:
+		tmp_path = filepath + ".tmp"
+		with open(tmp_path, 'wb') as f:
+			f.write(data)
+		os.replace(tmp_path, filepath)
+	except Exception as e:
+		print(f"Error writing image {filepath}: {e}")
+
+
 def update_image_for_state(state_override=None):
 	"""Updates character image based on app state or emotion."""
-	character = get_current_character()
+	if not state.current_character_name:
+		return
+	character = state.characters.get(state.current_character_name)
 	if not character:
 		return
 
-	image_map = character.get('images', {})
-	current_emotion = character.get('emotion', 'neutral')
+	current_emotion = character.config.get('emotion', 'neutral')
 	image_key = state_override if state_override else current_emotion
-	image_path = image_map.get(image_key)
+	# Images are pre-scaled by the registry
+	image_data = character.images.get(image_key)
 
-	if image_path and os.path.exists(image_path):
-		shutil.copy(image_path, CURRENT_IMAGE_PATH)
+	if image_data:
+		write_image(CURRENT_IMAGE_PATH, image_data)
 		print(f"Updated image to: {image_key}")
 	else:
-		# Render text as a fallback image
-		print(f"Rendering fallback text for state: {image_key}")
-		write_file(CURRENT_IMAGE_PATH, image_key.upper())
+		# Keep showing the previous image until one has been generated
+		print(f"No image found for state: {image_key}")
+		image_queue.request(state.current_character_name, image_key)
 
 
 def update_character_state(new_state: str):
@@ -230,8 +235,7 @@ def process_interaction(audio_path: str):
 	# 1. Transcribe Audio
 	update_character_state("Transcribing...")
 	try:
-		transcription_result = stt.generate(audio_path, verbose=False)
-		user_text = transcription_result.text.strip()
+		user_text = stt.transcribe(audio_path)
 		if not user_text:
 			print("No speech detected in audio.")
 			update_character_state("Idle")
@@ -269,6 +273,9 @@ def process_interaction(audio_path: str):
 	# Update character's internal emotion state if a valid one was returned
 	if emotion and emotion in character.get('images', {}):
 		character['emotion'] = emotion
+	elif emotion and state.current_character_name:
+		# Rendered once we're idle, then picked up by the character registry
+		image_queue.request(state.current_character_name, emotion)
 
 	# 3. TTS Generation and Playback
 	update_character_state("Talking")
@@ -337,6 +344,8 @@ def main():
 
 	# Initialize components (can take a moment)
 	load_characters()
+	state.characters.watch(on_change=on_characters_changed)
+	image_queue.start()
 	llm.init()
 	stt.init()
 	tts.init()
@@ -369,6 +378,8 @@ def main():
 		# Stop the processing thread gracefully
 		state.processing_queue.put(None)
 		processing_thread.join()
+		state.characters.stop()
+		image_queue.stop()
 
 		llm.unload()
 		stt.unload()
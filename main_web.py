@@ -3,13 +3,13 @@ import os
 import time
 import threading
 import queue
-import shutil
+import random
 import asyncio
 from typing import List, Dict, Any
 import io
 
 # TODO
-# - Manage chat state (e.g. clear all, editing messages)
+# - Manage chat state (e.g. editing messages)
 # - Manage (section of) system prompt
 # - Change character's TTS voice (+ update its config)
 
@@ -25,10 +25,23 @@ from scipy.io.wavfile import write
 import numpy as np
 
 # --- Project Imports ---
+import config as cfg
 import lib.llm as llm
 import lib.stt as stt
 import lib.tts as tts
+import lib.models as models
 from lib.utils import get_local_ip
+from lib.audio import pcm16_to_float32, resample, decode_audio
+from lib.characters import CharacterRegistry
+from lib.history import ConversationHistory
+from lib.memory import MemoryStore
+from lib.cache import ResponseCache
+from lib.fillers import FillerBank, FillerTimer
+from lib.router import from_config as router_from_config
+from lib.deadline import (TurnBudget, LatencyStats, CHARS_PER_SECOND,
+                          generate_reply, first_sentences)
+from lib.wakeword import WakeWordListener
+from generate_character_images import BackgroundImageQueue
 
 # --- Configuration ---
 LLM_INPUT_FILE = "./data/llm_input.txt"
@@ -38,8 +51,36 @@ RECORDED_AUDIO_FILE = "./data/audio.wav"
 CURRENT_IMAGE_PATH = "./data/current_character_image.png"
 CHARACTERS_DIR = "./data/characters"
 PUSH_TO_TALK_KEY = keyboard.Key.alt_r
+# Hands-free: start a capture when the wake word is heard (see lib/wakeword.py)
+WAKE_WORD_ENABLED = False
+WAKE_WORDS = None  # Defaults to the current character's name
 SAMPLE_RATE = 16000
 CHANNELS = 1
+# Verbatim chat history kept in the prompt; older turns are summarized
+HISTORY_MAX_TOKENS = 1024
+# Long-term memory: past turns recalled by similarity and added to the prompt
+MEMORY_ENABLED = True
+MEMORY_TOP_K = 3
+# Reuse LLM replies for repeated lines. Off unless a character's config sets
+# "response_cache": true (e.g. for scripted scenes), since a cached reply
+# loses the variety of sampling
+REPLY_CACHE_DEFAULT = False
+# Reuse synthesized audio for repeated reply text; "audio_cache": false opts out
+AUDIO_CACHE_ENABLED = True
+TTS_SPEED = 1.2
+# Play a short pre-synthesized "hmm..." if reply audio takes longer than this
+FILLERS_ENABLED = True
+FILLER_DEADLINE_S = 1.5
+# Target seconds from releasing the button to the reply starting to play.
+# Stages degrade (fewer tokens, faster speech, shorter reply) to stay within it.
+TURN_SLO_S = 6.0
+MAX_TTS_SPEED = 1.6
+# Used when the LLM can't produce anything usable in time
+FALLBACK_REPLIES = [
+    "Hmm, you've stumped me there.",
+    "Oh, I'll have to get back to you on that one!",
+    "Let's just say it's complicated.",
+]
 
 
 # --- WebSocket Connection Manager ---
@@ -71,15 +112,34 @@ class AppState:
 		self.current_state = "Idle"
 		self.is_recording = False
 		self.audio_frames = []
+		# Remote (phone) capture: 'pcm16' frames go straight into audio_frames,
+		# encoded formats (webm/ogg Opus) are buffered and decoded on stop.
+		self.recording_source = "local"
+		self.remote_audio_format = "pcm16"
+		self.remote_sample_rate = SAMPLE_RATE
+		self.remote_audio_bytes = bytearray()
 		self.processing_queue = queue.Queue()
 		self.state_update_queue = asyncio.Queue()
 		self.qr_code_buffer: io.BytesIO | None = None
 
-		self.available_characters: Dict[str, Dict[str, Any]] = {}
+		self.characters = CharacterRegistry(CHARACTERS_DIR)
 		self.current_character_name: str | None = None
+		# Chat history per character, kept when switching back and forth
+		self.histories: Dict[str, ConversationHistory] = {}
+		self.memories: Dict[str, MemoryStore] = {}
+		self.loop: asyncio.AbstractEventLoop | None = None
 
 
 state = AppState()
+# Renders images for emotions the current character doesn't have yet
+image_queue = BackgroundImageQueue(
+    is_idle=lambda: state.current_state == "Idle")
+response_cache = ResponseCache()
+# Sends STT, LLM and TTS to other machines if config.STAGE_NODES lists any,
+# falling back to this process
+router = router_from_config()
+filler_bank = FillerBank(synthesize=router.synthesize)
+latency_stats = LatencyStats()
 app = FastAPI()
 
 
@@ -91,53 +151,120 @@ def load_characters():
 		print(f"Warning: Characters directory not found at {CHARACTERS_DIR}")
 		return
 
-	for char_name in os.listdir(CHARACTERS_DIR):
-		char_dir = os.path.join(CHARACTERS_DIR, char_name)
-		config_path = os.path.join(char_dir, "config.json")
-		if os.path.isdir(char_dir) and os.path.isfile(config_path):
-			try:
-				with open(config_path, 'r') as f:
-					config_data = json.load(f)
-					# Add a runtime state for the character's current emotion
-					config_data['emotion'] = 'neutral'
-					state.available_characters[char_name] = config_data
-					print(f"  - Loaded character: {config_data['name']}")
-			except Exception as e:
-				print(f"Error loading character '{char_name}': {e}")
-
-	if state.available_characters:
-		state.current_character_name = sorted(state.available_characters.keys())[0]
+	state.characters.refresh()
+
+	if len(state.characters):
+		state.current_character_name = state.characters.keys()[0]
 		print(f"Default character set to: {state.current_character_name}")
 	else:
 		print("No characters found. The application may not function correctly.")
 
 
+def on_characters_changed(changed: List[str]):
+	"""Called from the registry's watcher thread when characters are edited."""
+	with state.lock:
+		if state.current_character_name not in state.characters:
+			keys = state.characters.keys()
+			state.current_character_name = keys[0] if keys else None
+			print(f"Current character removed, now: {state.current_character_name}")
+	if state.current_character_name in changed:
+		update_image_for_state()
+	if FILLERS_ENABLED:
+		configs = [state.characters.get(k) for k in changed]
+		filler_bank.prepare_in_background([c.config for c in configs if c],
+		                                  TTS_SPEED)
+	if state.loop:
+		asyncio.run_coroutine_threadsafe(
+		    manager.broadcast({
+		        "type": "character_update",
+		        "character": get_public_character_data()
+		    }), state.loop)
+
+
 def get_current_character() -> Dict[str, Any] | None:
 	"""Safely gets the config dictionary for the current character."""
 	if not state.current_character_name:
 		return None
-	return state.available_characters.get(state.current_character_name)
+	character = state.characters.get(state.current_character_name)
+	return character.config if character else None
 
 
-def get_system_prompt() -> str:
-	"""Generates the system prompt for the current character."""
-	character = get_current_character()
+def get_system_prompt(memories: List[str] | None = None) -> str:
+	"""
+    Returns the precomputed system prompt for the current character,
+    plus any recalled memories.
+    """
+	if not state.current_character_name:
+		return "You are a helpful AI."  # Fallback
+	character = state.characters.get(state.current_character_name)
 	if not character:
 		return "You are a helpful AI."  # Fallback
+	if not memories:
+		return character.system_prompt
+	recalled = "\n".join(f"- {m}" for m in memories)
+	return (f"{character.system_prompt}\n\n"
+	        f"Things said earlier in the conversation that may be relevant:\n{recalled}")
+
+
+def generate_summary(input: str, **kwargs) -> str:
+	"""Summaries go through the router, so they run wherever the LLM does."""
+	return "".join(router.generate_stream(input, **kwargs))
+
+
+def get_history() -> ConversationHistory | None:
+	"""Gets (or creates) the chat history for the current character."""
+	char_name = state.current_character_name
+	if not char_name:
+		return None
+	with state.lock:
+		history = state.histories.get(char_name)
+		if history is None:
+			history = ConversationHistory(max_tokens=HISTORY_MAX_TOKENS,
+			                              generate=generate_summary)
+			state.histories[char_name] = history
+			history.start_background_summarizer(
+			    is_idle=lambda: state.current_state == "Idle")
+	return history
+
+
+def get_memory() -> MemoryStore | None:
+	"""Gets (or opens) the long-term memory for the current character."""
+	char_name = state.current_character_name
+	if not MEMORY_ENABLED or not char_name:
+		return None
+	with state.lock:
+		memory = state.memories.get(char_name)
+		if memory is None:
+			memory = MemoryStore(os.path.join(CHARACTERS_DIR, char_name))
+			state.memories[char_name] = memory
+	return memory
+
+
+def recall_memories(user_text: str, history: ConversationHistory | None) -> List[str]:
+	"""Finds the past turns most relevant to what the user just said."""
+	memory = get_memory()
+	if not memory:
+		return []
+	# Turns still in the verbatim history are already in the prompt
+	recent_turns = len(history.messages()) // 2 if history else 0
+	try:
+		results = memory.search(user_text,
+		                        k=MEMORY_TOP_K,
+		                        exclude_last=recent_turns)
+	except Exception as e:
+		print(f"Error searching memory: {e}")
+		return []
+	return [text for _, text in results]
 
-	char_name = character.get('name', 'AI')
-	# Dynamically get valid emotions, excluding non-emotional states
-	valid_emotions = [
-	    e for e in character.get('images', {}).keys()
-	    if e not in ['talking', 'listening', 'thinking']
-	]
 
-	return (
-	    f"You are a helpful, expressive AI character named {char_name}. "
-	    f"Respond in JSON object format with keys: 'text' (spoken output), and optional 'emotion'. "
-	    f"Valid emotions are: {valid_emotions}.\n"
-	    "Example response:\n"
-	    '{"text": "Hello! How can I help you today?", "emotion": "happy"}')
+def remember_turn(user_text: str, ai_text: str, char_name: str):
+	memory = get_memory()
+	if not memory:
+		return
+	try:
+		memory.add(f"User: {user_text} / {char_name}: {ai_text}")
+	except Exception as e:
+		print(f"Error saving to memory: {e}")
 
 
 async def switch_character(char_name: str):
@@ -145,7 +272,7 @@ async def switch_character(char_name: str):
 	should_update = False
 	with state.lock:
 		# The lock is only held for this small, critical section
-		if char_name in state.available_characters and char_name != state.current_character_name:
+		if char_name in state.characters and char_name != state.current_character_name:
 			print(f"Switching character to: {char_name}")
 			prev_char_config = get_current_character()
 			assert prev_char_config is not None
@@ -182,19 +309,30 @@ def write_file(filepath, content):
 		print(f"Error writing to file {filepath}: {e}")
 
 
+def write_image(filepath, data: bytes):
+	"""Writes via a temp file so the display never reads a half-written PNG."""
+	try:
+		tmp_path = filepath + ".tmp"
+		with open(tmp_path, 'wb') as f:
+			f.write(data)
+		os.replace(tmp_path, filepath)
+	except Exception as e:
+		print(f"Error writing image {filepath}: {e}")
+
+
 def update_image_for_state(state_override=None):
-	character = get_current_character()
+	if not state.current_character_name: return
+	character = state.characters.get(state.current_character_name)
 	if not character: return
 
-	image_map = character.get('images', {})
-	current_emotion = character.get('emotion', 'neutral')
+	current_emotion = character.config.get('emotion', 'neutral')
 	image_key = state_override if state_override else current_emotion
-	image_path = image_map.get(image_key)
+	image_data = character.images.get(image_key)
 
-	if image_path and os.path.exists(image_path):
-		shutil.copy(image_path, CURRENT_IMAGE_PATH)
+	if image_data:
+		write_image(CURRENT_IMAGE_PATH, image_data)
 	else:
-		print(f"No image found for state: {image_key} at path: {image_path}")
+		print(f"No image found for state: {image_key}")
 
 
 def update_character_state(new_state: str):
@@ -214,14 +352,34 @@ def update_character_state(new_state: str):
 stream = None
 
 
-def start_recording():
+def start_recording(source="local",
+                    audio_format="pcm16",
+                    sample_rate=SAMPLE_RATE,
+                    pre_roll: np.ndarray | None = None) -> bool:
+	"""
+    Starts a capture. With source="remote" no local input stream is opened;
+    audio arrives as binary WebSocket frames via add_remote_audio(). With
+    source="wake" it comes from the wake word listener, starting with pre_roll.
+    Returns False if a capture or turn is already in progress.
+    """
 	global stream
 	with state.lock:
-		if state.is_recording or state.current_state != "Idle": return
+		if state.is_recording or state.current_state != "Idle": return False
 		state.is_recording = True
-		state.audio_frames = []
+		state.audio_frames = [pre_roll] if pre_roll is not None else []
+		state.recording_source = source
+		state.remote_audio_format = audio_format
+		state.remote_sample_rate = int(sample_rate)
+		state.remote_audio_bytes = bytearray()
 	update_character_state("Listening")
 
+	if source == "remote":
+		print(f"Recording started (remote, {audio_format})...")
+		return True
+	if source == "wake":
+		print("Recording started (wake word)...")
+		return True
+
 	def audio_callback(indata, frames, time, status):
 		if status: print(f"Audio stream status: {status}")
 		with state.lock:
@@ -234,6 +392,34 @@ def start_recording():
 	                        dtype='float32')
 	stream.start()
 	print("Recording started...")
+	return True
+
+
+def add_remote_audio(data: bytes):
+	"""Appends a binary frame streamed from the remote page to the capture."""
+	with state.lock:
+		if not state.is_recording or state.recording_source != "remote":
+			return
+		if state.remote_audio_format == "pcm16":
+			frame = pcm16_to_float32(data)
+			if state.remote_sample_rate != SAMPLE_RATE:
+				frame = resample(frame, state.remote_sample_rate)
+			state.audio_frames.append(frame)
+		else:
+			state.remote_audio_bytes.extend(data)
+
+
+def add_wake_audio(frame: np.ndarray):
+	with state.lock:
+		if state.is_recording and state.recording_source == "wake":
+			state.audio_frames.append(frame)
+
+
+def get_wake_words() -> List[str]:
+	if WAKE_WORDS:
+		return WAKE_WORDS
+	character = get_current_character()
+	return [character['name']] if character else []
 
 
 def stop_recording():
@@ -248,22 +434,71 @@ def stop_recording():
 	print("Recording stopped.")
 	update_character_state("Processing")
 	with state.lock:
-		if not state.audio_frames:
-			print("No audio recorded.")
-			update_character_state("Idle")
-			return
-		audio_data = np.concatenate(state.audio_frames, axis=0)
+		encoded = bytes(state.remote_audio_bytes)
+		state.remote_audio_bytes = bytearray()
+	if encoded:
+		try:
+			with state.lock:
+				state.audio_frames.append(decode_audio(encoded))
+		except Exception as e:
+			print(f"Error decoding remote audio: {e}")
+	with state.lock:
+		frames = state.audio_frames
 		state.audio_frames = []
+	if not frames:
+		# update_character_state takes the lock, so this must happen outside it
+		print("No audio recorded.")
+		update_character_state("Idle")
+		return
+	audio_data = np.concatenate(frames, axis=0)
 	write(RECORDED_AUDIO_FILE, SAMPLE_RATE, audio_data)
 	state.processing_queue.put(RECORDED_AUDIO_FILE)
 
 
+wake_listener = WakeWordListener(
+    wake_words=get_wake_words,
+    on_wake=lambda pre_roll: start_recording("wake", pre_roll=pre_roll),
+    on_audio=add_wake_audio,
+    on_end=stop_recording,
+    is_idle=lambda: state.current_state == "Idle" and not state.is_recording)
+
+
 # --- Core Logic ---
+def plan_tts(budget: TurnBudget, text: str, voice: str, speed: float,
+             character: Dict[str, Any]):
+	"""
+    Picks what to speak and how, so synthesis fits in the TTS budget going by
+    recent real-time factors: first a faster speed/voice, then a shorter reply.
+    """
+	tts_budget = budget.stage_budget('tts')
+	expected = latency_stats.expected_tts_seconds(text, speed)
+	if expected <= tts_budget:
+		return text, voice, speed
+
+	new_speed = min(MAX_TTS_SPEED, speed * 1.25)
+	new_voice = character.get('fast_voice', voice)
+	if new_speed != speed or new_voice != voice:
+		budget.degrade('tts', f"speed {speed:.2f}->{new_speed:.2f}, voice {new_voice}",
+		               f"expected {expected:.2f}s > {tts_budget:.2f}s")
+		voice, speed = new_voice, new_speed
+		expected = latency_stats.expected_tts_seconds(text, speed)
+
+	if expected > tts_budget and latency_stats.tts_rtf:
+		max_chars = int(tts_budget / latency_stats.tts_rtf * CHARS_PER_SECOND * speed)
+		trimmed = first_sentences(text, max(40, max_chars))
+		if len(trimmed) < len(text):
+			budget.degrade('tts', f"reply trimmed to {len(trimmed)} chars",
+			               f"expected {expected:.2f}s > {tts_budget:.2f}s")
+			text = trimmed
+	return text, voice, speed
+
+
 def process_interaction(audio_path: str):
+	budget = TurnBudget(slo=TURN_SLO_S)
 	update_character_state("Transcribing...")
 	try:
-		transcription_result = stt.generate(audio_path, verbose=False)
-		user_text = transcription_result.text.strip()
+		user_text = router.transcribe(audio_path)
+		budget.record('stt', budget.elapsed())
 		if not user_text:
 			print("No speech detected in audio.")
 			update_character_state("Idle")
@@ -283,41 +518,110 @@ def process_interaction(audio_path: str):
 		update_character_state("Idle")
 		return
 
+	voice = character.get('voice', 'af_heart')
+	speed = character.get('speed', TTS_SPEED)
+	filler = None
+	if FILLERS_ENABLED:
+		filler = FillerTimer(filler_bank, voice, speed, character.get('fillers'),
+		                     FILLER_DEADLINE_S)
+		filler.start()
+
+	history = get_history()
+	char_key = state.current_character_name or ''
+	use_cache = character.get('response_cache', REPLY_CACHE_DEFAULT)
+	# Keyed on the character's base prompt and the reply being answered, not
+	# the whole history/memories, so scripted lines hit across a rehearsal
+	# while "yes" or "why?" only hit after the same line
+	base_prompt = get_system_prompt()
+	last_reply = history.last_reply() if history else ''
+	raw_response = response_cache.get_reply(
+	    user_text, char_key, base_prompt, last_reply) if use_cache else None
+	is_fallback = False
 	try:
-		raw_response = llm.generate(user_text,
-		                            sys_input=get_system_prompt(),
-		                            json=True)
-		parsed = json.loads(raw_response)
+		if raw_response is not None:
+			print("[Cache] Reply hit")
+			parsed = json.loads(raw_response)
+		else:
+			memories = recall_memories(user_text, history)
+			parsed = generate_reply(
+			    budget,
+			    latency_stats,
+			    user_text,
+			    sys_input=get_system_prompt(memories) +
+			    (history.system_context() if history else ''),
+			    history=history.messages() if history else None,
+			    tts_reserve=budget.budgets['tts'],
+			    generate_stream=router.generate_stream)
+			if parsed is None:
+				budget.degrade('llm', "used a fallback reply",
+				               "nothing usable within budget")
+				parsed = {'text': random.choice(FALLBACK_REPLIES), 'emotion': None}
+				is_fallback = True
+			raw_response = json.dumps(parsed)
+			# Degraded replies aren't worth repeating from the cache
+			if use_cache and parsed.get('text') and not budget.degradations:
+				response_cache.set_reply(user_text, char_key, base_prompt,
+				                         raw_response, last_reply)
 		ai_text = parsed.get('text', '')
 		emotion = parsed.get('emotion', None)
+		if history:
+			history.add_turn(user_text, raw_response)
 	except Exception as e:
 		print(f"Error parsing LLM response: {e}")
 		ai_text = "I'm sorry, something went wrong."
 		emotion = None
+		is_fallback = True
+
+	ai_text, voice, speed = plan_tts(budget, ai_text, voice, speed, character)
 
 	write_file(LLM_OUTPUT_FILE, ai_text)
 	if emotion and emotion in character.get('images', {}):
 		character['emotion'] = emotion
+	elif emotion and state.current_character_name:
+		# Rendered once we're idle, then picked up by the character registry
+		image_queue.request(state.current_character_name, emotion)
 
 	update_character_state("Talking")
-	tts_audio_path = "./data/output.wav"
+	# Fallback lines are always cached, so they play instantly next time
+	cache_audio = character.get('audio_cache', AUDIO_CACHE_ENABLED) or is_fallback
 	try:
-		tts.generate(ai_text,
-		             output_path=tts_audio_path,
-		             voice=character.get('voice', 'af_heart'))
+		# Keyed on the engine too, so switching engines or nodes doesn't replay old audio
+		engine = router.tts_engine() if cache_audio else None
+		cached_audio = response_cache.get_audio(ai_text, voice, speed,
+		                                        *engine) if engine else None
+		if cached_audio is not None:
+			print("[Cache] Audio hit")
+			data, samplerate = cached_audio
+		else:
+			tts_start = time.time()
+			data, samplerate = router.synthesize(ai_text, voice=voice, speed=speed)
+			tts_seconds = time.time() - tts_start
+			budget.record('tts', tts_seconds)
+			latency_stats.record_tts(tts_seconds, len(data) / samplerate)
+			# The engine that actually answered, which failover may have changed
+			engine = router.tts_engine() if cache_audio else None
+			if engine and engine[1] == samplerate:
+				response_cache.set_audio(ai_text, voice, speed, engine[0], data,
+				                         samplerate)
 	except Exception as e:
 		print(f"Error generating TTS: {e}")
+		if filler:
+			filler.finish()
 		update_character_state("Idle")
 		return
 
+	if filler:
+		# Lets a filler that already started finish instead of cutting it off
+		filler.finish()
+	print(budget.summary())
 	try:
-		import soundfile as sf
-		data, samplerate = sf.read(tts_audio_path, dtype='float32')
 		sd.play(data, samplerate)
 		sd.wait()
 	except Exception as e:
 		print(f"Error playing audio: {e}")
 
+	# Embedding happens after playback so it doesn't add to the response time
+	remember_turn(user_text, ai_text, character.get('name', 'AI'))
 	update_character_state("Idle")
 	print("\nReady for next interaction.")
 
@@ -343,10 +647,10 @@ def on_release(key):
 def get_public_character_data():
 	"""Returns a dictionary of public-facing character data."""
 	all_chars = {}
-	for char_key, char_data in state.available_characters.items():
+	for char_key, character in state.characters.items():
 		all_chars[char_key] = {
-		    "name": char_data.get("name"),
-		    "voice": char_data.get("voice")
+		    "name": character.config.get("name"),
+		    "voice": character.config.get("voice")
 		}
 	return {"available": all_chars, "current": state.current_character_name}
 
@@ -356,6 +660,39 @@ async def get_characters():
 	return get_public_character_data()
 
 
+def get_model_data() -> Dict[str, Any]:
+	"""The loaded model, any swap in progress, and the models configured to swap to."""
+	available = [getattr(cfg, 'LANGUAGE_MODEL', None)] + list(
+	    getattr(cfg, 'LANGUAGE_MODELS', []))
+	return {
+	    **llm.model_info(), "available":
+	    [m for i, m in enumerate(available) if m and m not in available[:i]]
+	}
+
+
+def on_model_swapped(ok: bool, error: str | None):
+	"""Called from lib.llm's loading thread when a model swap finishes."""
+	if ok:
+		print(f"Model swapped to {llm.model_path_loaded}")
+	if state.loop:
+		asyncio.run_coroutine_threadsafe(
+		    manager.broadcast({
+		        "type": "model_update",
+		        "model": get_model_data()
+		    }), state.loop)
+
+
+@app.get("/api/models", response_class=JSONResponse)
+async def get_models():
+	return get_model_data()
+
+
+@app.get("/api/router", response_class=JSONResponse)
+async def get_router_status():
+	"""The backends each stage is routed to, in order, and which are healthy."""
+	return router.status()
+
+
 @app.get("/", response_class=HTMLResponse)
 async def get_remote_control():
 	with open("remote_control/templates/index.html") as f:
@@ -373,18 +710,50 @@ async def websocket_endpoint(websocket: WebSocket):
 	    "type": "character_update",
 	    "character": get_public_character_data()
 	})
+	await websocket.send_json({"type": "model_update", "model": get_model_data()})
 	try:
 		while True:
-			data = await websocket.receive_json()
+			message = await websocket.receive()
+			if message["type"] == "websocket.disconnect":
+				raise WebSocketDisconnect(message.get("code", 1000))
+			if message.get("bytes") is not None:
+				# Binary frames are microphone audio streamed from the remote
+				add_remote_audio(message["bytes"])
+				continue
+			data = json.loads(message.get("text") or "{}")
 			action = data.get("action")
 			if action == "start_recording":
-				start_recording()
+				if data.get("source") == "remote":
+					start_recording("remote",
+					                data.get("format", "pcm16"),
+					                data.get("sample_rate", SAMPLE_RATE))
+				else:
+					start_recording()
 			elif action == "stop_recording":
 				stop_recording()
+			elif action == "clear_history":
+				history = get_history()
+				if history:
+					history.clear()
+					print("Chat history cleared.")
 			elif action == "switch_character":
 				char_name = data.get("character")
 				if char_name:
 					await switch_character(char_name)
+			elif action == "swap_model":
+				model_path = data.get("model_path")
+				# Only the configured models; any other path is ignored, so a
+				# client can't make this process open arbitrary files
+				if model_path not in get_model_data()["available"]:
+					print(f"Ignoring swap to unconfigured model {model_path!r}")
+				elif model_path != llm.model_path_loaded:
+					# The current model keeps answering until the new one is ready
+					if llm.swap_model(model_path, on_done=on_model_swapped):
+						print(f"Loading model {model_path} in the background...")
+					await manager.broadcast({
+					    "type": "model_update",
+					    "model": get_model_data()
+					})
 	except WebSocketDisconnect:
 		manager.disconnect(websocket)
 		print("Client disconnected")
@@ -404,10 +773,19 @@ def startup_event():
 	print("Starting AI Improv (Web Remote Mode)...")
 	load_characters()
 
-	llm.init()
-	stt.init()
-	tts.init()
+	# Token counting only needs the tokenizer, and summaries go through the
+	# router, so a remote LLM isn't loaded here
+	if not router.is_remote('llm'):
+		models.manager.load('llm')
+	if not router.is_remote('stt'):
+		models.manager.load('stt')
+	if not router.is_remote('tts'):
+		models.manager.load('tts')
+	router.start_health_checks()
 	print("LLM, STT, and TTS models initialized.")
+	if FILLERS_ENABLED:
+		filler_bank.prepare_in_background(
+		    [c.config for _, c in state.characters.items()], TTS_SPEED)
 
 	write_file(LLM_INPUT_FILE, "")
 	write_file(LLM_OUTPUT_FILE, "")
@@ -416,6 +794,11 @@ def startup_event():
 	threading.Thread(target=processing_worker, daemon=True).start()
 	keyboard.Listener(on_press=on_press, on_release=on_release).start()
 	asyncio.create_task(state_updater())
+	state.loop = asyncio.get_event_loop()
+	state.characters.watch(on_change=on_characters_changed)
+	image_queue.start()
+	if WAKE_WORD_ENABLED:
+		wake_listener.start()
 
 	# --- Server Info & QR Code ---
 	HOST = "0.0.0.0"
@@ -425,6 +808,8 @@ def startup_event():
 
 	print("-" * 50)
 	print(f"Hold the '{PUSH_TO_TALK_KEY}' key to record your voice.")
+	if WAKE_WORD_ENABLED:
+		print(f"Or just say {' or '.join(get_wake_words())!r}.")
 	print(f"Or open http://127.0.0.1:{PORT} in your browser.")
 	if local_ip != '127.0.0.1':
 		print(f"On other devices on the same network, open: {server_url}")
@@ -453,9 +838,17 @@ def startup_event():
 def shutdown_event():
 	print("\nShutting down.")
 	state.processing_queue.put(None)
+	state.characters.stop()
+	image_queue.stop()
+	if WAKE_WORD_ENABLED:
+		wake_listener.stop()
+	response_cache.close()
+	router.stop()
 	llm.unload()
-	stt.unload()
-	tts.unload()
+	if not router.is_remote('stt'):
+		stt.unload()
+	if not router.is_remote('tts'):
+		tts.unload()
 	write_file(APP_STATE_FILE, "Offline")
 	print("Application stopped.")
 
@@ -171,8 +171,7 @@ def stop_recording():
 def process_interaction(audio_path: str):
 	update_character_state("Transcribing...")
 	try:
-		transcription_result = stt.generate(audio_path, verbose=False)
-		user_text = transcription_result.text.strip()
+		user_text = stt.transcribe(audio_path)
 		if not user_text:
 			print("No speech detected in audio.")
 			update_character_state("Idle")
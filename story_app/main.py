@@ -1,9 +1,22 @@
 import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from typing import IO, Any, Dict, List
 from llama_cpp import Llama
-from openai.types.chat import ChatCompletion
+from openai.types.chat import ChatCompletionChunk
 
 # --- PROMPT ENGINEERING ---
 # These prompts define the "brains" of our multi-step process.
+# Both stages share the system prompt and the planning conversation, so the
+# writing stage's prompt starts with exactly the tokens already in the KV cache
+# and llama.cpp only has to prefill the new instruction.
+
+SYSTEM_PROMPT = "You are an expert storyteller, plot designer and master fiction writer."
 
 PLANNING_PROMPT_TEMPLATE = """
 You are an expert storyteller and plot designer. Your task is to create a detailed, structured plan for a story based on the user's request.
@@ -26,101 +39,373 @@ Here is the user's request:
 ---
 """
 
-WRITING_PROMPT_TEMPLATE = """
-You are a master fiction writer. Your task is to write a complete, engaging short story based on the provided plan and the original user request.
+ACT_PROMPT_TEMPLATE = """
+You are a master fiction writer. You are writing an engaging short story based on the plan above and the original user request, one act at a time.
 
 Follow the plan closely to ensure all key plot points, character arcs, and themes are included. Write in a compelling narrative style, using vivid descriptions, strong character voices, and emotional depth.
 
-This is the original user request for context:
----
-{user_prompt}
----
+{story_so_far}
 
-This is the detailed story plan you must follow:
---- STORY PLAN ---
-{story_plan}
---- END OF PLAN ---
+Now write {act_label} of the story, covering:
+{act_outline}
 
-Now, write the full, captivating story.
+Write only this act's prose, continuing seamlessly from the story so far. Do not add headings or commentary.
 """
 
+SUMMARY_PROMPT = """
+Summarize the story written so far (including the act you just wrote) in one or two short paragraphs. Keep the names, key events, open threads and the emotional state of each character, so the next act can continue from it. Reply with only the summary.
+"""
 
-def generate_story_plan(llm: Llama, user_prompt: str) -> str:
+# Token budgeting against n_ctx
+ACT_MAX_TOKENS = 2048  # Upper bound for a single act
+MIN_ACT_TOKENS = 256  # Below this, an act isn't worth generating
+SUMMARY_MAX_TOKENS = 384
+MESSAGE_OVERHEAD_TOKENS = 8  # Chat template tokens around each message
+CONTEXT_MARGIN_TOKENS = 32
+
+
+def stream_completion(llm: Llama,
+                      messages: list,
+                      max_tokens: int,
+                      temperature: float,
+                      out: IO[str] | None = None,
+                      stats: Dict[str, Any] | None = None,
+                      echo: bool = True) -> str:
+	"""
+    Streams a chat completion to the console (unless echo is False) and `out`,
+    if given, as it is generated. Returns the full, unstripped text.
+    If `stats` is given, the token count and generation time are added to it.
+    """
+	start = time.time()
+	n_tokens = 0
+	stream = llm.create_chat_completion_openai_v1(
+	    messages=messages,
+	    max_tokens=max_tokens,
+	    temperature=temperature,
+	    stream=True,
+	)
+	parts = []
+	for chunk in stream:
+		assert isinstance(chunk, ChatCompletionChunk)
+		content = chunk.choices[0].delta.content
+		if not content:
+			continue
+		# llama.cpp streams one chunk per generated token
+		n_tokens += 1
+		parts.append(content)
+		if echo:
+			sys.stdout.write(content)
+			sys.stdout.flush()
+		if out:
+			out.write(content)
+			out.flush()
+	if echo:
+		print()
+	if stats is not None:
+		stats["tokens"] = stats.get("tokens", 0) + n_tokens
+		stats["seconds"] = stats.get("seconds", 0.0) + time.time() - start
+	return "".join(parts)
+
+
+def count_tokens(llm: Llama, messages: list) -> int:
+	"""Counts the prompt tokens for `messages`, approximating the chat template overhead."""
+	total = 0
+	for message in messages:
+		total += len(llm.tokenize(message["content"].encode("utf-8"),
+		                          add_bos=False,
+		                          special=True))
+		total += MESSAGE_OVERHEAD_TOKENS
+	return total
+
+
+def completion_budget(llm: Llama, messages: list, max_tokens: int) -> int:
+	"""How many tokens can be generated for `messages` without overflowing n_ctx."""
+	available = llm.n_ctx() - count_tokens(llm, messages) - CONTEXT_MARGIN_TOKENS
+	return min(max_tokens, available)
+
+
+def split_acts(story_plan: str) -> List[str]:
 	"""
-    Generates a structured story plan using the LLM.
+    Extracts each act's outline from the plan's three-act structure.
+    Falls back to the whole plan as a single section if no acts are found.
+    """
+	starts = []
+	seen = set()
+	for match in re.finditer(r"\bAct\s+(\d+|I{1,3})\b", story_plan):
+		if match.group(1) not in seen:  # e.g. "Act 1" mentioned again later on
+			seen.add(match.group(1))
+			starts.append(match.start())
+	acts = []
+	for i, start in enumerate(starts):
+		if i + 1 < len(starts):
+			section = story_plan[start:starts[i + 1]]
+		else:
+			# The last act ends where the next top-level (unindented) numbered
+			# section or heading of the plan starts, keeping its own beats
+			section = re.split(r"\n(?:\d+\.|#+)\s", story_plan[start:])[0]
+		acts.append(section.strip(" *:\n"))
+	return acts or [story_plan.strip()]
+
+
+def planning_messages(user_prompt: str) -> list:
+	return [{
+	    "role": "system",
+	    "content": SYSTEM_PROMPT
+	}, {
+	    "role": "user",
+	    "content": PLANNING_PROMPT_TEMPLATE.format(user_prompt=user_prompt)
+	}]
+
+
+def generate_story_plan(llm: Llama,
+                        user_prompt: str,
+                        out: IO[str] | None = None,
+                        stats: Dict[str, Any] | None = None) -> str:
+	"""
+    Generates a structured story plan using the LLM, streaming it as it goes.
 
     Args:
         llm: An initialized Llama object.
         user_prompt: The user's initial story idea.
+        out: Optional file to stream the plan into.
+        stats: Optional dict to record token count and time in.
 
     Returns:
-        A string containing the generated story plan.
+        A string containing the generated story plan (unstripped, so the
+        writing stage can reuse its tokens from the KV cache).
     """
 	print(">>> Stage 1: Generating story plan...")
 
-	# We use a system prompt to set the role and a user prompt for the task
-	messages = [{
-	    "role": "system",
-	    "content": "You are an expert storyteller and plot designer."
-	}, {
-	    "role":
-	    "user",
-	    "content":
-	    PLANNING_PROMPT_TEMPLATE.format(user_prompt=user_prompt)
-	}]
-
-	response = llm.create_chat_completion_openai_v1(
-	    messages=messages,
+	plan = stream_completion(
+	    llm,
+	    planning_messages(user_prompt),
 	    max_tokens=1024,  # Allow enough tokens for a detailed plan
 	    temperature=0.7,
-	)
-	assert isinstance(response, ChatCompletion)
-	assert response.choices[0].message.content
+	    out=out,
+	    stats=stats)
+	assert plan.strip()
 
-	plan = response.choices[0].message.content.strip()
 	print("...Plan generated successfully.\n")
 	return plan
 
 
-def generate_story_from_plan(llm: Llama, user_prompt: str,
-                             story_plan: str) -> str:
+def generate_story_from_plan(llm: Llama,
+                             user_prompt: str,
+                             story_plan: str,
+                             out: IO[str] | None = None,
+                             stats: Dict[str, Any] | None = None) -> str:
 	"""
-    Generates the full story based on the provided plan.
+    Generates the full story based on the provided plan, one act at a time,
+    streaming it as it goes.
+
+    Each act's prompt holds only the plan and a rolling summary of the story so
+    far, and its completion budget is checked against n_ctx, so prompt size and
+    prefill cost stay bounded however long the story gets. Prompts continue the
+    planning conversation (plan as the assistant's turn), so that shared prefix
+    is reused from the KV cache instead of prefilled.
 
     Args:
         llm: An initialized Llama object.
         user_prompt: The user's original story idea.
         story_plan: The plan generated in the first stage.
+        out: Optional file to stream the story into.
+        stats: Optional dict to record token count and time in.
 
     Returns:
         A string containing the final story.
     """
-	print(">>> Stage 2: Writing the full story from the plan...")
+	print(">>> Stage 2: Writing the full story from the plan, act by act...")
 
-	messages = [{
-	    "role": "system",
-	    "content": "You are a master fiction writer."
-	}, {
-	    "role":
-	    "user",
-	    "content":
-	    WRITING_PROMPT_TEMPLATE.format(user_prompt=user_prompt,
-	                                   story_plan=story_plan)
+	prefix = planning_messages(user_prompt) + [{
+	    "role": "assistant",
+	    "content": story_plan
 	}]
+	acts = split_acts(story_plan)
+	summary = ""
+	written = []
+	for i, act_outline in enumerate(acts, 1):
+		act_label = f"Act {i} of {len(acts)}" if len(acts) > 1 else "the whole story"
+		story_so_far = (f"Summary of the story so far:\n{summary}"
+		                if summary else "This is the beginning of the story.")
+		act_request = {
+		    "role":
+		    "user",
+		    "content":
+		    ACT_PROMPT_TEMPLATE.format(story_so_far=story_so_far,
+		                               act_label=act_label,
+		                               act_outline=act_outline)
+		}
+		messages = prefix + [act_request]
+		budget = completion_budget(llm, messages, ACT_MAX_TOKENS)
+		if budget < MIN_ACT_TOKENS:
+			raise ValueError(
+			    f"Not enough context left for {act_label} ({budget} tokens); increase n_ctx or shorten the plan."
+			)
+
+		print(f"\n>>> Writing {act_label} (up to {budget} tokens)...")
+		if out and written:
+			out.write("\n\n")
+		act_text = stream_completion(
+		    llm,
+		    messages,
+		    max_tokens=budget,
+		    temperature=0.8,  # Slightly higher temp for more creative writing
+		    out=out,
+		    stats=stats)
+		written.append(act_text.strip())
+
+		if i == len(acts):
+			break
+
+		# Fold this act into the rolling summary. Continuing the same conversation
+		# means the act is already in the KV cache and only this request is prefilled.
+		summary_messages = messages + [{
+		    "role": "assistant",
+		    "content": act_text
+		}, {
+		    "role": "user",
+		    "content": SUMMARY_PROMPT
+		}]
+		summary_budget = completion_budget(llm, summary_messages,
+		                                   SUMMARY_MAX_TOKENS)
+		if summary_budget < SUMMARY_MAX_TOKENS // 4:
+			# No room to summarize in context; keep the previous summary plus the act's outline
+			summary = f"{summary}\n{act_outline}".strip()
+			continue
+		summary = stream_completion(llm,
+		                            summary_messages,
+		                            max_tokens=summary_budget,
+		                            temperature=0.3,
+		                            echo=False).strip()
+
+	story = "\n\n".join(written)
+	assert story.strip()
 
-	response = llm.create_chat_completion_openai_v1(
-	    messages=messages,
-	    max_tokens=4096,  # Allow more tokens for the full story
-	    temperature=0.8,  # Slightly higher temp for more creative writing
-	)
-	assert isinstance(response, ChatCompletion)
-	assert response.choices[0].message.content
-
-	story = response.choices[0].message.content.strip()
 	print("...Story generation complete.\n")
 	return story
 
 
+def tokens_per_second(stats: Dict[str, Any]) -> float:
+	return stats["tokens"] / stats["seconds"] if stats.get("seconds") else 0.0
+
+
+def load_checkpoint(path: str | None,
+                    user_prompt: str,
+                    source: str | None = None) -> Dict[str, Any]:
+	"""Returns the saved progress for this prompt file, or an empty checkpoint."""
+	if not path or not os.path.exists(path):
+		return {}
+	try:
+		with open(path, 'r', encoding='utf-8') as f:
+			checkpoint = json.load(f)
+	except (OSError, ValueError):
+		return {}
+	# Another prompt file's progress, or the prompt file was edited since, so start over
+	if checkpoint.get("source") != source or checkpoint.get("prompt") != user_prompt:
+		return {}
+	return checkpoint
+
+
+def save_checkpoint(path: str | None, checkpoint: Dict[str, Any]):
+	if not path:
+		return
+	tmp_path = path + ".tmp"
+	with open(tmp_path, 'w', encoding='utf-8') as f:
+		json.dump(checkpoint, f, indent=2)
+	os.replace(tmp_path, path)
+
+
+def run_job(llm: Llama,
+            user_prompt: str,
+            output_path: str,
+            checkpoint_path: str | None,
+            source: str | None = None) -> Dict[str, Any]:
+	"""
+    Runs both stages for one prompt, writing to output_path as it streams.
+    Progress is checkpointed after each stage; finished stages are not redone.
+    Returns the checkpoint, including per-stage stats. `source` is the prompt
+    file's path, so a checkpoint is only resumed for the file that made it.
+    """
+	checkpoint = load_checkpoint(checkpoint_path, user_prompt, source)
+	checkpoint["source"] = source
+	checkpoint["prompt"] = user_prompt
+	checkpoint.setdefault("stats", {})
+
+	print(
+	    f"--- Using Initial Prompt ---\n{user_prompt}\n---------------------------\n"
+	)
+
+	# Output is written to the file as it streams, so progress is visible there too
+	with open(output_path, "w", encoding='utf-8') as f:
+		f.write("--- INITIAL PROMPT ---\n")
+		f.write(user_prompt + "\n\n")
+		f.write("--- GENERATED STORY PLAN ---\n")
+		f.flush()
+
+		print("--- Generated Story Plan ---")
+		if "plan" in checkpoint:
+			print(">>> Stage 1: Plan restored from checkpoint.")
+			story_plan = checkpoint["plan"]
+			print(story_plan)
+			f.write(story_plan)
+		else:
+			stats: Dict[str, Any] = {}
+			story_plan = generate_story_plan(llm, user_prompt, out=f, stats=stats)
+			checkpoint["plan"] = story_plan
+			checkpoint["stats"]["plan"] = stats
+			save_checkpoint(checkpoint_path, checkpoint)
+		print("--------------------------\n")
+
+		f.write("\n\n--- FINAL STORY ---\n")
+		f.flush()
+
+		print("--- Final Generated Story ---")
+		if "story" in checkpoint:
+			print(">>> Stage 2: Story restored from checkpoint.")
+			print(checkpoint["story"])
+			f.write(checkpoint["story"])
+		else:
+			stats = {}
+			checkpoint["story"] = generate_story_from_plan(llm,
+			                                               user_prompt,
+			                                               story_plan,
+			                                               out=f,
+			                                               stats=stats)
+			checkpoint["stats"]["story"] = stats
+			save_checkpoint(checkpoint_path, checkpoint)
+		print("---------------------------\n")
+		f.write("\n")
+
+	return checkpoint
+
+
+def output_name(prompt_file: str) -> str:
+	"""
+    A per-prompt-file name for batch outputs: the file name plus a short hash
+    of its full path, so a.txt and a.md, or two a.txt files in different
+    directories, don't share a story or a checkpoint.
+    """
+	source = os.path.abspath(prompt_file)
+	digest = hashlib.sha1(source.encode('utf-8')).hexdigest()[:8]
+	return f"{os.path.basename(prompt_file)}.{digest}"
+
+
+def collect_prompt_files(inputs: List[str]) -> List[str]:
+	"""Expands directories (their *.txt files) and glob patterns into prompt files."""
+	files = []
+	for item in inputs:
+		if os.path.isdir(item):
+			matches = sorted(glob.glob(os.path.join(item, "*.txt")))
+		elif glob.has_magic(item):
+			matches = sorted(glob.glob(item))
+		else:
+			matches = [item]
+		for path in matches:
+			if path not in files:
+				files.append(path)
+	return files
+
+
 def main():
 	"""Main function to run the story generation script."""
 	parser = argparse.ArgumentParser(
@@ -131,15 +416,35 @@ def main():
 	                    required=True,
 	                    help="Path to the GGUF model file.")
 	parser.add_argument(
-	    "prompt_file", help="Path to the text file containing the story prompt.")
+	    "prompt_files",
+	    nargs="+",
+	    help=
+	    "Text file(s) containing story prompts. Directories and glob patterns\n"
+	    "(e.g. 'prompts/*.txt') are expanded; more than one prompt runs in batch mode."
+	)
 	parser.add_argument("-c",
 	                    "--n_ctx",
 	                    type=int,
 	                    default=8192,
 	                    help="Context size for the model (default: 8192).")
+	parser.add_argument(
+	    "-o",
+	    "--output_dir",
+	    default=None,
+	    help="Batch mode: directory for per-prompt stories and checkpoints\n"
+	    "(default: generated_stories). A re-run resumes unfinished prompts.")
 	args = parser.parse_args()
 
-	# --- 1. Load the LLM ---
+	prompt_files = collect_prompt_files(args.prompt_files)
+	if not prompt_files:
+		print("Error: No prompt files found.")
+		return
+	batch = len(prompt_files) > 1 or args.output_dir is not None
+	output_dir = args.output_dir or "generated_stories"
+	if batch:
+		os.makedirs(output_dir, exist_ok=True)
+
+	# --- 1. Load the LLM (once, for every prompt) ---
 	print(f"Loading model from: {args.model}")
 
 	try:
@@ -151,43 +456,56 @@ def main():
 		print(f"Error loading model: {e}")
 		return
 
-	# --- 2. Read the user's prompt from the file ---
-	try:
-		with open(args.prompt_file, 'r', encoding='utf-8') as f:
-			user_prompt = f.read().strip()
-	except FileNotFoundError:
-		print(f"Error: Prompt file not found at '{args.prompt_file}'")
-		return
-	except Exception as e:
-		print(f"Error reading prompt file: {e}")
-		return
-
-	print(
-	    f"--- Using Initial Prompt ---\n{user_prompt}\n---------------------------\n"
-	)
-
-	# --- 3. Execute the multi-step generation process ---
-	story_plan = generate_story_plan(llm, user_prompt)
-
-	print("--- Generated Story Plan ---")
-	print(story_plan)
-	print("--------------------------\n")
-
-	final_story = generate_story_from_plan(llm, user_prompt, story_plan)
-
-	print("--- Final Generated Story ---")
-	print(final_story)
-	print("---------------------------\n")
-
-	# --- 4. Save the output to a file ---
-	with open("generated_story.txt", "w", encoding='utf-8') as f:
-		f.write("--- INITIAL PROMPT ---\n")
-		f.write(user_prompt + "\n\n")
-		f.write("--- GENERATED STORY PLAN ---\n")
-		f.write(story_plan + "\n\n")
-		f.write("--- FINAL STORY ---\n")
-		f.write(final_story + "\n")
-	print("Story and plan have been saved to 'generated_story.txt'")
+	results = []
+	for i, prompt_file in enumerate(prompt_files, 1):
+		if batch:
+			print(f"\n=== Job {i}/{len(prompt_files)}: {prompt_file} ===")
+
+		# --- 2. Read the user's prompt from the file ---
+		try:
+			with open(prompt_file, 'r', encoding='utf-8') as f:
+				user_prompt = f.read().strip()
+		except FileNotFoundError:
+			print(f"Error: Prompt file not found at '{prompt_file}'")
+			continue
+		except Exception as e:
+			print(f"Error reading prompt file: {e}")
+			continue
+
+		if batch:
+			name = output_name(prompt_file)
+			output_path = os.path.join(output_dir, f"{name}.story.txt")
+			checkpoint_path = os.path.join(output_dir, f"{name}.checkpoint.json")
+		else:
+			output_path = "generated_story.txt"
+			checkpoint_path = None
+
+		# --- 3. Execute the multi-step generation process ---
+		try:
+			checkpoint = run_job(llm, user_prompt, output_path, checkpoint_path,
+			                     os.path.abspath(prompt_file))
+		except Exception as e:
+			# Keep going; the checkpoint lets this prompt resume on the next run
+			print(f"Error generating story for '{prompt_file}': {e}")
+			continue
+
+		for stage in ("plan", "story"):
+			stats = checkpoint["stats"].get(stage)
+			if stats:
+				print(
+				    f"[{stage}] {stats['tokens']} tokens in {stats['seconds']:.1f}s ({tokens_per_second(stats):.1f} tokens/sec)"
+				)
+		print(f"Story and plan have been saved to '{output_path}'")
+		results.append((prompt_file, checkpoint))
+
+	if batch:
+		print(f"\n=== Batch complete: {len(results)}/{len(prompt_files)} stories ===")
+		for prompt_file, checkpoint in results:
+			rates = [
+			    f"{stage} {tokens_per_second(checkpoint['stats'][stage]):.1f} tok/s"
+			    for stage in ("plan", "story") if stage in checkpoint["stats"]
+			]
+			print(f"  {prompt_file}: {', '.join(rates) or 'restored'}")
 
 
 if __name__ == "__main__":
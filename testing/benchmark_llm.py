@@ -0,0 +1,133 @@
+"""
+Compares reply decoding speed with and without speculative decoding.
+
+Run from the project root, e.g.:
+    python -m testing.benchmark_llm
+    python -m testing.benchmark_llm --draft prompt_lookup:2 --draft ./gemma-3n-e4b-it-q8_0.gguf
+
+Without --draft, prompt lookup with 2 and 10 draft tokens is compared, to
+pick lib.llm.PROMPT_LOOKUP_TOKENS (or 'prompt_lookup:N') for this machine.
+
+Each mode answers the same prompts greedily (temperature 0), so the outputs
+should match the baseline exactly; any mismatch is reported.
+"""
+import argparse
+import json
+import time
+
+import lib.llm as llm
+from lib.characters import build_system_prompt
+import config as cfg
+
+PROMPTS = [
+    "Hi! What's your name?",
+    "What did you have for breakfast today?",
+    "Tell me a joke about pirates.",
+    "Can you describe your favorite place in the world?",
+    "What would you do with a million dollars?",
+    "Repeat after me: the quick brown fox jumps over the lazy dog.",
+]
+# Prompt lookup's draft length: short suits CPUs, long suits GPUs
+DEFAULT_MODES = ['prompt_lookup:2', 'prompt_lookup:10']
+SYSTEM_PROMPT = build_system_prompt({'name': 'Luna'},
+                                    ['neutral', 'happy', 'sad', 'surprised'])
+
+
+def run_prompt(prompt: str, max_tokens: int):
+	"""Returns (text, first token latency, decode tokens/sec)."""
+	start = time.time()
+	first_token_at = None
+	parts = []
+	with llm.model_lock:
+		stream = llm.model.create_chat_completion(
+		    messages=llm.build_messages(prompt, SYSTEM_PROMPT),
+		    max_tokens=max_tokens,
+		    temperature=0.0,
+		    response_format={'type': 'json_object'},
+		    stream=True)
+		for chunk in stream:
+			content = chunk['choices'][0]['delta'].get('content')
+			if content:
+				if first_token_at is None:
+					first_token_at = time.time()
+				parts.append(content)
+	end = time.time()
+	text = "".join(parts)
+	n_tokens = llm.count_tokens(text) if text else 0
+	decode_time = end - (first_token_at or end)
+	tps = (n_tokens - 1) / decode_time if n_tokens > 1 and decode_time > 0 else 0.0
+	return text, (first_token_at or end) - start, tps
+
+
+def run_mode(draft, model_path: str, max_tokens: int, runs: int):
+	name = draft or "baseline"
+	print(f"\n--- {name} ---")
+	llm.init(model_path, draft=draft)
+	# Warm-up, so model loading and the first prefill aren't measured
+	run_prompt(PROMPTS[0], 8)
+	outputs = {}
+	latencies, rates = [], []
+	for prompt in PROMPTS:
+		for _ in range(runs):
+			text, latency, tps = run_prompt(prompt, max_tokens)
+			latencies.append(latency)
+			rates.append(tps)
+		outputs[prompt] = text
+		print(f"{tps:6.1f} tok/s  {latency:.2f}s first token  {text[:60]!r}")
+	llm.unload()
+	result = {
+	    'mode': name,
+	    'first_token': sum(latencies) / len(latencies),
+	    'tokens_per_second': sum(rates) / len(rates),
+	}
+	return result, outputs
+
+
+def main():
+	parser = argparse.ArgumentParser(
+	    description=
+	    "Benchmark speculative decoding modes against plain decoding on character replies."
+	)
+	parser.add_argument(
+	    "--draft",
+	    action="append",
+	    default=[],
+	    help=
+	    "A mode to compare: 'prompt_lookup', 'prompt_lookup:N' or a draft GGUF path. "
+	    "Can be given more than once (default: prompt_lookup:2 and prompt_lookup:10)."
+	)
+	parser.add_argument("--model",
+	                    default=cfg.LANGUAGE_MODEL,
+	                    help="Main model (default: LANGUAGE_MODEL).")
+	parser.add_argument("--max-tokens", type=int, default=128)
+	parser.add_argument("--runs",
+	                    type=int,
+	                    default=2,
+	                    help="Runs per prompt (default: 2).")
+	parser.add_argument("--json", help="Also write the results to this file.")
+	args = parser.parse_args()
+
+	baseline, baseline_outputs = run_mode(None, args.model, args.max_tokens,
+	                                      args.runs)
+	results = [baseline]
+	for draft in args.draft or DEFAULT_MODES:
+		result, outputs = run_mode(draft, args.model, args.max_tokens, args.runs)
+		mismatches = [p for p in PROMPTS if outputs[p] != baseline_outputs[p]]
+		result['speedup'] = result['tokens_per_second'] / max(
+		    baseline['tokens_per_second'], 1e-9)
+		result['mismatches'] = len(mismatches)
+		for prompt in mismatches:
+			print(f"Output differs from baseline for: {prompt!r}")
+		results.append(result)
+
+	print("\nMode                            tok/s  first token  speedup")
+	for r in results:
+		print(f"{r['mode'][-30:]:30}  {r['tokens_per_second']:6.1f}  "
+		      f"{r['first_token']:10.2f}s  {r.get('speedup', 1.0):6.2f}x")
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+	main()